@@ -16,11 +16,50 @@ from pathlib import Path
 import hashlib
 import copy
 
+# dashboard hashing on all cores
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
 # dynamic timestamped names
-from datetime import datetime
+from datetime import datetime, timezone
+
+# watch mode polling
+import time
+
+# --profile stages
+import cProfile, tracemalloc, functools, contextlib
+from collections import Counter
 
 import logging
 
+# pipelined fetching
+import threading, queue
+
+import atexit
+
+# s3 locations
+import hmac
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+# query expression parsing for the query index
+import re, fnmatch
+
+# upper limit of concurrent requests per grafana instance, the actual number adapts to the instance
+MAX_WORKERS = 32
+
+# a request slower than this multiple of the normal latency counts as overload
+LATENCY_SPIKE = 2.0
+
+# times a request that got HTTP 429 (too many requests) is retried
+RATE_LIMIT_RETRIES = 3
+
+# seconds between stack samples for the collapsed stack (flame graph) output of --profile
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# below this many dashboards hashing in worker processes costs more than it saves
+HASH_PROCESS_THRESHOLD = 32
+
 def cli_arguments():
     """
     Uses Argparse to get user input returns a Namespace object:
@@ -69,6 +108,67 @@ def cli_arguments():
         help="Do not perform changes, only show what would be imported/updated",
         action="store_true",
     )
+    import_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Maximum number of concurrent requests, the actual number adapts to the instance (default {MAX_WORKERS})",
+    )
+    import_parser.add_argument(
+        "--dashboard-version",
+        dest="dashboard_versions",
+        action="append",
+        metavar="UID:VERSION",
+        help="Import this older version of a dashboard instead of the latest, needs a dump made with --with-versions (can be repeated)",
+    )
+    import_parser.add_argument(
+        "--preflight",
+        default=False,
+        dest="preflight",
+        help="Only check the references in the dump against the target and exit, nothing is imported",
+        action="store_true",
+    )
+    import_parser.add_argument(
+        "--strict",
+        default=False,
+        dest="strict",
+        help="Stop before importing anything when the preflight check or the backup checksums find problems",
+        action="store_true",
+    )
+    import_parser.add_argument(
+        "--bulk-rulegroups",
+        default=False,
+        dest="bulk_rulegroups",
+        help="Write every alert rule group with one request (rules and settings) instead of one request per rule",
+        action="store_true",
+    )
+    import_parser.add_argument(
+        "--plan-out",
+        dest="plan_out",
+        metavar="PLAN",
+        help="Write the operations the import would do to PLAN (json) instead of importing, run them with apply",
+    )
+    import_parser.add_argument(
+        "--cache",
+        default=False,
+        dest="cache",
+        help="Keep the folder tree and dashboard hashes of each instance between runs (in $XDG_CACHE_HOME/dashmove). Existing dashboards are checked with a small versions request instead of a download, alert rules and contact points are always fetched",
+        action="store_true",
+    )
+    import_parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="DIR",
+        help="Profile every stage and write pstats files and collapsed stacks (for flame graphs) to DIR",
+    )
+    import_parser.add_argument(
+        "--profile-memory",
+        default=False,
+        dest="profile_memory",
+        help="With --profile also trace memory allocations (slower)",
+        action="store_true",
+    )
     import_parser.add_argument(
         "--debug",
         default=False,
@@ -83,7 +183,7 @@ def cli_arguments():
         "--location",
         dest="location",
         required=True,
-        help="The location to save the dump, file or folder. (pointing to a folder will automaticly set a time and url specific name)",
+        help="The location to save the dump, file, folder or s3://bucket/prefix. (pointing to a folder or prefix will automaticly set a time and url specific name)",
     )
     export_parser.add_argument(
         "--secret",
@@ -109,6 +209,458 @@ def cli_arguments():
         help="Dump format: json pickle(default)",
     )
     export_parser.add_argument(
+        "--with-versions",
+        dest="with_versions",
+        type=int,
+        nargs="?",
+        const=5,
+        default=0,
+        metavar="N",
+        help="Also export the last N older versions of every dashboard (default N: 5)",
+    )
+    export_parser.add_argument(
+        "--encoding",
+        dest="encoding",
+        default="plain",
+        choices=["plain", "dedup"],
+        help="plain(default) or dedup: store repeated strings and identical sub-objects once",
+    )
+    export_parser.add_argument(
+        "--minify",
+        default=False,
+        dest="minify",
+        help="Only keep the folderUid of the dashboard meta and leave out fields that have the grafana default value",
+        action="store_true",
+    )
+    export_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Maximum number of concurrent requests, the actual number adapts to the instance (default {MAX_WORKERS})",
+    )
+    export_parser.add_argument(
+        "--cache",
+        default=False,
+        dest="cache",
+        help="Keep the folder tree and dashboard hashes of each instance between runs (in $XDG_CACHE_HOME/dashmove). Existing dashboards are checked with a small versions request instead of a download, alert rules and contact points are always fetched",
+        action="store_true",
+    )
+    export_parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="DIR",
+        help="Profile every stage and write pstats files and collapsed stacks (for flame graphs) to DIR",
+    )
+    export_parser.add_argument(
+        "--profile-memory",
+        default=False,
+        dest="profile_memory",
+        help="With --profile also trace memory allocations (slower)",
+        action="store_true",
+    )
+    export_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## sync command argument parsing
+    sync_parser = subparsers.add_parser("sync", help="Copy directly from one grafana instance to another")
+    sync_parser.add_argument(
+        "--source-url",
+        dest="source_url",
+        required=True,
+        help="The grafana URL to copy from: https://grafana.local",
+    )
+    sync_parser.add_argument(
+        "--source-secret",
+        dest="source_secret",
+        required=True,
+        help="grafana_session=## cookie, glsa_## Service account token or apikey for the source",
+    )
+    sync_parser.add_argument(
+        "--target-url",
+        dest="target_url",
+        required=True,
+        help="The grafana URL to copy to: https://grafana.local",
+    )
+    sync_parser.add_argument(
+        "--target-secret",
+        dest="target_secret",
+        required=True,
+        help="grafana_session=## cookie, glsa_## Service account token or apikey for the target",
+    )
+    sync_parser.add_argument(
+        "--tag",
+        dest="tag",
+        help="Tag used to only include dashboads with tag (only 1 tag supported)",
+    )
+    sync_parser.add_argument(
+        "--location",
+        dest="location",
+        help="Also write a dump of the source while syncing, file, folder or s3://bucket/prefix",
+    )
+    sync_parser.add_argument(
+        "--format",
+        dest="data_format",
+        default="pickle",
+        help="Dump format when --location is used: json pickle(default)",
+    )
+    sync_parser.add_argument(
+        "--encoding",
+        dest="encoding",
+        default="plain",
+        choices=["plain", "dedup"],
+        help="Dump encoding when --location is used: plain(default) or dedup",
+    )
+    sync_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Maximum number of concurrent requests on each instance, the actual number adapts (default {MAX_WORKERS})",
+    )
+    sync_parser.add_argument(
+        "--bulk-rulegroups",
+        default=False,
+        dest="bulk_rulegroups",
+        help="Write every alert rule group with one request (rules and settings) instead of one request per rule",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--override",
+        default=False,
+        dest="override",
+        help="Remove everything in the target before syncing",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--dry-run",
+        default=False,
+        dest="dry_run",
+        help="Do not perform changes, only show what would be imported/updated",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--cache",
+        default=False,
+        dest="cache",
+        help="Keep the folder tree and dashboard hashes of each instance between runs (in $XDG_CACHE_HOME/dashmove). Existing dashboards are checked with a small versions request instead of a download, alert rules and contact points are always fetched",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="DIR",
+        help="Profile every stage and write pstats files and collapsed stacks (for flame graphs) to DIR",
+    )
+    sync_parser.add_argument(
+        "--profile-memory",
+        default=False,
+        dest="profile_memory",
+        help="With --profile also trace memory allocations (slower)",
+        action="store_true",
+    )
+    sync_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## watch command argument parsing
+    watch_parser = subparsers.add_parser("watch", help="Keep a target instance in sync with a source instance")
+    watch_parser.add_argument(
+        "--source-url",
+        dest="source_url",
+        required=True,
+        help="The grafana URL to copy from: https://grafana.local",
+    )
+    watch_parser.add_argument(
+        "--source-secret",
+        dest="source_secret",
+        required=True,
+        help="grafana_session=## cookie, glsa_## Service account token or apikey for the source",
+    )
+    watch_parser.add_argument(
+        "--target-url",
+        dest="target_url",
+        required=True,
+        help="The grafana URL to copy to: https://grafana.local",
+    )
+    watch_parser.add_argument(
+        "--target-secret",
+        dest="target_secret",
+        required=True,
+        help="grafana_session=## cookie, glsa_## Service account token or apikey for the target",
+    )
+    watch_parser.add_argument(
+        "--tag",
+        dest="tag",
+        help="Tag used to only include dashboads with tag (only 1 tag supported)",
+    )
+    watch_parser.add_argument(
+        "--state",
+        dest="state",
+        default="dashmove-watch-state.json",
+        help="File that keeps track of what has been applied to the target (default dashmove-watch-state.json)",
+    )
+    watch_parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=float,
+        default=30,
+        help="Seconds between polls while changes are found (default 30)",
+    )
+    watch_parser.add_argument(
+        "--max-interval",
+        dest="max_interval",
+        type=float,
+        default=600,
+        help="The poll interval doubles while nothing changes up to this many seconds (default 600)",
+    )
+    watch_parser.add_argument(
+        "--recheck",
+        dest="recheck",
+        type=int,
+        default=50,
+        help="Number of dashboards with an unchanged search result whose version is still checked on each poll, "
+        "in rotation (default 50)",
+    )
+    watch_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Maximum number of concurrent requests on each instance, the actual number adapts (default {MAX_WORKERS})",
+    )
+    watch_parser.add_argument(
+        "--once",
+        default=False,
+        dest="once",
+        help="Poll and apply changes once, then exit",
+        action="store_true",
+    )
+    watch_parser.add_argument(
+        "--dry-run",
+        default=False,
+        dest="dry_run",
+        help="Do not perform changes, only show what would be imported/updated",
+        action="store_true",
+    )
+    watch_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## apply command argument parsing
+    apply_parser = subparsers.add_parser("apply", help="Run a plan made with import --plan-out")
+    apply_parser.add_argument("plan", help="The plan file written by import --plan-out")
+    apply_parser.add_argument(
+        "--secret",
+        dest="secret",
+        required=True,
+        help="grafana_session=## cookie, glsa_## Service account token or apikey",
+    )
+    apply_parser.add_argument(
+        "--url",
+        dest="url",
+        required=True,
+        help="The grafana URL: https://grafana.local, must be the instance the plan was made for",
+    )
+    apply_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=MAX_WORKERS,
+        help=f"Maximum number of concurrent requests, the actual number adapts to the instance (default {MAX_WORKERS})",
+    )
+    apply_parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="DIR",
+        help="Profile every stage and write pstats files and collapsed stacks (for flame graphs) to DIR",
+    )
+    apply_parser.add_argument(
+        "--profile-memory",
+        default=False,
+        dest="profile_memory",
+        help="With --profile also trace memory allocations (slower)",
+        action="store_true",
+    )
+    apply_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## inspect command argument parsing
+    inspect_parser = subparsers.add_parser("inspect", help="Inspect a dump without a Grafana connection")
+    inspect_parser.add_argument(
+        "--location", dest="location", required=True, help="The location of the dump"
+    )
+    inspect_parser.add_argument(
+        "--format",
+        dest="data_format",
+        help="Dump format: json, pickle. Taken from the dump index or the file extension if not given",
+    )
+    inspect_parser.add_argument(
+        "--kind",
+        dest="kind",
+        help="Only list objects of this kind: dashboards, folders, datasources, alertrules, ...",
+    )
+    inspect_parser.add_argument(
+        "--search",
+        dest="search",
+        help="Only list objects where the uid or title contains this text",
+    )
+    inspect_parser.add_argument(
+        "--folder",
+        dest="folder",
+        help="Only list objects inside the folder with this uid",
+    )
+    inspect_parser.add_argument(
+        "--largest",
+        dest="largest",
+        type=int,
+        default=10,
+        help="Number of largest dashboards to show (default 10)",
+    )
+    inspect_parser.add_argument(
+        "--extract",
+        dest="extract",
+        help="Print the object with this uid as json to stdout",
+    )
+    inspect_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## verify command argument parsing
+    verify_parser = subparsers.add_parser("verify", help="Check dumps against the checksums in their index")
+    verify_parser.add_argument(
+        "--location",
+        dest="locations",
+        required=True,
+        nargs="+",
+        help="One or more dumps or folders with dumps",
+    )
+    verify_parser.add_argument(
+        "--deep",
+        default=False,
+        dest="deep",
+        help="Check the checksum of every object, not only the whole file digest",
+        action="store_true",
+    )
+    verify_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=8,
+        help="Number of dumps or objects checked in parallel (default 8)",
+    )
+    verify_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## index command argument parsing
+    index_parser = subparsers.add_parser("index", help="Add dumps to the query index")
+    index_parser.add_argument(
+        "--location",
+        dest="locations",
+        required=True,
+        nargs="+",
+        help="One or more dumps or folders with dumps",
+    )
+    index_parser.add_argument(
+        "--index",
+        dest="index",
+        default="dashmove-query-index.json",
+        help="The query index file (default dashmove-query-index.json)",
+    )
+    index_parser.add_argument(
+        "--format",
+        dest="data_format",
+        help="Dump format: json, pickle. Taken from the dump index or the file extension if not given",
+    )
+    index_parser.add_argument(
+        "--prune",
+        default=False,
+        dest="prune",
+        help="Remove dumps from the index that don't exist anymore",
+        action="store_true",
+    )
+    index_parser.add_argument(
+        "--debug",
+        default=False,
+        dest="debug",
+        help="Enable debug logging",
+        action="store_true",
+    )
+
+    ## query command argument parsing
+    query_parser = subparsers.add_parser("query", help="Find the panels and alert rules that use a datasource, metric or label")
+    query_parser.add_argument(
+        "--index",
+        dest="index",
+        default="dashmove-query-index.json",
+        help="The query index file (default dashmove-query-index.json)",
+    )
+    query_parser.add_argument(
+        "--datasource",
+        dest="datasource",
+        help="Datasource uid or name",
+    )
+    query_parser.add_argument(
+        "--type",
+        dest="dstype",
+        help="Datasource type, for example prometheus",
+    )
+    query_parser.add_argument(
+        "--metric",
+        dest="metric",
+        help="Metric name used in a query expression, * and ? match like in a shell",
+    )
+    query_parser.add_argument(
+        "--label",
+        dest="labels",
+        action="append",
+        help="Label name (job) or label matcher (job=node, job=~node.*) used in a query expression, can be repeated",
+    )
+    query_parser.add_argument(
+        "--folder",
+        dest="folder",
+        help="Folder uid or title",
+    )
+    query_parser.add_argument(
+        "--kind",
+        dest="kind",
+        help="Only list objects of this kind: dashboards, alertrules, libraryelements, ...",
+    )
+    query_parser.add_argument(
+        "--latest",
+        default=False,
+        dest="latest",
+        help="Only look at the most recent dump in the index",
+        action="store_true",
+    )
+    query_parser.add_argument(
         "--debug",
         default=False,
         dest="debug",
@@ -120,7 +672,89 @@ def cli_arguments():
     return parser.parse_args(args=None if sys.argv[2:] else sys.argv[1:2] + ["--help"])
 
 
-def login(url, secret):
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for the requests to one grafana instance.
+    The limit grows by about one request per round trip while latency stays flat and is halved
+    (at most once per round trip) on HTTP 429/5xx, connection errors or latency spikes.
+    """
+
+    def __init__(self, max_limit, initial=4, min_limit=1):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.limit = float(min(initial, self.max_limit))
+        self.in_flight = 0
+        self.latency = None
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self.cond:
+            self.in_flight -= 1
+            before = int(self.limit)
+            if self.latency is None:
+                self.latency = latency
+            now = time.monotonic()
+            if not ok or latency > self.latency * LATENCY_SPIKE:
+                if now - self.last_decrease > self.latency:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+                # follow a lasting slowdown slowly so it stops counting as a spike
+                self.latency += 0.02 * (latency - self.latency)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.latency += 0.1 * (latency - self.latency)
+            if int(self.limit) != before:
+                logging.debug(
+                    f"Concurrency {'raised' if int(self.limit) > before else 'lowered'} to {int(self.limit)} "
+                    f"(in flight: {self.in_flight}, latency: {self.latency * 1000:.0f}ms, last: {latency * 1000:.0f}ms{'' if ok else ', error'})"
+                )
+            self.cond.notify_all()
+
+
+class AdaptiveAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that lets every request of the session pass through an AdaptiveLimiter."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            ok = False
+            try:
+                resp = super().send(request, **kwargs)
+                ok = resp.status_code != 429 and resp.status_code < 500
+            finally:
+                self.limiter.release(time.monotonic() - start, ok)
+            if resp.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                return resp
+            # rate limited requests were not processed, so they are safe to send again
+            retry_after = resp.headers.get("Retry-After", "")
+            time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+
+
+def concurrent_map(s, fn, items):
+    """
+    Returns [fn(item) for item in items] computed on a thread pool.
+    The adaptive limiter of the session decides how many requests really run at the same time.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(i) for i in items]
+    with ThreadPoolExecutor(max_workers=min(getattr(s, "max_workers", MAX_WORKERS), len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+def login(url, secret, max_workers=MAX_WORKERS):
     """Returns a requests session which can communicate with the grafana instance."""
     s = requests.Session()
     s.headers.update(
@@ -142,6 +776,12 @@ def login(url, secret):
             }
         )
 
+    # all requests go through one adaptive concurrency limit, with enough pooled connections for its maximum
+    s.max_workers = max_workers
+    adapter = AdaptiveAdapter(AdaptiveLimiter(max_workers), pool_connections=4, pool_maxsize=max(max_workers, 10))
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+
     # Check the connection if ssl fails, disable ssl checks, try again and check status code.
     try:
         r = s.get(f"{url}/api/access-control/user/permissions")
@@ -155,6 +795,148 @@ def login(url, secret):
     print(f"\nConnection established with: {url}")
     return s
 
+# set by enable_inventory_cache when --cache is used, the loaded cache of every instance by url
+INVENTORY_CACHE = {"dir": None, "instances": {}, "lock": threading.Lock()}
+
+# where --cache keeps its files
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"), "dashmove")
+
+
+def enable_inventory_cache(location=CACHE_DIR):
+    Path(location).mkdir(parents=True, exist_ok=True)
+    INVENTORY_CACHE["dir"] = Path(location)
+    atexit.register(save_inventory_caches)
+
+
+def instance_cache(s, url):
+    """
+    Returns the cache of an instance, loaded from disk on first use, or None when --cache is not used.
+    The cache is kept per url and organisation: {"folders": {"signal", "items"}, "dashboards": {uid: [id, version, hash]}}.
+    """
+    if INVENTORY_CACHE["dir"] is None:
+        return None
+    with INVENTORY_CACHE["lock"]:
+        if url in INVENTORY_CACHE["instances"]:
+            return INVENTORY_CACHE["instances"][url][1]
+        org = s.get(f"{url}/api/org").json().get("id")
+        path = Path(INVENTORY_CACHE["dir"], f"{content_hash([url, org])[:16]}.json")
+        cache = {"version": 3, "url": url, "org": org, "folders": None, "dashboards": {}}
+        if path.exists():
+            try:
+                with path.open() as f:
+                    stored = json.load(f)
+                if (stored.get("version"), stored.get("url"), stored.get("org")) == (3, url, org):
+                    cache = stored
+            except ValueError:
+                logging.warning(f"Ignoring broken cache file {path}")
+        logging.debug(f"Using cache {path} for {url} (org {org}) with {len(cache['dashboards'])} dashboard hashes")
+        INVENTORY_CACHE["instances"][url] = (path, cache)
+        return cache
+
+
+def write_json_atomic(path, obj, **kwargs):
+    """Writes obj as json next to path and swaps it in, so an interrupted write never leaves a broken file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f, **kwargs)
+    os.replace(tmp, path)
+
+
+def save_inventory_caches():
+    for path, cache in INVENTORY_CACHE["instances"].values():
+        write_json_atomic(path, cache)
+
+
+# set by enable_profiling when --profile is used
+PROFILE = {"dir": None, "memory": False, "count": 0, "active": False}
+
+
+def enable_profiling(location, memory=False):
+    Path(location).mkdir(parents=True, exist_ok=True)
+    PROFILE.update({"dir": Path(location), "memory": memory})
+    if memory:
+        tracemalloc.start(25)
+    print(f"\nProfiling stages into: {location}")
+
+
+def sample_stacks(stacks, stop, stage):
+    """Samples the stacks of all threads until stop is set, counted as collapsed "stage;thread;frame;..." lines."""
+    me = threading.get_ident()
+    while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks[";".join([stage, names.get(ident, str(ident))] + frames[::-1])] += 1
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """
+    Profiles the code inside the block as one stage when --profile is used, otherwise does nothing.
+    Writes NN-name.pstats (cProfile of the main thread), appends the samples of all threads to
+    profile.collapsed and the duration (and peak memory with --profile-memory) to summary.txt.
+    With --profile-memory NN-name.memory.txt lists the allocation sites that grew or shrank during the stage.
+    Nested stages and stages started outside the main thread are part of the enclosing stage.
+    """
+    if PROFILE["dir"] is None or PROFILE["active"] or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    PROFILE["active"] = True
+    PROFILE["count"] += 1
+    base = PROFILE["dir"] / f"{PROFILE['count']:02d}-{name}"
+    stacks = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, args=(stacks, stop, name), daemon=True)
+    profiler = cProfile.Profile()
+    if PROFILE["memory"]:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stop.set()
+        sampler.join()
+        duration = time.perf_counter() - start
+        PROFILE["active"] = False
+
+        profiler.dump_stats(f"{base}.pstats")
+        with (PROFILE["dir"] / "profile.collapsed").open("a") as f:
+            for stack, count in stacks.items():
+                f.write(f"{stack} {count}\n")
+        summary = f"{base.name:<45} {duration:10.3f}s"
+        if PROFILE["memory"]:
+            peak = tracemalloc.get_traced_memory()[1]
+            summary += f" peak {peak / 1024 / 1024:10.1f} MiB"
+            with open(f"{base}.memory.txt", "w") as f:
+                # the snapshot taken at the start is itself an allocation of tracemalloc, leave it out
+                diff = tracemalloc.take_snapshot().compare_to(before, "lineno")
+                for stat in [d for d in diff if d.traceback[0].filename != tracemalloc.__file__][:50]:
+                    f.write(f"{stat}\n")
+        with (PROFILE["dir"] / "summary.txt").open("a") as f:
+            f.write(summary + "\n")
+        logging.debug(f"Profiled stage {summary}")
+
+
+def profiled(fn):
+    """Runs every call of fn as a profile stage, see profile_stage."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with profile_stage(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
 def count_receivers(policy):
     count = 0
 
@@ -169,15 +951,151 @@ def count_receivers(policy):
     return count
 
 
+class Record:
+    """
+    Metadata of one grafana object. Slotted, so large instances don't keep a dict (or the full json) per object.
+    Supports record["name"] and record.get("folderUid") with the json keys of the api, so code written for the
+    json objects keeps working.
+    """
+
+    __slots__ = ("uid", "id", "title", "type", "folder", "group", "version", "hash")
+
+    # json keys of the api responses that are stored in a record field
+    ALIASES = {
+        "name": "title",
+        "folderUid": "folder",
+        "folderUID": "folder",
+        "parentUid": "folder",
+        "ruleGroup": "group",
+        "updated": "version",
+    }
+
+    def __init__(self, uid=None, id=None, title=None, type=None, folder=None, group=None, version=None, hash=None):
+        self.uid = uid
+        self.id = id
+        self.title = title
+        # few distinct values repeated over many objects, share one string
+        self.type = sys.intern(type) if isinstance(type, str) else type
+        self.folder = sys.intern(folder) if isinstance(folder, str) else folder
+        self.group = group
+        self.version = version
+        self.hash = hash
+
+    @classmethod
+    def from_json(cls, obj, hash=None):
+        return cls(
+            uid=obj.get("uid"),
+            id=obj.get("id"),
+            title=obj.get("title", obj.get("name")),
+            type=obj.get("type"),
+            folder=obj.get("folderUid", obj.get("folderUID", obj.get("parentUid"))),
+            group=obj.get("ruleGroup"),
+            version=obj.get("version", obj.get("updated")),
+            hash=hash,
+        )
+
+    def __getitem__(self, key):
+        field = self.ALIASES.get(key, key)
+        if field not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, field)
+
+    def get(self, key, default=None):
+        field = self.ALIASES.get(key, key)
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"Record(uid={self.uid!r}, title={self.title!r})"
+
+
+class Inventory:
+    """The records of one kind of object with indexes on uid, id and title, iterates like the json list it replaces."""
+
+    __slots__ = ("records", "by_uid", "by_id", "by_title")
+
+    def __init__(self, records=()):
+        self.records = tuple(records)
+        self.by_uid = {r.uid: r for r in self.records if r.uid is not None}
+        self.by_id = {r.id: r for r in self.records if r.id is not None}
+        self.by_title = {}
+        for r in self.records:
+            self.by_title.setdefault(r.title, []).append(r)
+
+    @classmethod
+    def from_json(cls, objects, hasher=None):
+        """Builds the inventory from an api list, hasher(obj) is stored as record hash when the content matters."""
+        return cls(Record.from_json(o, hasher(o) if hasher else None) for o in objects if isinstance(o, dict))
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, uid):
+        return uid in self.by_uid
+
+    def get(self, uid, default=None):
+        return self.by_uid.get(uid, default)
+
+    def titled(self, title):
+        """Returns the records with this title (or name), titles are not unique."""
+        return self.by_title.get(title, [])
+
+    def only(self, uids):
+        return Inventory(self.by_uid[uid] for uid in uids if uid in self.by_uid)
+
+
+@profiled
 def get_current_state(s, url, tag=False):
     """
-    Returns the current objects in the connected grafana instance. (mostly metadata)
-    It doesn't download all the data inside the objects: datasources, folders, dashboards and alertrules.
-    Use the fetch_ functions to get all the data inside those objects.
+    Returns the current objects in the connected grafana instance. (metadata only)
+    Datasources, folders, dashboards, alertrules and contactpoints are returned as an Inventory of records,
+    the json returned by the api is not kept. Use the fetch_ functions to get all the data inside those objects.
     Use tag to filter dashboards based on that tag.
     """
     tag_query = f"&tag={tag}" if tag else ""
-    datasources = s.get(f"{url}/api/datasources").json()
+    datasources = Inventory.from_json(s.get(f"{url}/api/datasources").json())
+    folders = Inventory.from_json(list_folders(s, url))
+    dashboards = Inventory.from_json(s.get(f"{url}/api/search?limit=5000&type=dash-db{tag_query}").json())
+    # contact points are compared by content on import, only the hash of the content is kept
+    contactpoints = Inventory.from_json(s.get(f"{url}/api/v1/provisioning/contact-points").json(), contactpoint_hash)
+    policies = s.get(f"{url}/api/v1/provisioning/policies").json()
+
+    alertrules = Inventory.from_json(s.get(f"{url}/api/v1/provisioning/alert-rules").json())
+
+    # alertrules = []
+    # rules = s.get(f"{url}/api/ruler/grafana/api/v1/rules").json()
+    # for folder in rules:
+    #     for x in rules[folder]:
+    #         for y in x["rules"]:
+    #             alertrules.append(y["grafana_alert"])
+
+    preferences = fetch_preferences(s, url)
+
+    return datasources, folders, dashboards, alertrules, contactpoints, policies, preferences
+
+
+def list_folders(s, url):
+    """
+    Returns all folders including nested sub-folders (metadata only).
+    With --cache the folder tree is only walked again when the folder search (one request) changed.
+    """
+    cache = instance_cache(s, url)
+    if cache is not None:
+        hits = s.get(f"{url}/api/search?type=dash-folder&limit=5000").json()
+        signal = content_hash(sorted([h.get("uid"), h.get("title"), h.get("folderUid")] for h in hits))
+        if cache["folders"] and cache["folders"]["signal"] == signal:
+            logging.debug(f"Folders of {url} unchanged, using {len(cache['folders']['items'])} cached folders")
+            return copy.deepcopy(cache["folders"]["items"])
+        folders = list_folders_tree(s, url)
+        cache["folders"] = {"signal": signal, "items": copy.deepcopy(folders)}
+        return folders
+    return list_folders_tree(s, url)
+
+
+def list_folders_tree(s, url):
     # Fetch folders recursively (Grafana supports nested folders via parentUid).
     # NOTE: The original implementation only fetched one subfolder level.
     main_folders = s.get(f"{url}/api/folders").json()
@@ -209,132 +1127,939 @@ def get_current_state(s, url, tag=False):
             if not uid or uid in seen:
                 continue
             seen.add(uid)
+            # the list api leaves out the parent, keep it so moves show up in the listing
+            child.setdefault("parentUid", parent_uid)
             folders.append(child)
             queue.append(uid)
-    
-    dashboards = s.get(f"{url}/api/search?limit=5000&type=dash-db{tag_query}").json()
+
+    return folders
+
+
+@profiled
+def fetch_datasources(s, url, datasources_list):
+    return concurrent_map(
+        s, lambda uid: s.get(f"{url}/api/datasources/uid/{uid}").json(), [x["uid"] for x in datasources_list]
+    )
+
+
+@profiled
+def fetch_folders(s, url, folder_list):
+    ids = [x.get("id") for x in folder_list if x.get("id") is not None] + [0]
+    return concurrent_map(s, lambda id: s.get(f"{url}/api/folders/id/{id}").json(), ids)
+
+
+def fetch_dashboard(s, url, uid):
+    return s.get(f"{url}/api/dashboards/uid/{uid}").json()
+
+
+# marks the end of a stage in the dashboard pipeline
+_DONE = object()
+
+
+def dashboard_version_items(body):
+    """Returns the list of a dashboard versions response, grafana 11 wraps it: {"versions": [...], "continueToken": ...}."""
+    return body.get("versions", []) if isinstance(body, dict) else body
+
+
+def fetch_dashboard_history(s, url, uid, current_version, count):
+    """Returns up to count older versions of a dashboard, newest first, with the dashboard body in "data"."""
+    r = s.get(f"{url}/api/dashboards/uid/{uid}/versions?limit={count + 1}")
+    if r.status_code != 200:
+        logging.warning(f"Could not fetch versions of dashboard {uid} (HTTP {r.status_code})")
+        return []
+    items = dashboard_version_items(r.json())
+    history = []
+    for item in items:
+        if item.get("version") == current_version:
+            continue
+        if len(history) >= count:
+            break
+        r = s.get(f"{url}/api/dashboards/uid/{uid}/versions/{item['version']}")
+        if r.status_code != 200:
+            logging.warning(f"Could not fetch version {item['version']} of dashboard {uid} (HTTP {r.status_code})")
+            continue
+        history.append({
+            "version": item.get("version"),
+            "created": item.get("created"),
+            "createdBy": item.get("createdBy"),
+            "message": item.get("message"),
+            "data": r.json().get("data"),
+        })
+    return history
+
+
+# fields that identify the elements of a list in a dashboard: panels, targets and template variables
+JSON_DELTA_LIST_KEYS = ("id", "refId", "name")
+
+
+def json_delta_list_key(base, target):
+    """Returns the field that identifies every element of both lists once, None when there is none."""
+    if not all(isinstance(item, dict) for item in base + target):
+        return None
+    for key in JSON_DELTA_LIST_KEYS:
+        for items in (base, target):
+            ids = [str(item.get(key)) for item in items if item.get(key) is not None]
+            if len(ids) != len(items) or len(set(ids)) != len(ids):
+                break
+        else:
+            return key
+    return None
+
+
+def json_delta(base, target):
+    """
+    Returns a compact delta that turns base into target, None when they are equal.
+    A delta is ["=", value] (replace), ["-"] (remove key), {"~": {key: delta}} (patch dict),
+    {"@": {index: delta}} (patch list of the same length)
+    or {"#": {"key": field, "order": [ids], "items": {id: delta}}} (patch list matched by an id field,
+    so adding or removing a panel only stores that panel).
+    """
+    if base == target:
+        return None
+    if isinstance(base, dict) and isinstance(target, dict):
+        patch = {}
+        for k, v in target.items():
+            if k not in base:
+                patch[k] = ["=", v]
+            elif base[k] != v:
+                patch[k] = json_delta(base[k], v)
+        for k in base:
+            if k not in target:
+                patch[k] = ["-"]
+        return {"~": patch}
+    if isinstance(base, list) and isinstance(target, list) and len(base) == len(target):
+        return {"@": {str(i): json_delta(a, b) for i, (a, b) in enumerate(zip(base, target)) if a != b}}
+    if isinstance(base, list) and isinstance(target, list):
+        key = json_delta_list_key(base, target)
+        if key is not None:
+            by_id = {str(item[key]): item for item in base}
+            items = {}
+            for item in target:
+                if str(item[key]) not in by_id:
+                    items[str(item[key])] = ["=", item]
+                elif by_id[str(item[key])] != item:
+                    items[str(item[key])] = json_delta(by_id[str(item[key])], item)
+            return {"#": {"key": key, "order": [str(item[key]) for item in target], "items": items}}
+    return ["=", target]
+
+
+def apply_json_delta(base, delta):
+    """Returns base with a json_delta applied, base itself is not changed."""
+    if delta is None:
+        return base
+    if isinstance(delta, list):
+        return delta[1]
+    if "~" in delta:
+        result = dict(base)
+        for k, d in delta["~"].items():
+            if d == ["-"]:
+                result.pop(k, None)
+            else:
+                result[k] = apply_json_delta(base.get(k), d)
+        return result
+    if "#" in delta:
+        by_id = {str(item[delta["#"]["key"]]): item for item in base}
+        return [apply_json_delta(by_id.get(i), delta["#"]["items"].get(i)) for i in delta["#"]["order"]]
+    result = list(base)
+    for i, d in delta["@"].items():
+        result[int(i)] = apply_json_delta(base[int(i)], d)
+    return result
+
+
+def restore_dashboard_version(grafana_backup, uid, version):
+    """Replaces the latest body of a dashboard in the backup with an older exported version."""
+    for backup_dashboard in grafana_backup["dashboards"]:
+        if backup_dashboard["dashboard"].get("uid") != uid:
+            continue
+        for old in backup_dashboard.get("versions", []):
+            if old["version"] == version:
+                backup_dashboard["dashboard"] = apply_json_delta(backup_dashboard["dashboard"], old["delta"])
+                logging.info(f"Using version {version} of dashboard {uid}")
+                return True
+        logging.error(f"Version {version} of dashboard {uid} not found in the backup")
+        return False
+    logging.error(f"Dashboard {uid} not found in the backup")
+    return False
+
+
+def stream_dashboards(s, url, dashboard_list, folders, workers=MAX_WORKERS, library_uids=None, versions=0, minify=False):
+    """
+    Yields fetched and transformed dashboards while the next ones are still downloading.
+    Fetch workers, a transform thread and the caller are connected by bounded queues,
+    so only a couple of dashboards per worker are held in memory at any time.
+    Panels of library elements in library_uids are reduced to their reference.
+    With versions the last older versions are fetched by the same workers and stored as deltas against the latest body.
+    With minify the meta and default values are left out (the older versions are minified as well).
+    """
+    uids = queue.Queue()
+    for d in dashboard_list:
+        if d.get("type") != "dash-folder":
+            uids.put(d["uid"])
+    fetched = queue.Queue(maxsize=workers * 2)
+    ready = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+
+    def put(q, item):
+        # give up when the consumer stopped reading, otherwise the thread would block forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def fetch_worker():
+        while not stop.is_set():
+            try:
+                uid = uids.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                item = fetch_dashboard(s, url, uid)
+                if versions:
+                    item["versions"] = fetch_dashboard_history(
+                        s, url, uid, item.get("dashboard", {}).get("version"), versions
+                    )
+                put(fetched, item)
+            except Exception as e:
+                put(fetched, e)
+        put(fetched, _DONE)
+
+    def transform(obj):
+        # add uid to dashlist panels for portability and remove NOBACKUP panels
+        obj = remove_nobackup_panels(add_folder_uid_to_dashlist_panels(obj, folders))
+        if library_uids:
+            obj = strip_library_panels(obj, library_uids)
+        if minify:
+            obj = minify_dashboard_entry(obj)
+        return obj
+
+    def transform_worker():
+        finished = 0
+        while finished < workers and not stop.is_set():
+            item = get(fetched)
+            if item is _DONE:
+                finished += 1
+                continue
+            if not isinstance(item, Exception):
+                history = item.pop("versions", None)
+                item = transform(item)
+                if history:
+                    item["versions"] = [
+                        dict(
+                            {k: v for k, v in old.items() if k != "data"},
+                            delta=json_delta(item["dashboard"], transform(old["data"])),
+                        )
+                        for old in history
+                    ]
+            put(ready, item)
+        put(ready, _DONE)
+
+    threads = [threading.Thread(target=fetch_worker, name=f"dashboard-fetch-{i}", daemon=True) for i in range(workers)]
+    threads.append(threading.Thread(target=transform_worker, name="dashboard-transform", daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = get(ready)
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            logging.debug(f"Streamed dashboard {item.get('dashboard', {}).get('uid')} (queued: {fetched.qsize()} fetched, {ready.qsize()} ready)")
+            yield item
+    finally:
+        stop.set()
+
+
+@profiled
+def fetch_alertrules(s, url, alertrules_list):
+    alertrules = concurrent_map(
+        s, lambda uid: s.get(f"{url}/api/v1/provisioning/alert-rules/{uid}").json(), [x["uid"] for x in alertrules_list]
+    )
+
+    used_rulegroups = {(item["folderUID"], item["ruleGroup"]) for item in alertrules_list}
+
+    rulegroups = concurrent_map(
+        s,
+        lambda group: s.get(f"{url}/api/v1/provisioning/folder/{group[0]}/rule-groups/{group[1]}").json(),
+        sorted(used_rulegroups),
+    )
+
+    for i, rulegroup in enumerate(rulegroups):
+        if isinstance(rulegroup, str):
+            rulegroup = json.loads(rulegroup)
+        rulegroup.pop("rules", None)
+        rulegroups[i] = rulegroup
+
+    return alertrules, rulegroups
+
+@profiled
+def fetch_libraryelements(s, url, per_page=100):
+    """Returns all library elements (library panels) of the instance, one page at a time."""
+    elements = []
+    page = 1
+    while True:
+        r = s.get(f"{url}/api/library-elements?perPage={per_page}&page={page}")
+        if r.status_code != 200:
+            logging.warning(f"Could not fetch library elements (HTTP {r.status_code})")
+            break
+        result = r.json().get("result", {})
+        batch = result.get("elements") or []
+        elements.extend(batch)
+        if not batch or len(elements) >= result.get("totalCount", 0):
+            break
+        page += 1
+    return elements
+
+
+# panel fields that stay in a dashboard when the panel body lives in a library element
+LIBRARY_PANEL_KEEP_FIELDS = ("id", "gridPos", "libraryPanel")
+
+
+def strip_library_panels(obj, library_uids):
+    """Reduces panels that reference an exported library element to the reference, the body is kept once in the library element."""
+    if isinstance(obj, list):
+        return [strip_library_panels(i, library_uids) for i in obj]
+    elif isinstance(obj, dict):
+        library_panel = obj.get("libraryPanel")
+        if isinstance(library_panel, dict) and library_panel.get("uid") in library_uids:
+            return {k: v for k, v in obj.items() if k in LIBRARY_PANEL_KEEP_FIELDS}
+        return {k: strip_library_panels(v, library_uids) for k, v in obj.items()}
+    else:
+        return obj
+
+
+@profiled
+def fetch_contactpoints(s, url, contactpoints_list):
+    contactpoints = []
     contactpoints = s.get(f"{url}/api/v1/provisioning/contact-points").json()
+    return contactpoints
+
+@profiled
+def fetch_policies(s, url, policies_list):
+    policies = []
     policies = s.get(f"{url}/api/v1/provisioning/policies").json()
+    return policies
+
+def fetch_preferences(s, url):
+    """
+    Returns the current preferences in the connected grafana instance.
+    """
+    org = s.get(f"{url}/api/org/preferences").json()
+
+    # get all teams and their preferences
+    def team_preferences(team):
+        team['preferences'] = s.get(f"{url}/api/teams/{team['id']}/preferences").json()
+        return team
+
+    team_prefs = concurrent_map(s, team_preferences, list_teams(s, url))
+
+    #TODO: we might want to migrate user preferences but we are not allowed to access that through the api at the moment
+
+    return {"org": org, "teams": team_prefs}
+
+
+def list_teams(s, url, per_page=1000):
+    """Returns all teams of the organisation, the search api returns one page at a time."""
+    teams = []
+    page = 1
+    while True:
+        r = s.get(f"{url}/api/teams/search?perpage={per_page}&page={page}").json()
+        batch = r.get('teams') or []
+        teams.extend(batch)
+        if not batch or len(teams) >= r.get('totalCount', 0):
+            break
+        page += 1
+    return teams
+
+
+# size of the parts of multipart uploads and ranged reads of dumps in s3 (the s3 minimum is 5 MiB)
+S3_PART_SIZE = 16 * 1024 * 1024
+
+# parts uploaded or read in parallel per dump, also limits the parts held in memory while uploading
+S3_WORKERS = 8
+
+# s3 client created from the AWS_* environment on first use
+S3 = {"client": None, "lock": threading.Lock()}
+
+
+def is_s3_location(location):
+    return str(location).startswith("s3://")
+
+
+def split_s3_location(location):
+    bucket, _, key = str(location)[len("s3://"):].partition("/")
+    return bucket, key
+
+
+class S3Client:
+    """
+    Just enough of the s3 api for dumps: single and multipart uploads, size and ranged reads.
+    Requests are signed with AWS signature v4 and use path style urls so s3 compatible stores like minio work too.
+    """
+
+    def __init__(self, endpoint, region, access_key, secret_key, session_token=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlsplit(self.endpoint).netloc
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.session = requests.Session()
+        self.session.mount(self.endpoint, requests.adapters.HTTPAdapter(pool_maxsize=S3_WORKERS * 2))
+
+    def sign(self, method, path, query, headers, payload_hash):
+        now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        headers.update({"host": self.host, "x-amz-date": now, "x-amz-content-sha256": payload_hash})
+        if self.session_token:
+            headers["x-amz-security-token"] = self.session_token
+        signed_headers = sorted(headers)
+        canonical_request = "\n".join([
+            method, path, query,
+            "".join(f"{name}:{str(headers[name]).strip()}\n" for name in signed_headers),
+            ";".join(signed_headers), payload_hash,
+        ])
+        scope = f"{now[:8]}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", now, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (now[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(signed_headers)}, Signature={signature}"
+        )
+
+    def request(self, method, bucket, key, params=None, data=b"", headers=None, ok=(200,)):
+        """Sends a signed request, server errors and throttling are retried. Raises OSError for other failures."""
+        path = f"/{quote(bucket)}/{quote(key, safe='/~')}"
+        query = "&".join(f"{quote(k, safe='~')}={quote(str(v), safe='~')}" for k, v in sorted((params or {}).items()))
+        payload_hash = hashlib.sha256(data).hexdigest()
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            request_headers = {k.lower(): v for k, v in (headers or {}).items()}
+            self.sign(method, path, query, request_headers, payload_hash)
+            try:
+                r = self.session.request(
+                    method, f"{self.endpoint}{path}{'?' + query if query else ''}", data=data, headers=request_headers
+                )
+            except requests.exceptions.ConnectionError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise OSError(f"s3 {method} s3://{bucket}/{key} failed: {e}") from e
+            else:
+                if r.status_code in ok:
+                    return r
+                if r.status_code not in (429, 500, 502, 503, 504) or attempt == RATE_LIMIT_RETRIES:
+                    raise OSError(f"s3 {method} s3://{bucket}/{key} failed: {r.status_code} {r.text[:300]}")
+            time.sleep(0.5 * 2**attempt)
+
+    def put(self, bucket, key, data):
+        self.request("PUT", bucket, key, data=data)
+
+    def size(self, bucket, key):
+        """Returns the size of an object or None when it doesn't exist."""
+        r = self.request("HEAD", bucket, key, ok=(200, 404))
+        return int(r.headers["Content-Length"]) if r.status_code == 200 else None
+
+    def get(self, bucket, key, offset=None, length=None):
+        """Returns the object or a byte range of it, None when the object doesn't exist."""
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"} if offset is not None else None
+        r = self.request("GET", bucket, key, headers=headers, ok=(200, 206, 404))
+        return r.content if r.status_code != 404 else None
+
+    def create_multipart_upload(self, bucket, key):
+        r = self.request("POST", bucket, key, params={"uploads": ""})
+        return xml_text(r.content, "UploadId")
+
+    def upload_part(self, bucket, key, upload_id, number, data):
+        r = self.request("PUT", bucket, key, params={"partNumber": number, "uploadId": upload_id}, data=data)
+        return r.headers["ETag"]
+
+    def complete_multipart_upload(self, bucket, key, upload_id, etags):
+        body = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in enumerate(etags, 1)
+        )
+        r = self.request(
+            "POST", bucket, key, params={"uploadId": upload_id},
+            data=f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode(),
+        )
+        # s3 can answer 200 and still fail the upload, the error is then in the body
+        if xml_text(r.content, "Code"):
+            raise OSError(f"s3 upload of s3://{bucket}/{key} failed: {r.text[:300]}")
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.request("DELETE", bucket, key, params={"uploadId": upload_id}, ok=(200, 204, 404))
+
+
+def xml_text(body, tag):
+    """Returns the text of the first element with this tag in an s3 response, ignoring the namespace."""
+    for element in ElementTree.fromstring(body).iter():
+        if element.tag.rsplit("}", 1)[-1] == tag:
+            return element.text
+    return None
+
+
+def s3_client():
+    """
+    Returns the s3 client configured by the usual AWS_* environment variables.
+    AWS_ENDPOINT_URL_S3 or AWS_ENDPOINT_URL point to s3 compatible stores (minio, moto server, ...).
+    """
+    with S3["lock"]:
+        if S3["client"] is None:
+            region = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+            endpoint = (
+                os.environ.get("AWS_ENDPOINT_URL_S3") or os.environ.get("AWS_ENDPOINT_URL") or f"https://s3.{region}.amazonaws.com"
+            )
+            if not os.environ.get("AWS_ACCESS_KEY_ID") or not os.environ.get("AWS_SECRET_ACCESS_KEY"):
+                logging.error("AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY have to be set to use s3:// locations")
+                sys.exit(1)
+            S3["client"] = S3Client(
+                endpoint, region, os.environ["AWS_ACCESS_KEY_ID"], os.environ["AWS_SECRET_ACCESS_KEY"],
+                os.environ.get("AWS_SESSION_TOKEN"),
+            )
+        return S3["client"]
+
+
+class S3Writer:
+    """
+    File like target that streams a dump to s3. Writes are cut into parts that are uploaded concurrently
+    as a multipart upload, at most S3_WORKERS parts are in flight so memory use doesn't depend on the dump size.
+    Dumps smaller than one part are written with a single request.
+    """
+
+    def __init__(self, location, part_size=S3_PART_SIZE, workers=S3_WORKERS):
+        self.client = s3_client()
+        self.bucket, self.key = split_s3_location(location)
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.position = 0
+        self.digest = hashlib.sha256()
+        self.upload_id = None
+        self.parts = []
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.Semaphore(workers)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        self.digest.update(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def upload(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(self.bucket, self.key)
+        # wait for a free slot, a failed part stops the dump right away
+        self.slots.acquire()
+        failed = next((f for f in self.parts if f.done() and f.exception()), None)
+        if failed:
+            self.slots.release()
+            failed.result()
+        future = self.executor.submit(
+            self.client.upload_part, self.bucket, self.key, self.upload_id, len(self.parts) + 1, data
+        )
+        future.add_done_callback(lambda _: self.slots.release())
+        self.parts.append(future)
+
+    def close(self):
+        try:
+            if self.upload_id is None:
+                self.client.put(self.bucket, self.key, bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.upload(bytes(self.buffer))
+                etags = [f.result() for f in self.parts]
+                self.client.complete_multipart_upload(self.bucket, self.key, self.upload_id, etags)
+        except BaseException:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+        self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
-    alertrules = s.get(f"{url}/api/v1/provisioning/alert-rules").json()
 
-    # alertrules = []
-    # rules = s.get(f"{url}/api/ruler/grafana/api/v1/rules").json()
-    # for folder in rules:
-    #     for x in rules[folder]:
-    #         for y in x["rules"]:
-    #             alertrules.append(y["grafana_alert"])
+def open_backup_output(location):
+    """Opens the dump for writing in binary mode, local file or s3 object."""
+    if is_s3_location(location):
+        return S3Writer(location)
+    return Path(location).open(mode="wb")
 
-    preferences = fetch_preferences(s, url)
 
-    return datasources, folders, dashboards, alertrules, contactpoints, policies, preferences
+def backup_size(location):
+    """Returns the size of a dump, None if it doesn't exist."""
+    if is_s3_location(location):
+        return s3_client().size(*split_s3_location(location))
+    return os.path.getsize(location) if os.path.exists(location) else None
 
 
-def fetch_datasources(s, url, datasources_list):
-    datasources = []
-    for uid in [x["uid"] for x in datasources_list]:
-        r = s.get(f"{url}/api/datasources/uid/{uid}")
-        datasources.append(r.json())
-    return datasources
+def s3_part_reader(location, part_size=S3_PART_SIZE):
+    """Returns (size, read_part) of a dump in s3, read_part(offset) returns the part that starts at offset."""
+    client = s3_client()
+    bucket, key = split_s3_location(location)
+    size = client.size(bucket, key)
+    if size is None:
+        raise FileNotFoundError(f"No such dump: {location}")
 
+    def read_part(offset):
+        part = client.get(bucket, key, offset, min(part_size, size - offset))
+        if part is None or len(part) != min(part_size, size - offset):
+            raise OSError(f"Short read of {location} at {offset}, the dump changed while reading")
+        return part
 
-def fetch_folders(s, url, folder_list):
-    folders = []
-    for id in [x.get("id") for x in folder_list if isinstance(x, dict) and x.get("id") is not None] + [0]:
-        r = s.get(f"{url}/api/folders/id/{id}")
-        folders.append(r.json())
-    return folders
+    return size, read_part
 
 
-def fetch_dashboards(s, url, dashboard_list):
-    dashboards = []
-    
-    dashboard_list = [d for d in dashboard_list if d.get("type") != "dash-folder"]
-    for uid in [x["uid"] for x in dashboard_list]:
-        r = s.get(f"{url}/api/dashboards/uid/{uid}").json()
-        
-        # check if dashboard is a folder, dot not include folder in dashboard backup
-        # if "isFolder" in r['meta'] and r['meta']["isFolder"] is True:
-        #     continue
-        
-        dashboards.append(r)
-    return dashboards
+def read_backup_bytes(location, part_size=S3_PART_SIZE, workers=S3_WORKERS):
+    """Returns the content of a dump, dumps in s3 are read with parallel ranged requests."""
+    if not is_s3_location(location):
+        with open(location, "rb") as f:
+            return f.read()
+    size, read_part = s3_part_reader(location, part_size)
+    data = bytearray(size)
+
+    def copy_part(offset):
+        data[offset : offset + part_size] = read_part(offset)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(copy_part, range(0, size, part_size)))
+    return data
+
+
+def read_backup_range(location, offset, length):
+    """Returns length bytes of a dump starting at offset, without reading the rest of it."""
+    if is_s3_location(location):
+        return s3_client().get(*split_s3_location(location), offset, length) or b""
+    with open(location, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def read_backup_index_file(location):
+    """Returns the sidecar index of a dump as written by the export, None when there is none."""
+    if is_s3_location(location):
+        bucket, key = split_s3_location(location)
+        data = s3_client().get(bucket, f"{key}.index.json")
+        return json.loads(data) if data is not None else None
+    index_file = backup_index_path(location)
+    if not index_file.exists():
+        return None
+    with index_file.open() as f:
+        return json.load(f)
+
+
+@profiled
+def write_to_filesystem(grafana_backup, location, data_format, url, encoding="plain"):
+    # if location is folder (or an s3 prefix) choose output name automaticly
+    s3_prefix = is_s3_location(location) and not location.endswith((".json", ".pickle"))
+    if os.path.isdir(location) or s3_prefix:
+        timestamp = datetime.now().isoformat(timespec="minutes")
+        # Folder from location input + server base url + timestamp + output format
+        name = f'{url.split("://")[1]}_{timestamp}.{data_format}'.replace(":", "")
+        output_file = f"{location.rstrip('/')}/{name}" if s3_prefix else Path(location, name)
+    elif is_s3_location(location):
+        output_file = location
+    else:
+        output_file = Path(location)
 
+    print(f"\nWriting backup to: {output_file} \n")
 
-def fetch_alertrules(s, url, alertrules_list):
-    alertrules = []
-    rulegroups = []
-    for uid in [x["uid"] for x in alertrules_list]:
-        r = s.get(f"{url}/api/v1/provisioning/alert-rules/{uid}")
-        alertrules.append(r.json())
+    # print(grafana_backup)
 
-    used_rulegroups = {item["folderUID"]: item["ruleGroup"] for item in alertrules_list}
+    if data_format == "pickle" or encoding == "dedup":
+        # pickle and the dedup encoding can't be written incrementally, collect streamed sections first
+        grafana_backup = {
+            kind: section if isinstance(section, (dict, list)) else list(section)
+            for kind, section in grafana_backup.items()
+        }
+        checksum_format = checksum_data_format(data_format, encoding)
+        entries = [
+            backup_entry(kind, obj, serialize_object(obj, checksum_format)) for kind, obj in iter_backup_objects(grafana_backup)
+        ]
+        if encoding == "dedup":
+            grafana_backup = dedup_encode(grafana_backup)
+        with open_backup_output(output_file) as f:
+            if data_format == "pickle":
+                pickle.dump(grafana_backup, f)
+            else:
+                f.write(json.dumps(grafana_backup, separators=(",", ":")).encode())
+    elif data_format == "json":
+        with open_backup_output(output_file) as f:
+            entries = write_json_backup(grafana_backup, f)
 
-    for folder_uid, rule_group in used_rulegroups.items():
-        r = s.get(f"{url}/api/v1/provisioning/folder/{folder_uid}/rule-groups/{rule_group}")
-        rulegroups.append(r.json())
+    if is_s3_location(output_file):
+        # the dump was never on disk, size and digest were taken while uploading
+        size, sha256 = f.tell(), f.digest.hexdigest()
+    else:
+        size, sha256 = os.path.getsize(output_file), file_digest(output_file)
+    write_backup_index(output_file, entries, data_format, url, size, sha256, encoding)
+    return output_file
 
-    for i, rulegroup in enumerate(rulegroups):
-        if isinstance(rulegroup, str):
-            rulegroup = json.loads(rulegroup)
-        rulegroup.pop("rules", None)
-        rulegroups[i] = rulegroup
 
-    return alertrules, rulegroups
+def serialize_object(obj, data_format):
+    """Returns the bytes of a single backup object, for json these are exactly the bytes written to the dump."""
+    if data_format == "pickle":
+        return pickle.dumps(obj)
+    return json.dumps(obj, indent=4).encode("utf-8")
 
-def fetch_contactpoints(s, url, contactpoints_list):
-    contactpoints = []
-    contactpoints = s.get(f"{url}/api/v1/provisioning/contact-points").json()
-    return contactpoints
 
-def fetch_policies(s, url, policies_list):
-    policies = []
-    policies = s.get(f"{url}/api/v1/provisioning/policies").json()
-    return policies
+def checksum_data_format(data_format, encoding):
+    """
+    Returns the format the object checksums are taken of. Pickle writes repeated objects as references, which
+    depends on what is shared in memory and differs after decoding a dedup dump, so those are checked as json.
+    """
+    return "json" if data_format == "pickle" and encoding == "dedup" else data_format
 
-def fetch_preferences(s, url):
+
+def backup_entry(kind, obj, data, offset=None):
+    """Returns the index entry of a backup object with the size and sha256 of its serialized bytes."""
+    return dict(
+        kind=kind, offset=offset, length=len(data), sha256=hashlib.sha256(data).hexdigest(),
+        **backup_object_meta(kind, obj),
+    )
+
+
+def file_digest(location, chunk_size=1024 * 1024, workers=S3_WORKERS, part_size=S3_PART_SIZE):
     """
-    Returns the current preferences in the connected grafana instance.
+    Returns the sha256 of a file, read in chunks so memory use doesn't depend on the file size.
+    Dumps in s3 are read with parallel ranged requests and hashed part by part in order,
+    at most workers parts are held in memory.
     """
-    org = s.get(f"{url}/api/org/preferences").json()
+    digest = hashlib.sha256()
+    if is_s3_location(location):
+        size, read_part = s3_part_reader(location, part_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for offset in range(0, size, part_size):
+                if len(pending) == workers:
+                    digest.update(pending.pop(0).result())
+                pending.append(executor.submit(read_part, offset))
+            for future in pending:
+                digest.update(future.result())
+        return digest.hexdigest()
+    with open(location, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# marks a backup written with dedup_encode
+DEDUP_ENCODING = "dedup-v1"
+
+
+def dedup_encode(obj):
+    """
+    Encodes a backup with interned strings and hash-consed sub-trees.
+    Every distinct string is stored once in "strings" and every distinct dict or list once in "nodes",
+    so repeated fieldConfig blocks, datasource refs and queries only take space once.
+    A node is [kind, types, keys, values]: kind "d" (dict) or "l" (list), keys are string ids (dicts only)
+    and types has one char per value: s string id, n node id, i int, f float, b bool, z null.
+    Nodes only point to earlier nodes so decoding is a single pass.
+    """
+    strings, string_ids = [], {}
+    nodes, node_ids = [], {}
+
+    def string_id(value):
+        sid = string_ids.get(value)
+        if sid is None:
+            sid = string_ids[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    def encode(value):
+        if isinstance(value, str):
+            return "s", string_id(value)
+        if isinstance(value, bool):
+            return "b", value
+        if isinstance(value, int):
+            return "i", value
+        if isinstance(value, float):
+            return "f", value
+        if value is None:
+            return "z", None
+        if isinstance(value, dict):
+            kind, keys, items = "d", tuple(string_id(str(k)) for k in value), value.values()
+        elif isinstance(value, (list, tuple)):
+            kind, keys, items = "l", (), value
+        else:
+            raise TypeError(f"Can't encode {type(value).__name__} in a dedup backup")
+        encoded = [encode(v) for v in items]
+        # the children are already ids, so this tuple identifies the whole sub-tree
+        key = (kind, "".join(t for t, _ in encoded), keys, tuple(v for _, v in encoded))
+        nid = node_ids.get(key)
+        if nid is None:
+            nid = node_ids[key] = len(nodes)
+            nodes.append([kind, key[1], list(keys), list(key[3])])
+        return "n", nid
+
+    _, root = encode(obj)
+    return {"_encoding": DEDUP_ENCODING, "strings": strings, "nodes": nodes, "root": root}
+
+
+def dedup_decode(encoded):
+    """Rebuilds a backup written by dedup_encode, identical sub-trees become one shared object."""
+    strings = encoded["strings"]
+    built = []
+    for kind, types, keys, values in encoded["nodes"]:
+        items = [strings[v] if t == "s" else built[v] if t == "n" else v for t, v in zip(types, values)]
+        built.append({strings[k]: v for k, v in zip(keys, items)} if kind == "d" else items)
+    return built[encoded["root"]]
+
+
+def iter_backup_objects(grafana_backup):
+    """Yields (kind, object) for every object in the backup, dict sections (preferences, policies) count as one object."""
+    for kind, section in grafana_backup.items():
+        if isinstance(section, dict):
+            yield kind, section
+        else:
+            for obj in section:
+                yield kind, obj
+
+
+def backup_object_meta(kind, obj):
+    """Returns the uid, title and folderUid used to find a backup object without loading the backup."""
+    if not isinstance(obj, dict) or kind in ("preferences", "policies"):
+        return {"uid": None, "title": kind, "folderUid": None}
+    if kind == "dashboards":
+        dashboard = obj.get("dashboard", {})
+        return {
+            "uid": dashboard.get("uid"),
+            "title": dashboard.get("title"),
+            "folderUid": obj.get("meta", {}).get("folderUid"),
+        }
+    if kind == "rulegroups":
+        return {
+            "uid": f"{obj.get('folderUid')}/{obj.get('title')}",
+            "title": obj.get("title"),
+            "folderUid": obj.get("folderUid"),
+        }
+    if kind == "alertrules":
+        return {"uid": obj.get("uid"), "title": obj.get("title"), "folderUid": obj.get("folderUID")}
+    return {
+        "uid": obj.get("uid"),
+        "title": obj.get("title") or obj.get("name"),
+        "folderUid": obj.get("parentUid", obj.get("folderUid")),
+    }
 
-    # get all teams
-    teams = s.get(f"{url}/api/teams/search").json()
-    
-    team_prefs = []
-    if 'teams' in teams and 'totalCount' in teams and teams['totalCount'] > 0:
-        # Found teams, lets get the preferences
-        for team in teams['teams']:
-            team['preferences'] = s.get(f"{url}/api/teams/{team['id']}/preferences").json()
-            team_prefs.append(team)
 
-    #TODO: we might want to migrate user preferences but we are not allowed to access that through the api at the moment
+def write_json_backup(grafana_backup, f):
+    """
+    Writes the backup as a json document one object at a time, sections can be lists or generators.
+    Returns index entries with the byte offset and length of every object so they can be read back on their own.
+    """
+    entries = []
+    f.write(b"{")
+    for i, (kind, section) in enumerate(grafana_backup.items()):
+        f.write(f'{"," if i else ""}\n    {json.dumps(kind)}: '.encode())
+        is_list = not isinstance(section, dict)
+        objects = section if is_list else [section]
+        if is_list:
+            f.write(b"[")
+        written = 0
+        for obj in objects:
+            if is_list:
+                f.write(b",\n" if written else b"\n")
+            data = serialize_object(obj, "json")
+            entries.append(backup_entry(kind, obj, data, offset=f.tell()))
+            f.write(data)
+            written += 1
+        if is_list:
+            f.write(b"\n    ]" if written else b"]")
+    f.write(b"\n}\n")
+    return entries
+
+
+def backup_index_path(location):
+    return Path(f"{location}.index.json")
+
+
+def write_backup_index(output_file, entries, data_format, url, size, sha256, encoding="plain"):
+    """Writes the sidecar index next to the backup, used by inspect to answer questions without loading the backup."""
+    index = {
+        "version": 1,
+        "format": data_format,
+        "encoding": encoding,
+        "size": size,
+        "sha256": sha256,
+        "url": url,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "objects": entries,
+    }
+    if is_s3_location(output_file):
+        bucket, key = split_s3_location(output_file)
+        s3_client().put(bucket, f"{key}.index.json", json.dumps(index).encode())
+        return
+    with backup_index_path(output_file).open(mode="w") as f:
+        json.dump(index, f)
 
-    return {"org": org, "teams": team_prefs}
 
+def backup_data_format(location, recorded=None, data_format=None):
+    """Returns the format of a dump: the one recorded in its index, the one given, else the one its file extension names."""
+    suffix = Path(location).suffix.lstrip(".")
+    return recorded or data_format or (suffix if suffix in ("json", "pickle") else "pickle")
 
-def write_to_filesystem(grafana_backup, location, data_format, url):
-    # if location is folder choose output name automaticly
-    if os.path.isdir(location):
-        timestamp = datetime.now().isoformat(timespec="minutes")
-        # Folder from location input + server base url + timestamp + output format
-        output_file = Path(
-            location,
-            f'{url.split("://")[1]}_{timestamp}.{data_format}'.replace(":", ""),
-        )
-    else:
-        output_file = Path(location)
 
-    print(f"\nWriting backup to: {output_file} \n")
+def load_backup_index(location, data_format=None):
+    """
+    Returns the sidecar index of a backup, its "format" is the format the backup is read with.
+    If the index is missing or doesn't match the backup anymore, the backup is loaded once and indexed in memory.
+    """
+    index = read_backup_index_file(location)
+    size = backup_size(location)
+    data_format = backup_data_format(location, (index or {}).get("format"), data_format)
+    if index:
+        if index.get("size") == size:
+            return index
+        logging.warning(f"Index {location}.index.json does not match the backup, loading the full backup")
+    else:
+        logging.info(f"No index found for {location}, loading the full backup")
+
+    grafana_backup = load_backup_file(location, data_format)
+    return {
+        "version": 1,
+        "format": data_format,
+        "size": size,
+        "objects": [
+            backup_entry(kind, obj, serialize_object(obj, data_format)) for kind, obj in iter_backup_objects(grafana_backup)
+        ],
+    }
 
-    # print(grafana_backup)
 
-    if data_format == "pickle":
-        with output_file.open(mode="wb") as f:
-            pickle.dump(grafana_backup, f)
-    elif data_format == "json":
-        with output_file.open(mode="w") as f:
-            json.dump(grafana_backup, f, indent=4)
+def read_backup_object(location, data_format, entry):
+    """Reads a single object from the backup, seeking directly to it when the index knows where it is."""
+    if entry.get("offset") is not None:
+        return json.loads(read_backup_range(location, entry["offset"], entry["length"]))
+    grafana_backup = load_backup_file(location, data_format)
+    for kind, obj in iter_backup_objects(grafana_backup):
+        if kind == entry["kind"] and backup_object_meta(kind, obj)["uid"] == entry["uid"]:
+            return obj
+    return None
 
 
 def add_folder_uid_to_dashlist_panel(dashlist_panel, folders):
@@ -393,8 +2118,8 @@ def add_folder_id_to_dashlist_panel(dashlist_panel, current_folders):
         return dashlist_panel
 
     folder_uid = options["folderUid"]
-    # safe lookup instead of indexing into possibly-empty list
-    folder_id = next((folder.get("id") for folder in current_folders if folder.get("uid") == folder_uid), None)
+    # current_folders is the inventory of the target, indexed on uid
+    folder_id = current_folders.get(folder_uid).id if folder_uid in current_folders else None
     if folder_id is None:
         logging.warning(f"folderUid '{folder_uid}' not found in current instance; keeping folderUid")
         return dashlist_panel
@@ -443,13 +2168,78 @@ def remove_nobackup_panels(obj):
         return obj
 
 
-def dash_export(args, s):
-    logging.info("Export started")
+# dashboard and panel fields grafana fills in with these values when they are missing
+DASHBOARD_DEFAULTS = {
+    "editable": True,
+    "graphTooltip": 0,
+    "links": [],
+    "tags": [],
+    "timezone": "",
+    "weekStart": "",
+    "fiscalYearStartMonth": 0,
+    "liveNow": False,
+    "gnetId": None,
+    "style": "dark",
+}
+PANEL_DEFAULTS = {
+    "transparent": False,
+    "links": [],
+    "transformations": [],
+    "options": {},
+    "title": "",
+}
+
+
+def minify_panel(panel):
+    """Returns the panel without fields that have their default value, nested row panels included."""
+    if not isinstance(panel, dict):
+        return panel
+    minified = {k: v for k, v in panel.items() if k not in PANEL_DEFAULTS or v != PANEL_DEFAULTS[k]}
+    field_config = minified.get("fieldConfig")
+    if isinstance(field_config, dict):
+        field_config = {k: v for k, v in field_config.items() if not (k in ("defaults", "overrides") and not v)}
+        if field_config:
+            minified["fieldConfig"] = field_config
+        else:
+            del minified["fieldConfig"]
+    if isinstance(minified.get("panels"), list):
+        minified["panels"] = [minify_panel(p) for p in minified["panels"]]
+    return minified
 
-    # get current state
-    datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(
-        s, args.url, args.tag
-    )
+
+def minify_dashboard(dashboard):
+    """
+    Returns the dashboard model without its id and the dashboard and panel fields that have the grafana default value.
+    The input is not changed, only the dicts on the path to a pruned field are copied.
+    """
+    minified = {
+        k: v
+        for k, v in dashboard.items()
+        if k != "id" and (k not in DASHBOARD_DEFAULTS or v != DASHBOARD_DEFAULTS[k])
+    }
+    if isinstance(minified.get("panels"), list):
+        minified["panels"] = [minify_panel(p) for p in minified["panels"]]
+    # dashboards older than schema version 16 keep their panels in rows
+    if isinstance(minified.get("rows"), list):
+        minified["rows"] = [
+            dict(row, panels=[minify_panel(p) for p in row["panels"]]) if isinstance(row, dict) and isinstance(row.get("panels"), list) else row
+            for row in minified["rows"]
+        ]
+    return minified
+
+
+def minify_dashboard_entry(obj):
+    """Minifies an exported dashboard, of the meta only the folderUid is used by the import. The entry gets "minified": true."""
+    if "dashboard" not in obj:
+        return minify_dashboard(obj)
+    # marks the entry so the import compares it with the target without the default values
+    minified = dict(obj, dashboard=minify_dashboard(obj["dashboard"]), minified=True)
+    if isinstance(obj.get("meta"), dict):
+        minified["meta"] = {"folderUid": obj["meta"].get("folderUid")}
+    return minified
+
+
+def print_found(datasources, folders, dashboards, alertrules, contactpoints, policies, preferences):
     print(
         f"""
         Found: {len(datasources)} datasources
@@ -463,22 +2253,60 @@ def dash_export(args, s):
         """
     )
 
+
+def print_imported(folders, libraryelements, datasources, dashboards, rulegroups, alertrules, preferences, contactpoints, policies):
+    """Prints the import summary, every kind is an (imported, skipped) pair, rulegroups only the imported count."""
+    print(
+        f"""
+        Folders:
+        Imported: {folders[0]} Skipped: {folders[1]}\n
+        Library panels:
+        Imported: {libraryelements[0]} Skipped: {libraryelements[1]}\n
+        Datasources:
+        Imported: {datasources[0]} Skipped: {datasources[1]}\n
+        Dashboards:
+        Imported: {dashboards[0]} Skipped: {dashboards[1]}\n
+        Rulegroups:
+        Imported: {rulegroups}\n
+        Alertrules:
+        Imported: {alertrules[0]} Skipped: {alertrules[1]}\n
+        Preferences:
+        Imported: {preferences[0]} Skipped: {preferences[1]}\n
+        Contactpoints:
+        Imported: {contactpoints[0]} Skipped: {contactpoints[1]}\n
+        Policies:
+        Imported: {policies[0]} Skipped: {policies[1]}
+        """
+    )
+
+
+def dash_export(args, s):
+    logging.info("Export started")
+
+    # get current state
+    datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(
+        s, args.url, args.tag
+    )
+    print_found(datasources, folders, dashboards, alertrules, contactpoints, policies, preferences)
+
     # pull in full backup data not just metadata
     datasources = fetch_datasources(s, args.url, datasources)
     folders = fetch_folders(s, args.url, folders)
-    dashboards = fetch_dashboards(s, args.url, dashboards)
     alertrules, rulegroups = fetch_alertrules(s, args.url, alertrules)
     contactpoints = fetch_contactpoints(s, args.url, contactpoints)
     policies = fetch_policies(s, args.url, policies)
+    libraryelements = fetch_libraryelements(s, args.url)
+    logging.info(f"Found {len(libraryelements)} library panels")
 
-    # add uid to dashlist panels for portability
-    dashboards = add_folder_uid_to_dashlist_panels(dashboards, folders)
-
-    # remove panels with NOBACKUP in the description from the dashboard backup
-    dashboards = remove_nobackup_panels(dashboards)
+    # dashboards are fetched, transformed (dashlist folder uids, NOBACKUP removal) and written as a stream
+    dashboards = stream_dashboards(
+        s, args.url, dashboards, folders, workers=args.workers,
+        library_uids={e["uid"] for e in libraryelements}, versions=args.with_versions, minify=args.minify,
+    )
 
     grafana_backup = {
         "folders": folders,
+        "libraryelements": libraryelements,
         "dashboards": dashboards,
         "datasources": datasources,
         "rulegroups": rulegroups,
@@ -488,28 +2316,31 @@ def dash_export(args, s):
         "policies": policies,
     }
 
-    write_to_filesystem(grafana_backup, args.location, args.data_format, args.url)
+    write_to_filesystem(grafana_backup, args.location, args.data_format, args.url, args.encoding)
 
     logging.info("Export Completed")
 
+@profiled
 def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules, dry_run=False):
+    # deletes of the same kind run concurrently, limited by the adaptive limiter of the session
+
     # delete dashboards
-    for dashboard in dashboards:
-        if dashboard["type"] == "dash-folder":
-            continue
+    def delete_dashboard(dashboard):
         dashboard_name = dashboard["title"]
         dashboard_uid = dashboard["uid"]
         if dry_run:
             logging.info(f"Dry-run: would delete dashboard: {dashboard_uid} with name: {dashboard_name}")
         else:
             resp = s.delete(f"{url}/api/dashboards/uid/{dashboard_uid}")
-            if resp.status_code == 200:
+            if resp.status_code < 300:
                 logging.info(f"Deleted dashboard: {dashboard_uid} with name: {dashboard_name}")
             else:
                 logging.warning(f"Failed to delete dashboard with status code: {resp.status_code}")
 
+    concurrent_map(s, delete_dashboard, [d for d in dashboards if d["type"] != "dash-folder"])
+
     #delete alerts
-    for alertrule in alertrules:
+    def delete_alertrule(alertrule):
         alertrule_name = alertrule["title"]
         alertrule_uid = alertrule["uid"]
 
@@ -517,18 +2348,20 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
             logging.info(f"Dry-run: would delete alert rule: {alertrule_uid} with name: {alertrule_name}")
         else:
             resp = s.delete(f"{url}/api/v1/provisioning/alert-rules/{alertrule_uid}")
-            if resp.status_code == 204:
+            if resp.status_code < 300:
                 logging.info(f"Deleted alert rule: {alertrule_uid} with name: {alertrule_name}")
             else:
                 logging.warning(f"Failed to delete alert rule {alertrule_name} with status code: {resp.status_code}")
 
+    concurrent_map(s, delete_alertrule, alertrules)
+
     # delete folders
-    _f_by_uid = {f.get('uid'): f for f in folders if isinstance(f, dict) and f.get('uid')}
+    _f_by_uid = {f.get('uid'): f for f in folders if f.get('uid')}
     
     def _f_depth(f):
         d = 0
         cur = f
-        while isinstance(cur, dict) and cur.get('parentUid'):
+        while cur is not None and cur.get('parentUid'):
             pu = cur.get('parentUid')
             d += 1
             if not pu or pu not in _f_by_uid:
@@ -538,7 +2371,7 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
                 break
         return d
     
-    for folder in sorted(folders, key=_f_depth, reverse=True):
+    def delete_folder(folder):
         folder_name = folder["title"]
         folder_uid = folder["uid"]
 
@@ -546,11 +2379,18 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
             logging.info(f"Dry-run: would delete folder: {folder_uid} with name: {folder_name}")
         else:
             resp = s.delete(f"{url}/api/folders/{folder_uid}")
-            if resp.status_code == 200:
+            if resp.status_code < 300:
                 logging.info(f"Deleted folder: {folder_uid} with name: {folder_name}")
             else:
                 logging.warning(f"Failed to delete folder {folder_name} with status code: {resp.status_code}")
 
+    # children before parents, the folders of one level are deleted concurrently
+    levels = {}
+    for folder in folders:
+        levels.setdefault(_f_depth(folder), []).append(folder)
+    for depth in sorted(levels, reverse=True):
+        concurrent_map(s, delete_folder, levels[depth])
+
     # # delete datasources
     # for datasource in datasources:
     #     datasource_name = datasource["name"]
@@ -558,7 +2398,7 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
 
     #     resp = s.delete(f"{url}/api/datasources/uid/{datasource_uid}")
 
-    #     if resp.status_code == 200:
+    #     if resp.status_code < 300:
     #         logging.info(f"Deleted datasource: {datasource_uid} with name: {datasource_name}")
     #     else:
     #         logging.warning(f"Failed to delete datasource {datasource_name} with status code: {resp.status_code}")
@@ -569,13 +2409,13 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
         logging.info("Dry-run: would delete notification policies")
     else:
         resp = s.delete(f"{url}/api/v1/provisioning/policies")
-        if resp.status_code == 202:
+        if resp.status_code < 300:
             logging.info(f"Deleted notification policies")
         else:
             logging.warning(f"Failed to delete notification policies with status code: {resp.status_code}")
 
     # delete contactpoints
-    for cp in contactpoints:
+    def delete_contactpoint(cp):
         cp_name = cp["name"]
         cp_uid = cp["uid"]
 
@@ -583,39 +2423,132 @@ def dash_purge(s, url, folders, dashboards, contactpoints, policies, alertrules,
             logging.info(f"Dry-run: would delete contact point: {cp_uid} with name: {cp_name}")
         else:
             resp = s.delete(f"{url}/api/v1/provisioning/contact-points/{cp_uid}")
-            if resp.status_code == 202:
+            if resp.status_code < 300:
                 logging.info(f"Deleted contact point: {cp_uid} with name: {cp_name}")
             else:
                 logging.warning(f"Failed to delete contact point {cp_name} with status code: {resp.status_code}")
 
-def load_backup_file(location, data_format):
+    concurrent_map(s, delete_contactpoint, contactpoints)
+
+def parse_backup(data, data_format):
     if data_format == "pickle":
-        with open(location, "rb") as f:
-            grafana_backup = pickle.load(f)
+        grafana_backup = pickle.loads(data)
     elif data_format == "json":
-        with open(location, "r") as f:
-            grafana_backup = json.load(f)
+        grafana_backup = json.loads(data)
+    if grafana_backup.get("_encoding") == DEDUP_ENCODING:
+        grafana_backup = dedup_decode(grafana_backup)
+    return grafana_backup
+
+
+@profiled
+def load_backup_file(location, data_format):
+    return parse_backup(read_backup_bytes(location), data_format)
+
+
+def corrupt_objects(grafana_backup, entries, data_format, encoding="plain"):
+    """
+    Compares every object with its index entry, objects of a kind are matched in order.
+    Returns (kind, position, entry) for objects whose checksum doesn't match and for objects missing from the backup.
+    """
+    checksum_format = checksum_data_format(data_format, encoding)
+    expected = {}
+    for entry in entries:
+        expected.setdefault(entry["kind"], []).append(entry)
+    positions = Counter()
+    corrupt = []
+    for kind, obj in iter_backup_objects(grafana_backup):
+        position = positions[kind]
+        positions[kind] += 1
+        kind_entries = expected.get(kind, [])
+        entry = kind_entries[position] if position < len(kind_entries) else None
+        if entry is None or hashlib.sha256(serialize_object(obj, checksum_format)).hexdigest() != entry.get("sha256"):
+            corrupt.append((kind, position, entry or dict(kind=kind, **backup_object_meta(kind, obj))))
+    for kind, kind_entries in expected.items():
+        corrupt.extend((kind, position, entry) for position, entry in enumerate(kind_entries) if position >= positions[kind])
+    return corrupt
+
+
+@profiled
+def load_verified_backup(location, data_format, strict=False):
+    """
+    Loads a backup for import and checks it against its index.
+    The file digest is computed on the bytes that are read for parsing anyway, only when it doesn't match
+    every object is checked and the damaged ones are left out of the import (or the import stops with strict).
+    """
+    index = read_backup_index_file(location)
+    data = read_backup_bytes(location)
+
+    if not index or "sha256" not in index:
+        logging.warning(f"No checksums found for {location}, the backup is not verified")
+        return parse_backup(data, data_format)
+    if len(data) == index["size"] and hashlib.sha256(data).hexdigest() == index["sha256"]:
+        logging.info(f"Backup checksum verified ({len(index['objects'])} objects)")
+        return parse_backup(data, data_format)
+
+    logging.error(f"Backup {location} does not match its checksum, checking every object")
+    try:
+        grafana_backup = parse_backup(data, data_format)
+    except Exception as e:
+        logging.error(f"Backup {location} is truncated or corrupt and can't be read: {e}")
+        sys.exit(1)
+    del data
+
+    corrupt = corrupt_objects(grafana_backup, index["objects"], data_format, index.get("encoding"))
+    for kind, _, entry in corrupt:
+        logging.error(f"Corrupt or missing {kind} object {entry.get('uid')} ({entry.get('title')})")
+    if corrupt and strict:
+        logging.error(f"{len(corrupt)} objects failed verification, nothing was imported (--strict)")
+        sys.exit(1)
+    # leave the damaged objects out, dict sections can't be partially restored so they are dropped
+    damaged = {(kind, position) for kind, position, _ in corrupt}
+    for kind, section in grafana_backup.items():
+        if isinstance(section, dict):
+            if (kind, 0) in damaged:
+                grafana_backup[kind] = {}
+        elif any(k == kind for k, _ in damaged):
+            grafana_backup[kind] = [obj for position, obj in enumerate(section) if (kind, position) not in damaged]
     return grafana_backup
 
 
-def import_datasources(s, url, datasources_import, datasources_current, dry_run=False):
+@profiled
+def import_datasources(s, url, datasources_import, datasources_current, override, dry_run=False, update=False, written=None):
+    """
+    Creates the datasources that are missing in the target, with update existing uids are overwritten as well.
+    The uids of datasources that were written are added to written.
+    """
     duplicated_datasources = 0
     imported_datasources = 0
     for datasource in datasources_import:
-        if datasource["uid"] in [f["uid"] for f in datasources_current]:
+        if datasource["uid"] in datasources_current:
             # found a uid match
-            duplicated_datasources += 1
+            if not update:
+                duplicated_datasources += 1
+                continue
+            if dry_run:
+                imported_datasources += 1
+                logging.info(f"Dry-run: would update datasource: {datasource['name']}")
+                continue
+            # the id belongs to the source instance
+            body = {k: v for k, v in datasource.items() if k != "id"}
+            resp = s.put(f"{url}/api/datasources/uid/{datasource['uid']}", data=json.dumps(body))
+            if resp.status_code < 300:
+                imported_datasources += 1
+                if written is not None:
+                    written.add(datasource["uid"])
+                logging.info(f"Updated datasource: {datasource['name']}")
+            else:
+                logging.error(f"Failed to update datasource {datasource['name']}: HTTP {resp.status_code} {resp.text}")
             continue
-        if datasource["name"] in [f["name"] for f in datasources_current]:
+        if datasources_current.titled(datasource["name"]):
             # found a name match
             # check type
-            if datasource["type"] != [f["type"] for f in datasources_current if f["name"] == datasource["name"]][0]:
+            if datasource["type"] != datasources_current.titled(datasource["name"])[0].type:
                 logging.warning(f"Datasource {datasource['name']} type mismatch found during import! Some dashboards may not work.")
                 continue
-            if args.override:
+            if override:
                 logging.info(f"Datasource {datasource['name']} found in destination with other uid, deleting it before importing. (Override selected)")
                 # get current uid
-                uid = [f["uid"] for f in datasources_current if f["name"] == datasource["name"]][0]
+                uid = datasources_current.titled(datasource["name"])[0].uid
                 if dry_run:
                     logging.info(f"Dry-run: would delete datasource uid {uid} (name: {datasource['name']})")
                 else:
@@ -627,20 +2560,31 @@ def import_datasources(s, url, datasources_import, datasources_current, dry_run=
             imported_datasources += 1
             logging.info(f"Dry-run: would import datasource: {datasource['name']}")
         else:
-            s.post(f"{url}/api/datasources", data=json.dumps(datasource))
-            imported_datasources += 1
-            logging.info(f"Imported datasource: {datasource['name']}")
+            resp = s.post(f"{url}/api/datasources", data=json.dumps(datasource))
+            if resp.status_code < 300:
+                imported_datasources += 1
+                if written is not None:
+                    written.add(datasource["uid"])
+                logging.info(f"Imported datasource: {datasource['name']}")
+            else:
+                logging.error(f"Failed to import datasource {datasource['name']}: HTTP {resp.status_code} {resp.text}")
     return imported_datasources, duplicated_datasources
 
 
-def import_folders(s, url, folders_import, folders_current, override, dry_run=False):
+@profiled
+def import_folders(s, url, folders_import, folders_current, override, dry_run=False, update=False, written=None):
+    """
+    Creates the folders that are missing in the target, parents first. With update existing folders get the
+    title and parent of the import. The uids of folders that were written are added to written.
+    """
     duplicated_folders = 0
     imported_folders = 0
 
     # check for folder uids that are in current and not in the import
     if override:
+        import_uids = {f["uid"] for f in folders_import}
         for folder in folders_current:
-            if folder["uid"] in [f["uid"] for f in folders_import]:
+            if folder["uid"] in import_uids:
                 # found a uid match, not deleteing it because of api bugs with recreating
                 continue
             print(f"Folder {folder['title']} found in current and not in backup, deleting it.")
@@ -672,9 +2616,14 @@ def import_folders(s, url, folders_import, folders_current, override, dry_run=Fa
         if backup_folder["id"] == 0:
             # skip general folder because we can't create it as it already exists by default
             continue
-        if backup_folder["uid"] in [f["uid"] for f in folders_current]:
+        if backup_folder["uid"] in folders_current:
             # found a uid match
-            duplicated_folders += 1
+            if not update:
+                duplicated_folders += 1
+            elif update_folder(s, url, backup_folder, dry_run):
+                imported_folders += 1
+                if written is not None and not dry_run:
+                    written.add(backup_folder["uid"])
             continue
         # disabled, beacause it could trigger unwanted bahaviour
         # this does help if you want to continue a migration you started by hand
@@ -704,73 +2653,231 @@ def import_folders(s, url, folders_import, folders_current, override, dry_run=Fa
             imported_folders += 1
             logging.info(f"Dry-run: would import folder: {backup_folder['title']}")
         else:
-            s.post(f"{url}/api/folders", data=json.dumps(backup_folder))       
-            imported_folders += 1
-            logging.info(f"Imported folder: {backup_folder['title']}")
+            resp = s.post(f"{url}/api/folders", data=json.dumps(backup_folder))
+            if resp.status_code < 300:
+                imported_folders += 1
+                if written is not None:
+                    written.add(backup_folder["uid"])
+                logging.info(f"Imported folder: {backup_folder['title']}")
+            else:
+                logging.error(f"Failed to import folder {backup_folder['title']}: HTTP {resp.status_code} {resp.text}")
     return imported_folders, duplicated_folders
 
 
-def import_dashboards(s, url, dashboards_import, dashboards_current, dry_run=False):
-    duplicated_dashboards = 0
-    imported_dashboards = 0
-    def _normalize_for_hash(obj):
-        """Return a copy of the dashboard dict with non-content fields removed for stable hashing."""
-        if isinstance(obj, dict):
-            # shallow copy to avoid mutating original
-            o = {}
-            for k, v in obj.items():
-                # drop fields that commonly change between imports but don't affect dashboard content
-                if k in ("id", "version"):
-                    continue
-                o[k] = _normalize_for_hash(v)
-            return o
-        elif isinstance(obj, list):
-            return [_normalize_for_hash(i) for i in obj]
+def update_folder(s, url, folder, dry_run=False):
+    """Gives an existing folder the title and parent of folder, returns True when the target was changed."""
+    uid = folder["uid"]
+    current = s.get(f"{url}/api/folders/{uid}").json()
+    if dry_run:
+        logging.info(f"Dry-run: would update folder: {folder['title']}")
+        return True
+    resp = s.put(
+        f"{url}/api/folders/{uid}",
+        data=json.dumps({"title": folder["title"], "description": folder.get("description"), "overwrite": True}),
+    )
+    if resp.status_code >= 300:
+        logging.error(f"Failed to update folder {folder['title']}: HTTP {resp.status_code} {resp.text}")
+        return False
+    if folder.get("parentUid") != current.get("parentUid"):
+        resp = s.post(f"{url}/api/folders/{uid}/move", data=json.dumps({"parentUid": folder.get("parentUid")}))
+        if resp.status_code >= 300:
+            logging.error(f"Failed to move folder {folder['title']}: HTTP {resp.status_code} {resp.text}")
+            return False
+    logging.info(f"Updated folder: {folder['title']}")
+    return True
+
+
+@profiled
+def import_libraryelements(s, url, libraryelements_import, dry_run=False):
+    """
+    Creates or updates the library elements from the backup, must run after folders and before dashboards.
+    Elements that already exist with the same model are skipped.
+    """
+    imported_libraryelements = 0
+    duplicated_libraryelements = 0
+    current = {e["uid"]: e for e in fetch_libraryelements(s, url)}
+
+    for element in libraryelements_import:
+        uid = element["uid"]
+        body = {
+            "uid": uid,
+            "name": element.get("name"),
+            "kind": element.get("kind", 1),
+            "model": element.get("model"),
+            "folderUid": element.get("folderUid") or None,
+        }
+        existing = current.get(uid)
+        if existing is not None:
+            if content_hash(existing.get("model")) == content_hash(element.get("model")) and existing.get("name") == element.get("name"):
+                duplicated_libraryelements += 1
+                continue
+            if dry_run:
+                imported_libraryelements += 1
+                logging.info(f"Dry-run: would update library panel: {element.get('name')} (uid: {uid})")
+                continue
+            # the current version is required by grafana to detect concurrent edits
+            body["version"] = existing.get("version")
+            resp = s.patch(f"{url}/api/library-elements/{uid}", data=json.dumps(body))
+            action = "Updated"
         else:
-            return obj
+            if dry_run:
+                imported_libraryelements += 1
+                logging.info(f"Dry-run: would import library panel: {element.get('name')} (uid: {uid})")
+                continue
+            resp = s.post(f"{url}/api/library-elements", data=json.dumps(body))
+            action = "Imported"
+        if resp.status_code < 300:
+            imported_libraryelements += 1
+            logging.info(f"{action} library panel: {element.get('name')} (uid: {uid})")
+        else:
+            logging.error(f"Failed to import library panel {element.get('name')} (uid: {uid}): HTTP {resp.status_code} {resp.text}")
 
-    def _hash_dashboard(dashboard_obj):
-        normalized = _normalize_for_hash(copy.deepcopy(dashboard_obj))
-        try:
-            js = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
-        except Exception:
-            # fallback to repr if something is not JSON serializable
-            js = repr(normalized)
-        return hashlib.sha256(js.encode("utf-8")).hexdigest()
+    return imported_libraryelements, duplicated_libraryelements
+
+
+def _normalize_for_hash(obj):
+    """
+    Returns the dashboard without non-content fields for stable hashing.
+    Builds the filtered structure in one pass and shares the leaf values, the input is never mutated so no copy is needed.
+    """
+    if isinstance(obj, dict):
+        # drop fields that commonly change between imports but don't affect dashboard content
+        return {k: _normalize_for_hash(v) for k, v in obj.items() if k != "id" and k != "version"}
+    elif isinstance(obj, list):
+        return [_normalize_for_hash(i) for i in obj]
+    else:
+        return obj
+
+
+def hash_dashboard(dashboard_obj, minified=False):
+    # for a minified backup the default values are left out on both sides, so it hashes like the full dashboard in grafana
+    if minified and isinstance(dashboard_obj, dict):
+        dashboard_obj = minify_dashboard(dashboard_obj)
+    normalized = _normalize_for_hash(dashboard_obj)
+    try:
+        js = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except Exception:
+        # fallback to repr if something is not JSON serializable
+        js = repr(normalized)
+    return hashlib.sha256(js.encode("utf-8")).hexdigest()
+
+
+def content_hash(obj):
+    """Returns a stable hash of any json serializable object."""
+    js = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=repr)
+    return hashlib.sha256(js.encode("utf-8")).hexdigest()
 
-    # build a set of current uids for quick lookup
-    current_uids = {d["uid"] for d in dashboards_current}
 
-    # build a set of current uids for quick lookup
-    current_uids = {d["uid"] for d in dashboards_current}
+def start_hash_pool(count):
+    """Returns a process pool for hashing when there are enough dashboards to make it worth it, else None."""
+    if count < HASH_PROCESS_THRESHOLD or (os.cpu_count() or 1) < 2:
+        return None
+    try:
+        return ProcessPoolExecutor()
+    except (OSError, NotImplementedError) as e:
+        logging.debug(f"Process pool not available ({e}), hashing dashboards in the main process")
+        return None
+
+
+def submit_hash(pool, dashboard_obj, minified=False):
+    """Returns a future with the dashboard hash, computed in the pool or right away when there is no pool."""
+    if pool is not None:
+        try:
+            return pool.submit(hash_dashboard, dashboard_obj, minified)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logging.debug(f"Hash pool unavailable ({e}), hashing in the main process")
+    future = Future()
+    future.set_result(hash_dashboard(dashboard_obj, minified))
+    return future
 
-    for backup_dashboard in dashboards_import:
+
+def hash_result(future, dashboard_obj, minified=False):
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        return hash_dashboard(dashboard_obj, minified)
+
+
+@profiled
+def import_dashboards(s, url, dashboards_import, dashboards_current, dry_run=False, written=None):
+    # dashboards that exist in the target are compared by hash, the hashing runs in worker processes
+    # while the current versions are downloaded, so the main process only waits on I/O
+    existing = {
+        d["dashboard"].get("uid"): d["dashboard"]
+        for d in dashboards_import
+        if d["dashboard"].get("uid") in dashboards_current
+    }
+    # dashboards of a minified dump are compared without default values, the others as they are
+    minified = {d["dashboard"].get("uid"): bool(d.get("minified")) for d in dashboards_import}
+    pool = start_hash_pool(len(existing))
+    backup_hashes = {uid: submit_hash(pool, dashboard, minified[uid]) for uid, dashboard in existing.items()}
+
+    # with --cache the hash of a current dashboard is reused while its id and version are the same,
+    # the version is in the search hit or a small versions request instead of the whole dashboard
+    cache = instance_cache(s, url)
+    current_hashes = {}
+    current_dashboards = {}
+    if cache is not None and existing:
+        versions = fetch_dashboard_versions(s, url, dashboards_current.only(existing))
+        for uid in existing:
+            entry = cache["dashboards"].get(uid)
+            if entry and entry == [dashboards_current.get(uid).id, versions.get(uid), entry[2], minified[uid]]:
+                current_hashes[uid] = Future()
+                current_hashes[uid].set_result(entry[2])
+                current_dashboards[uid] = (200, None)
+        if len(existing) > 1:
+            logging.info(f"Reusing cached hashes for {len(current_dashboards)} of {len(existing)} existing dashboards")
+
+    def remember(uid, dashboard_id, version, dashboard_hash):
+        if cache is not None and dashboard_id is not None and version is not None:
+            cache["dashboards"][uid] = [dashboard_id, version, dashboard_hash, minified[uid]]
+
+    def remember_import(uid, resp, dashboard):
+        # grafana answers with the new id and version, the target now holds exactly the imported dashboard
+        if cache is not None:
+            saved = resp.json()
+            remember(uid, saved.get("id"), saved.get("version"), hash_dashboard(dashboard, minified[uid]))
+
+    def fetch_current(uid):
+        try:
+            resp = s.get(f"{url}/api/dashboards/uid/{uid}")
+        except Exception as e:
+            return uid, e
+        if resp.status_code != 200:
+            return uid, (resp.status_code, None)
+        current = resp.json().get("dashboard")
+        # hand the body to the hash pool right away so hashing overlaps with the next downloads
+        current_hashes[uid] = submit_hash(pool, current, minified[uid])
+        return uid, (resp.status_code, current)
+
+    current_dashboards.update(concurrent_map(s, fetch_current, [uid for uid in existing if uid not in current_dashboards]))
+
+    def import_one(backup_dashboard):
+        """Imports or updates one dashboard, returns "imported", "duplicated" or None on failure."""
         uid = backup_dashboard["dashboard"].get("uid")
         needs_import = False
         title = backup_dashboard["dashboard"].get("title", "<unknown>")
 
-        # If dashboard exists in target, fetch full current dashboard and compare hashes
-        if uid in current_uids:
-            try:
-                resp = s.get(f"{url}/api/dashboards/uid/{uid}")
-                if resp.status_code != 200:
-                    # couldn't fetch current, assume different and import
-                    logging.info(f"Could not fetch current dashboard {uid} (status {resp.status_code}), proceeding to import/update.")
-                    needs_import = True
-                else:
-                    current = resp.json().get("dashboard")
-                    # compute hashes for normalized dashboard objects
-                    backup_hash = _hash_dashboard(backup_dashboard["dashboard"])
-                    current_hash = _hash_dashboard(current)
-                    if backup_hash == current_hash:
-                        duplicated_dashboards += 1
-                        logging.info(f"Skipping import for identical dashboard: {title} (uid: {uid})")
-                        continue
-                    else:
-                        needs_import = True
-            except Exception as e:
-                logging.warning(f"Error fetching current dashboard {uid}: {e}. Importing to be safe.")
+        # If dashboard exists in target, compare the hashes of the backup and the current dashboard
+        if uid in dashboards_current:
+            fetched = current_dashboards.get(uid)
+            if isinstance(fetched, Exception):
+                logging.warning(f"Error fetching current dashboard {uid}: {fetched}. Importing to be safe.")
                 needs_import = True
+            elif fetched[0] != 200:
+                # couldn't fetch current, assume different and import
+                logging.info(f"Could not fetch current dashboard {uid} (status {fetched[0]}), proceeding to import/update.")
+                needs_import = True
+            else:
+                backup_hash = hash_result(backup_hashes[uid], backup_dashboard["dashboard"], minified[uid])
+                current_hash = hash_result(current_hashes[uid], fetched[1], minified[uid])
+                if fetched[1] is not None:
+                    remember(uid, dashboards_current.get(uid).id, fetched[1].get("version"), current_hash)
+                if backup_hash == current_hash:
+                    logging.info(f"Skipping import for identical dashboard: {title} (uid: {uid})")
+                    return "duplicated"
+                else:
+                    needs_import = True
 
             if needs_import:
                 # update existing dashboard (overwrite)
@@ -782,16 +2889,15 @@ def import_dashboards(s, url, dashboards_import, dashboards_current, dry_run=Fal
                 # remove id to let Grafana handle internal ids
                 dashboard_request_body["dashboard"].pop("id", None)
                 if dry_run:
-                    imported_dashboards += 1
                     logging.info(f"Dry-run: would update dashboard: {title} (uid: {uid})")
-                else:
-                    resp = s.post(f"{url}/api/dashboards/db", data=json.dumps(dashboard_request_body))
-                    if resp.status_code < 300:
-                        imported_dashboards += 1
-                        logging.info(f"Updated dashboard: {title} (uid: {uid})")
-                    else:
-                        logging.error(f"Failed to update dashboard {title} (uid: {uid}): HTTP {resp.status_code} {resp.text}")
-                continue
+                    return "imported"
+                resp = s.post(f"{url}/api/dashboards/db", data=json.dumps(dashboard_request_body))
+                if resp.status_code < 300:
+                    logging.info(f"Updated dashboard: {title} (uid: {uid})")
+                    remember_import(uid, resp, backup_dashboard["dashboard"])
+                    return "imported"
+                logging.error(f"Failed to update dashboard {title} (uid: {uid}): HTTP {resp.status_code} {resp.text}")
+                return None
 
         # uid not present in current instance -> create new dashboard
         dashboard_request_body = {}
@@ -800,19 +2906,28 @@ def import_dashboards(s, url, dashboards_import, dashboards_current, dry_run=Fal
         # remove the old ID to trigger creation of a new one
         dashboard_request_body["dashboard"].pop("id", None)
         if dry_run:
-            imported_dashboards += 1
             logging.info(f"Dry-run: would import new dashboard: {title} (uid: {uid}) into folder {dashboard_request_body.get('folderUid')}")
-        else:
-            resp = s.post(f"{url}/api/dashboards/db", data=json.dumps(dashboard_request_body))
-            if resp.status_code < 300:
-                imported_dashboards += 1
-                logging.info(f"Imported dashboard: {title} (uid: {uid})")
-            else:
-                logging.error(f"Failed to import dashboard {title} (uid: {uid}): HTTP {resp.status_code} {resp.text}")
+            return "imported"
+        resp = s.post(f"{url}/api/dashboards/db", data=json.dumps(dashboard_request_body))
+        if resp.status_code < 300:
+            logging.info(f"Imported dashboard: {title} (uid: {uid})")
+            remember_import(uid, resp, backup_dashboard["dashboard"])
+            return "imported"
+        logging.error(f"Failed to import dashboard {title} (uid: {uid}): HTTP {resp.status_code} {resp.text}")
+        return None
+
+    results = concurrent_map(s, import_one, dashboards_import)
 
-    return imported_dashboards, duplicated_dashboards
+    if pool is not None:
+        pool.shutdown()
+    # identical dashboards count as written, the target already holds them
+    if written is not None:
+        written.update(d["dashboard"].get("uid") for d, result in zip(dashboards_import, results) if result)
 
+    return results.count("imported"), results.count("duplicated")
 
+
+@profiled
 def import_rulegroups(s, url, rulegroups_import, dry_run=False):
     imported_rulegroups = 0
 
@@ -833,7 +2948,114 @@ def import_rulegroups(s, url, rulegroups_import, dry_run=False):
             logging.error(f"Exception importing rulegroup: {rule['folderUid']} {rule['title']}: {str(e)}")
     return imported_rulegroups
 
-def import_alertrules(s, url, alertrules_import, alertrules_current, override=False, dry_run=False):
+# alert rule fields set by the server that don't say anything about the rule
+ALERTRULE_SERVER_FIELDS = ("id", "updated", "provenance")
+
+
+def rulegroup_hash(rulegroup):
+    """Returns a hash of the group settings and its rules in uid order, server assigned fields are ignored."""
+    rules = sorted(
+        ({k: v for k, v in r.items() if k not in ALERTRULE_SERVER_FIELDS} for r in rulegroup.get("rules") or []),
+        key=lambda r: r.get("uid") or "",
+    )
+    return content_hash(dict({k: v for k, v in rulegroup.items() if k != "rules"}, rules=rules))
+
+
+@profiled
+def import_rulegroups_bulk(s, url, rulegroups_import, alertrules_import, alertrules_current, override=False, dry_run=False):
+    """
+    Assembles complete rule groups (settings and rules) from the backup and writes each with one rule group PUT,
+    instead of a write per rule plus one per group. Like import_alertrules, rules that exist in the target are kept
+    as they are unless override is set, rules of the target group that are not in the backup stay in the group.
+    A group with a rule that would be written and references a missing contact point is skipped as a whole,
+    the PUT replaces the group so leaving the rule out would delete it. Groups identical in the target are skipped.
+    Folders are written concurrently, the groups of one folder one after the other.
+    Returns (imported groups, skipped groups, imported rules, skipped rules).
+    """
+    try:
+        cp_resp = s.get(f"{url}/api/v1/provisioning/contact-points")
+        available_contact_points = {cp["name"] for cp in cp_resp.json()} if cp_resp.status_code == 200 else set()
+    except Exception as e:
+        logging.error(f"Warning: Error fetching contact points: {e}. Proceeding without validation.")
+        available_contact_points = set()
+
+    settings = {(g.get("folderUid"), g.get("title")): g for g in rulegroups_import}
+    groups = {}
+    for rule in alertrules_import:
+        key = (rule["folderUID"], rule["ruleGroup"])
+        if key not in groups:
+            groups[key] = dict(settings.get(key, {"interval": 60}), folderUid=key[0], title=key[1], rules=[])
+        groups[key]["rules"].append({k: v for k, v in rule.items() if k not in ALERTRULE_SERVER_FIELDS})
+
+    by_folder = {}
+    for (folder_uid, _), group in sorted(groups.items()):
+        by_folder.setdefault(folder_uid, []).append(group)
+
+    def merge_group(group, current):
+        """Returns (group to write, written rules, kept rules) or None when a written rule can't be imported."""
+        current_rules = {r.get("uid"): r for r in (current or {}).get("rules") or []}
+        rules, written, kept = [], 0, 0
+        for rule in group["rules"]:
+            if not override and rule.get("uid") in current_rules:
+                rules.append({k: v for k, v in current_rules.pop(rule["uid"]).items() if k not in ALERTRULE_SERVER_FIELDS})
+                kept += 1
+                continue
+            if not override and rule.get("uid") in alertrules_current:
+                # the rule lives in another group of the target, a group PUT would move it there
+                kept += 1
+                continue
+            receiver = (rule.get("notification_settings") or {}).get("receiver")
+            if available_contact_points and receiver and receiver not in available_contact_points:
+                logging.warning(
+                    f"Rule '{rule['title']}' references missing contact point '{receiver}'. "
+                    f"Not importing rulegroup {group['folderUid']} {group['title']}."
+                )
+                return None
+            rules.append(rule)
+            written += 1
+        if not override:
+            rules.extend({k: v for k, v in r.items() if k not in ALERTRULE_SERVER_FIELDS} for r in current_rules.values())
+        return dict(group, rules=rules), written, kept
+
+    def import_folder_groups(folder_groups):
+        results = []
+        for group in folder_groups:
+            name = f"{group['folderUid']} {group['title']}"
+            group_url = f"{url}/api/v1/provisioning/folder/{group['folderUid']}/rule-groups/{group['title']}"
+            current = s.get(group_url)
+            current = current.json() if current.status_code == 200 else None
+            merged = merge_group(group, current)
+            if merged is None:
+                continue
+            group, written, kept = merged
+            if current is not None and rulegroup_hash(current) == rulegroup_hash(group):
+                logging.info(f"Skipping import for identical rulegroup: {name}")
+                results.append(("duplicated", 0, written + kept))
+                continue
+            if dry_run:
+                logging.info(f"Dry-run: would import rulegroup: {name} with {written} new and {kept} kept rules")
+                results.append(("imported", written, kept))
+                continue
+            resp = s.put(group_url, data=json.dumps(group))
+            if resp.status_code < 300:
+                logging.info(f"Imported rulegroup: {name} with {written} new and {kept} kept rules")
+                results.append(("imported", written, kept))
+            else:
+                logging.error(f"Failed to import rulegroup: {name}: HTTP {resp.status_code} {resp.text}")
+        return results
+
+    results = [r for folder in concurrent_map(s, import_folder_groups, list(by_folder.values())) for r in folder]
+    imported = [r for r in results if r[0] == "imported"]
+    return (
+        len(imported),
+        len(results) - len(imported),
+        sum(written for _, written, _ in results),
+        sum(kept for _, _, kept in results),
+    )
+
+
+@profiled
+def import_alertrules(s, url, alertrules_import, alertrules_current, override=False, dry_run=False, written=None):
     duplicated_alertrules = 0
     imported_alertrules = 0
     
@@ -854,7 +3076,7 @@ def import_alertrules(s, url, alertrules_import, alertrules_current, override=Fa
     
     # Process each alert rule
     for rule in alertrules_import:
-        uid_exists = rule["uid"] in [r.get("uid") for r in alertrules_current]
+        uid_exists = rule["uid"] in alertrules_current
         
         # Handle existing rule with same UID
         if uid_exists and not override:
@@ -895,6 +3117,8 @@ def import_alertrules(s, url, alertrules_import, alertrules_current, override=Fa
                         logging.info(f"Imported alertrule: {rule['title']}")
                         stats["success"] += 1
                         imported_alertrules += 1
+                        if written is not None:
+                            written.add(rule["uid"])
                     else:
                         print(f"Error importing rule: {resp.status_code}")
                         stats["error"] += 1
@@ -920,6 +3144,7 @@ def import_alertrules(s, url, alertrules_import, alertrules_current, override=Fa
     
     return imported_alertrules, duplicated_alertrules
 
+@profiled
 def import_preferences(s, url, preferences_import, preferences_current, dry_run=False):
     duplicated_preferences = 0
     imported_preferences = 0    
@@ -934,70 +3159,143 @@ def import_preferences(s, url, preferences_import, preferences_current, dry_run=
         )
         logging.info(f"Imported organisation preferences")
 
-    # get all current teams and match the teams against the backup
-    teams = s.get(f"{url}/api/teams/search").json()
-
-    if teams['totalCount'] > 0:
-        # find team matches
-        for team in teams['teams']:
-            team_preferences = [x['preferences'] for x in preferences_import['teams'] if x['uid'] == team['uid']]
-            if len(team_preferences) > 0:
-                # found a team uid match
-                if dry_run:
-                    imported_preferences += 1
-                    logging.info(f"Dry-run: would import team preferences for: {team['name']}")
-                else:
-                    s.post(
-                        f"{url}/api/teams/{team['id']}/preferences",
-                        data=json.dumps(team_preferences[0]),
-                    )
-                    imported_preferences += 1
-                    logging.info(f"Imported team preferences for: {team['name']}")  
-                continue
+    # match the current teams against the backup, first on uid then on name
+    by_uid = {x['uid']: x['preferences'] for x in preferences_import['teams'] if x.get('uid')}
+    by_name = {x['name']: x['preferences'] for x in preferences_import['teams']}
 
-            # try to find a name match 
-            team_preferences = [x['preferences'] for x in preferences_import['teams'] if x['name'] == team['name']]
-            if len(team_preferences) > 0:
-                # found a team name match
-                if dry_run:
-                    imported_preferences += 1
-                    logging.info(f"Dry-run: would import team preferences for: {team['name']}")
-                else:
-                    s.put(
-                        f"{url}/api/teams/{team['id']}/preferences",
-                        data=json.dumps(team_preferences[0]),
-                    )
-                    imported_preferences += 1
-                    logging.info(f"Imported team preferences for: {team['name']}")
+    def import_team_preferences(team):
+        team_preferences = by_uid.get(team.get('uid'))
+        if team_preferences is None:
+            team_preferences = by_name.get(team['name'])
+        if team_preferences is None:
+            return False
+        if dry_run:
+            logging.info(f"Dry-run: would import team preferences for: {team['name']}")
+            return True
+        resp = s.put(
+            f"{url}/api/teams/{team['id']}/preferences",
+            data=json.dumps(team_preferences),
+        )
+        if resp.status_code < 300:
+            logging.info(f"Imported team preferences for: {team['name']}")
+            return True
+        logging.error(f"Failed to import team preferences for: {team['name']} HTTP {resp.status_code}")
+        return False
+
+    imported_preferences = sum(concurrent_map(s, import_team_preferences, list_teams(s, url)))
 
     return imported_preferences, duplicated_preferences
 
-def import_contactpoints(s, url, contactpoints_import, contactpoints_current, dry_run=False):
-    duplicate_contactpoints = 0
-    imported_contactpoints = 0
-    for backup_contactpoints in contactpoints_import:
-        if backup_contactpoints["name"] in [
-            f["name"] for f in contactpoints_current]:
-                # found a name match
-                duplicate_contactpoints += 1
-                continue
+# contact point fields set by the server that don't say anything about the content
+CONTACTPOINT_SERVER_FIELDS = ("uid", "provenance")
+
+
+def contactpoint_hash(contactpoint):
+    """Returns a hash of the contact point content, server assigned fields are ignored."""
+    normalized = {k: v for k, v in contactpoint.items() if k not in CONTACTPOINT_SERVER_FIELDS}
+    if isinstance(normalized.get("receivers"), list):
+        normalized["receivers"] = [
+            {k: v for k, v in r.items() if k not in CONTACTPOINT_SERVER_FIELDS} if isinstance(r, dict) else r
+            for r in normalized["receivers"]
+        ]
+    return content_hash(normalized)
+
+
+@profiled
+def import_contactpoints(s, url, contactpoints_import, contactpoints_current, dry_run=False, written=None):
+    """
+    Creates missing contact points and updates the ones whose content differs from the backup.
+    Contact points are matched on uid, then on name and type, and compared by content hash
+    so unchanged contact points don't cause writes (and alertmanager reloads) on the target.
+    """
+    current_by_name = {(cp.title, cp.type): cp for cp in contactpoints_current}
+    failed = []
 
-        contactpoints_request_body = backup_contactpoints
+    def import_contactpoint(backup_contactpoint):
+        name = backup_contactpoint["name"]
+        current = contactpoints_current.get(backup_contactpoint.get("uid")) or current_by_name.get(
+            (name, backup_contactpoint.get("type"))
+        )
+        if current is not None and current.hash == contactpoint_hash(backup_contactpoint):
+            return "duplicated"
 
+        contactpoints_request_body = copy.deepcopy(backup_contactpoint)
         for receiver in contactpoints_request_body.get("receivers", []):
             receiver.pop("uid", None)
 
+        action = "update" if current is not None else "import"
         if dry_run:
-            imported_contactpoints += 1
-            logging.info(f"Dry-run: would import contact-point: {backup_contactpoints['name']}")
+            logging.info(f"Dry-run: would {action} contact-point: {name}")
+            return "imported"
+        if current is not None:
+            contactpoints_request_body["uid"] = current["uid"]
+            resp = s.put(
+                f"{url}/api/v1/provisioning/contact-points/{current['uid']}",
+                data=json.dumps(contactpoints_request_body),
+            )
         else:
-            response = s.post(f"{url}/api/v1/provisioning/contact-points", data=json.dumps(contactpoints_request_body))
-            imported_contactpoints += 1
-            logging.info(f"Imported contact-point: {backup_contactpoints['name']}")
+            resp = s.post(f"{url}/api/v1/provisioning/contact-points", data=json.dumps(contactpoints_request_body))
+        if resp.status_code < 300:
+            logging.info(f"{'Updated' if current is not None else 'Imported'} contact-point: {name}")
+            return "imported"
+        failed.append((name, resp.status_code, resp.text))
+        return None
+
+    results = concurrent_map(s, import_contactpoint, contactpoints_import)
+    if written is not None:
+        written.update(cp["name"] for cp, result in zip(contactpoints_import, results) if result)
+
+    if failed:
+        print("\nFailed contact points details:")
+        for name, status, text in failed:
+            print(f"  - Contact point: {name}")
+            print(f"    Error: HTTP {status} {text}")
+
+    return results.count("imported"), results.count("duplicated")
+
+def canonical_policy(policy):
+    """Returns the policy tree without server managed fields and empty values, so equal trees compare equal."""
+    if isinstance(policy, dict):
+        return {
+            k: canonical_policy(v)
+            for k, v in policy.items()
+            if k != "provenance" and v not in (None, [], {})
+        }
+    elif isinstance(policy, list):
+        return [canonical_policy(i) for i in policy]
+    else:
+        return policy
+
+
+def policy_routes(policy, path="root"):
+    """Flattens a policy tree to {path: route settings without the child routes}."""
+    routes = {path: {k: v for k, v in policy.items() if k != "routes"}}
+    for i, route in enumerate(policy.get("routes") or []):
+        routes.update(policy_routes(route, f"{path}.routes[{i}]"))
+    return routes
+
+
+def diff_policies(current, new):
+    """Returns a line per added, removed or changed route between two policy trees."""
+    current_routes = policy_routes(canonical_policy(current))
+    new_routes = policy_routes(canonical_policy(new))
+    lines = []
+    for path, route in new_routes.items():
+        if path not in current_routes:
+            lines.append(f"{path} added (receiver: {route.get('receiver', '-')})")
+        elif current_routes[path] != route:
+            changed = sorted(
+                k for k in set(route) | set(current_routes[path]) if route.get(k) != current_routes[path].get(k)
+            )
+            lines.append(f"{path} changed: {', '.join(changed)}")
+    for path, route in current_routes.items():
+        if path not in new_routes:
+            lines.append(f"{path} removed (receiver: {route.get('receiver', '-')})")
+    return lines
 
-    return imported_contactpoints, duplicate_contactpoints
 
-def import_policies(s, url, policies_import, policies_current, dry_run=False):
+@profiled
+def import_policies(s, url, policies_import, policies_current, dry_run=False, written=None):
     duplicated_policies = 0
     imported_policies = 0
 
@@ -1053,9 +3351,25 @@ def import_policies(s, url, policies_import, policies_current, dry_run=False):
         else policies_import
     )
 
+    current_hash = content_hash(canonical_policy(policies_current)) if isinstance(policies_current, dict) else None
+
     for backup_policy in policies_to_import:
         cleaned_policy = clean_policy(copy.deepcopy(backup_policy))
 
+        # a PUT always reloads the alertmanager config, skip it when the tree is the same
+        if content_hash(canonical_policy(cleaned_policy)) == current_hash:
+            duplicated_policies += 1
+            if written is not None:
+                written.add("root")
+            logging.info(
+                f"Skipping import for identical policy tree "
+                f"({count_receivers(cleaned_policy)} routes)"
+            )
+            continue
+        if isinstance(policies_current, dict):
+            for line in diff_policies(policies_current, cleaned_policy):
+                logging.info(f"Policy change: {line}")
+
         if dry_run:
             imported_policies += 1
             logging.info(
@@ -1069,6 +3383,8 @@ def import_policies(s, url, policies_import, policies_current, dry_run=False):
             )
             if resp.status_code < 300:
                 imported_policies += 1
+                if written is not None:
+                    written.add("root")
                 logging.info(
                     f"Imported policy "
                     f"{cleaned_policy.get('receiver', '[root]')}"
@@ -1083,16 +3399,192 @@ def import_policies(s, url, policies_import, policies_current, dry_run=False):
     return imported_policies, duplicated_policies
 
 
+# datasource references that are built into grafana and never exist as a datasource
+BUILTIN_DATASOURCES = {"-- Grafana --", "-- Mixed --", "-- Dashboard --", "grafana", "__expr__", "-100"}
+
+
+def collect_datasource_refs(obj, refs):
+    """Adds the datasource uids (or names in old dashboards) referenced anywhere in a dashboard to refs."""
+    if isinstance(obj, list):
+        for i in obj:
+            collect_datasource_refs(i, refs)
+    elif isinstance(obj, dict):
+        ref = obj.get("datasource")
+        if isinstance(ref, dict):
+            ref = ref.get("uid")
+        # template variables like $datasource or ${DS_PROMETHEUS} are resolved by grafana at runtime
+        if isinstance(ref, str) and ref and "$" not in ref and ref not in BUILTIN_DATASOURCES:
+            refs.add(ref)
+        for v in obj.values():
+            if isinstance(v, (dict, list)):
+                collect_datasource_refs(v, refs)
+
+
+def collect_dashlist_folder_refs(obj, refs):
+    if isinstance(obj, list):
+        for i in obj:
+            collect_dashlist_folder_refs(i, refs)
+    elif isinstance(obj, dict):
+        if obj.get("type") == "dashlist" and obj.get("options", {}).get("folderUid"):
+            refs.add(obj["options"]["folderUid"])
+        for v in obj.values():
+            if isinstance(v, (dict, list)):
+                collect_dashlist_folder_refs(v, refs)
+
+
+def collect_policy_refs(policy, edges, path="root"):
+    if not isinstance(policy, dict):
+        return
+    if policy.get("receiver"):
+        edges.append(("policy", path, path, "contactpoints", policy["receiver"]))
+    for name in (policy.get("mute_time_intervals") or []) + (policy.get("active_time_intervals") or []):
+        edges.append(("policy", path, path, "mutetimings", name))
+    for i, route in enumerate(policy.get("routes") or []):
+        collect_policy_refs(route, edges, f"{path}.routes[{i}]")
+
+
+def build_reference_graph(grafana_backup):
+    """
+    Returns every reference between objects in the backup and the objects they need in the target as
+    (kind, uid, title, needed kind, needed uid) edges, built in one pass over the backup.
+    """
+    edges = []
+    for backup_dashboard in grafana_backup.get("dashboards", []):
+        dashboard = backup_dashboard["dashboard"]
+        uid, title = dashboard.get("uid"), dashboard.get("title")
+        folder_uid = backup_dashboard.get("meta", {}).get("folderUid")
+        if folder_uid:
+            edges.append(("dashboard", uid, title, "folders", folder_uid))
+        datasources = set()
+        collect_datasource_refs(dashboard, datasources)
+        edges.extend(("dashboard", uid, title, "datasources", ds) for ds in sorted(datasources))
+        dashlist_folders = set()
+        collect_dashlist_folder_refs(dashboard, dashlist_folders)
+        edges.extend(("dashboard", uid, title, "folders", f) for f in sorted(dashlist_folders))
+        library_uids = set()
+        for panel in iter_panels(dashboard.get("panels", [])):
+            if isinstance(panel.get("libraryPanel"), dict) and panel["libraryPanel"].get("uid"):
+                library_uids.add(panel["libraryPanel"]["uid"])
+        edges.extend(("dashboard", uid, title, "libraryelements", lib) for lib in sorted(library_uids))
+
+    for element in grafana_backup.get("libraryelements", []):
+        if element.get("folderUid"):
+            edges.append(("library panel", element.get("uid"), element.get("name"), "folders", element["folderUid"]))
+
+    for rule in grafana_backup.get("alertrules", []):
+        uid, title = rule.get("uid"), rule.get("title")
+        if rule.get("folderUID"):
+            edges.append(("alert rule", uid, title, "folders", rule["folderUID"]))
+        for query in rule.get("data") or []:
+            ds = query.get("datasourceUid")
+            if ds and ds not in BUILTIN_DATASOURCES:
+                edges.append(("alert rule", uid, title, "datasources", ds))
+        receiver = (rule.get("notification_settings") or {}).get("receiver")
+        if receiver:
+            edges.append(("alert rule", uid, title, "contactpoints", receiver))
+
+    for group in grafana_backup.get("rulegroups", []):
+        if group.get("folderUid"):
+            edges.append(("rule group", group.get("title"), group.get("title"), "folders", group["folderUid"]))
+
+    policies = grafana_backup.get("policies")
+    for policy in [policies] if isinstance(policies, dict) else policies or []:
+        collect_policy_refs(policy, edges)
+
+    return edges
+
+
+def iter_panels(panels):
+    """Yields all panels including the ones nested in collapsed rows."""
+    for panel in panels or []:
+        if isinstance(panel, dict):
+            yield panel
+            yield from iter_panels(panel.get("panels"))
+
+
+@profiled
+def preflight(s, url, grafana_backup, grafana_current, override=False):
+    """
+    Resolves the reference graph of the backup against what the target will contain after the import
+    (the current objects plus the ones in the backup) and reports every missing reference at once.
+    With override the folders and contact points of the target are purged first and don't count.
+    Returns the list of problems, nothing is written to the target.
+    """
+    if override:
+        grafana_current = dict(grafana_current, folders=Inventory(), contactpoints=Inventory())
+    current_datasources = grafana_current["datasources"]
+    available = {
+        "folders": set(grafana_current["folders"].by_uid) | {f.get("uid") for f in grafana_backup.get("folders", [])} | {"general"},
+        "datasources": set(current_datasources.by_uid) | set(current_datasources.by_title) | {
+            key for ds in grafana_backup.get("datasources", []) for key in (ds.get("uid"), ds.get("name"))
+        },
+        "contactpoints": set(grafana_current["contactpoints"].by_title) | {cp.get("name") for cp in grafana_backup.get("contactpoints", [])},
+        "libraryelements": {e.get("uid") for e in grafana_backup.get("libraryelements", [])},
+        "mutetimings": set(),
+    }
+    # library panels and mute timings are not part of the current state, look them up once
+    available["libraryelements"] |= {e.get("uid") for e in fetch_libraryelements(s, url)}
+    resp = s.get(f"{url}/api/v1/provisioning/mute-timings")
+    if resp.status_code == 200:
+        available["mutetimings"] = {m.get("name") for m in resp.json() if isinstance(m, dict)}
+
+    problems = []
+    for kind, uid, title, needed_kind, needed in build_reference_graph(grafana_backup):
+        if needed not in available[needed_kind]:
+            problems.append((kind, uid, title, needed_kind, needed))
+
+    if problems:
+        print(f"\nPreflight found {len(problems)} missing references:")
+        for kind, uid, title, needed_kind, needed in problems:
+            note = " (will be removed from the policy)" if needed_kind == "mutetimings" else ""
+            print(f"    {kind} '{title}' ({uid}) -> missing {needed_kind} '{needed}'{note}")
+        print()
+    else:
+        print("\nPreflight: all references resolved\n")
+    return problems
+
+
 def dash_import(args, s):
     logging.info("Import Started")
 
+    if args.plan_out:
+        if args.dry_run:
+            logging.error("--plan-out already writes nothing, it can't be combined with --dry-run")
+            sys.exit(1)
+        # the importers run as usual, their writes are recorded into the plan instead of sent
+        s = PlanRecorder(s, args.url)
+        logging.info(f"Planning the import against {args.url}, nothing is written to grafana")
+
     # get current state
     datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(s, args.url)
+    grafana_backup = load_verified_backup(args.location, args.data_format, strict=args.strict)
+
+    # swap in the requested older dashboard versions
+    for spec in args.dashboard_versions or []:
+        uid, _, version = spec.rpartition(":")
+        if not uid or not version.isdigit() or not restore_dashboard_version(grafana_backup, uid, int(version)):
+            logging.error(f"Can't use dashboard version '{spec}', expected UID:VERSION of a version in the backup")
+            sys.exit(1)
+
+    # check every reference before the first write (including the override purge)
+    problems = preflight(
+        s, args.url, grafana_backup, {"datasources": datasources, "folders": folders, "contactpoints": contactpoints},
+        override=args.override,
+    )
+    if args.preflight:
+        sys.exit(1 if problems else 0)
+    if problems and args.strict:
+        logging.error("Preflight found problems, nothing was imported (--strict)")
+        sys.exit(1)
 
     # if override is active
     if args.override:
         dash_purge(s, args.url, folders, dashboards, contactpoints, policies, alertrules, dry_run=args.dry_run)
-        datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(s, args.url)
+        if args.plan_out:
+            # nothing was deleted yet, plan against the state the purge will leave behind
+            folders, dashboards, alertrules, contactpoints, policies = Inventory(), Inventory(), Inventory(), Inventory(), {}
+        else:
+            datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(s, args.url)
 
     grafana_current = {
         "datasources": datasources,
@@ -1103,20 +3595,26 @@ def dash_import(args, s):
         "contactpoints": contactpoints,
         "policies": policies,
     }
-    grafana_backup = load_backup_file(args.location, args.data_format)
 
-    # use current folder state to adjust dashlist panels to the new folder ids
-    grafana_backup["dashboards"] = add_folder_id_to_dashlist_panels(
-        grafana_backup["dashboards"], grafana_current["folders"]
-    )
     # Import datasources
     imported_datasources, duplicated_datasources = import_datasources(
-        s, args.url, grafana_backup["datasources"], grafana_current["datasources"], dry_run=args.dry_run
+        s, args.url, grafana_backup["datasources"], grafana_current["datasources"], override=args.override, dry_run=args.dry_run
     )
     #Import folders
     imported_folders, duplicate_folders = import_folders(
         s, args.url, grafana_backup["folders"], grafana_current["folders"], override=args.override, dry_run=args.dry_run
     )
+    # Import library panels, dashboards only keep a reference to them
+    imported_libraryelements, duplicated_libraryelements = import_libraryelements(
+        s, args.url, grafana_backup.get("libraryelements", []), dry_run=args.dry_run
+    )
+    # dashlist panels need the folder ids of the target, including the folders created above
+    if imported_folders and not args.dry_run and not args.plan_out:
+        grafana_current["folders"] = Inventory.from_json(list_folders(s, args.url))
+    with profile_stage("add_folder_id_to_dashlist_panels"):
+        grafana_backup["dashboards"] = add_folder_id_to_dashlist_panels(
+            grafana_backup["dashboards"], grafana_current["folders"]
+        )
     # Import dashboards
     imported_dashboards, duplicated_dashboards = import_dashboards(
         s, args.url, grafana_backup["dashboards"], grafana_current["dashboards"], dry_run=args.dry_run
@@ -1125,14 +3623,21 @@ def dash_import(args, s):
     imported_contactpoints, duplicate_contactpoints = import_contactpoints(
         s, args.url, grafana_backup["contactpoints"], grafana_current["contactpoints"], dry_run=args.dry_run
     )
-    # Import alertrules
-    imported_alertrules, duplicated_alertrules = import_alertrules(
-        s, args.url, grafana_backup["alertrules"], grafana_current["alertrules"], dry_run=args.dry_run
-    )
-    # Import rulegroups
-    imported_rulegroups = import_rulegroups(
-        s, args.url, grafana_backup["rulegroups"], dry_run=args.dry_run
-    )
+    if args.bulk_rulegroups:
+        # Import alertrules and rulegroups with one write per group
+        imported_rulegroups, _, imported_alertrules, duplicated_alertrules = import_rulegroups_bulk(
+            s, args.url, grafana_backup["rulegroups"], grafana_backup["alertrules"], grafana_current["alertrules"],
+            override=args.override, dry_run=args.dry_run,
+        )
+    else:
+        # Import alertrules
+        imported_alertrules, duplicated_alertrules = import_alertrules(
+            s, args.url, grafana_backup["alertrules"], grafana_current["alertrules"], dry_run=args.dry_run
+        )
+        # Import rulegroups
+        imported_rulegroups = import_rulegroups(
+            s, args.url, grafana_backup["rulegroups"], dry_run=args.dry_run
+        )
     # Import preferences
     imported_preferences, duplicated_preferences = import_preferences(
         s, args.url, grafana_backup["preferences"], grafana_current["preferences"], dry_run=args.dry_run
@@ -1142,39 +3647,1136 @@ def dash_import(args, s):
         s, args.url, grafana_backup["policies"], grafana_current["policies"], dry_run=args.dry_run
     )
 
-    print(
-        f"""
-        Folders:
-        Imported: {imported_folders} Skipped: {duplicate_folders}\n
-        Datasources:
-        Imported: {imported_datasources} Skipped: {duplicated_datasources}\n
-        Dashboards:
-        Imported: {imported_dashboards} Skipped: {duplicated_dashboards}\n
-        Rulegroups:
-        Imported: {imported_rulegroups}\n
-        Alertrules:
-        Imported: {imported_alertrules} Skipped: {duplicated_alertrules}\n
-        Preferences:
-        Imported: {imported_preferences} Skipped: {duplicated_preferences}\n
-        Contactpoints:
-        Imported: {imported_contactpoints} Skipped: {duplicate_contactpoints}\n
-        Policies:
-        Imported: {imported_policies} Skipped: {duplicated_policies}
-        """
+    print_imported(
+        (imported_folders, duplicate_folders),
+        (imported_libraryelements, duplicated_libraryelements),
+        (imported_datasources, duplicated_datasources),
+        (imported_dashboards, duplicated_dashboards),
+        imported_rulegroups,
+        (imported_alertrules, duplicated_alertrules),
+        (imported_preferences, duplicated_preferences),
+        (imported_contactpoints, duplicate_contactpoints),
+        (imported_policies, duplicated_policies),
     )
-    
+
+    if args.plan_out:
+        write_plan(s, args.plan_out, args.location)
+        logging.info(f"Wrote a plan with {len(s.operations)} operations to {args.plan_out}, run it with apply")
+        return
+
     logging.info("Import completed")
 
+
+# kinds of plan operations by api path prefix, the first match wins
+PLAN_KINDS = (
+    ("/api/folders", "folders"),
+    ("/api/library-elements", "libraryelements"),
+    ("/api/dashboards", "dashboards"),
+    ("/api/datasources", "datasources"),
+    ("/api/v1/provisioning/contact-points", "contactpoints"),
+    ("/api/v1/provisioning/alert-rules", "alertrules"),
+    ("/api/v1/provisioning/folder/", "rulegroups"),
+    ("/api/v1/provisioning/policies", "policies"),
+    ("/api/org/preferences", "preferences"),
+    ("/api/teams/", "preferences"),
+)
+
+# kinds whose operations depend on the order they were planned in (parent folders first)
+ORDERED_PLAN_KINDS = {"folders"}
+
+
+def plan_kind(path):
+    return next((kind for prefix, kind in PLAN_KINDS if path.startswith(prefix)), "other")
+
+
+def precondition_path(method, path):
+    """
+    Returns the path that is read to check the precondition of an operation, None when grafana checks it itself:
+    creates fail on an existing uid, dashboard and library panel updates carry the version they expect.
+    """
+    if path.startswith("/api/v1/provisioning/contact-points"):
+        # contact points have no single object endpoint and a create doesn't fail on an existing name
+        return "/api/v1/provisioning/contact-points"
+    if method in ("PUT", "DELETE"):
+        return path
+    return None
+
+
+def describe_operation(operation):
+    body = operation["body"]
+    obj = body.get("dashboard", body) if isinstance(body, dict) else {}
+    name = obj.get("title") or obj.get("name") or obj.get("uid") if isinstance(obj, dict) else None
+    return f"{operation['method']} {operation['path']}" + (f" ({name})" if name else "")
+
+
+def read_precondition(s, url, path):
+    """Returns the status and content hash of a path, the cheap check of a plan precondition."""
+    resp = s.get(f"{url}{path}")
+    try:
+        digest = content_hash(resp.json())
+    except ValueError:
+        digest = hashlib.sha256(resp.content).hexdigest()
+    return {"path": path, "status": resp.status_code, "sha256": digest if resp.status_code == 200 else None}
+
+
+class PlanRecorder:
+    """
+    Stands in for the session while an import is planned: reads go to grafana, writes are recorded.
+    Updates and deletes record the status and content hash of the object they change as precondition,
+    dashboard updates get the current version and overwrite=false so grafana rejects them if the dashboard changed.
+    """
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self.max_workers = session.max_workers
+        self.operations = []
+        self.preconditions = {}
+        self.lock = threading.Lock()
+
+    def get(self, *args, **kwargs):
+        return self.session.get(*args, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.record("POST", url, data)
+
+    def put(self, url, data=None, **kwargs):
+        return self.record("PUT", url, data)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.record("PATCH", url, data)
+
+    def delete(self, url, data=None, **kwargs):
+        return self.record("DELETE", url, data)
+
+    def record(self, method, url, data):
+        path = url[len(self.url):]
+        body = json.loads(data) if data is not None else None
+        if path == "/api/dashboards/db" and body.get("overwrite"):
+            uid = body["dashboard"].get("uid")
+            resp = self.session.get(f"{self.url}/api/dashboards/uid/{uid}")
+            if resp.status_code == 200:
+                body["dashboard"]["version"] = resp.json()["dashboard"].get("version")
+            body["overwrite"] = False
+
+        check = precondition_path(method, path)
+        if check is not None and check not in self.preconditions:
+            self.preconditions[check] = read_precondition(self.session, self.url, check)
+        operation = {
+            "kind": plan_kind(path),
+            "method": method,
+            "path": path,
+            "body": body,
+            "sha256": content_hash(body),
+            "precondition": check,
+        }
+        if path == "/api/dashboards/db":
+            # folders the plan creates have no id yet, apply fills in the dashlist folder ids from the target
+            folders = set()
+            collect_dashlist_folder_refs(body["dashboard"], folders)
+            if folders:
+                operation["folders"] = sorted(folders)
+        with self.lock:
+            self.operations.append(operation)
+
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = b"{}"
+        return resp
+
+
+def plan_groups(operations):
+    """Splits the operations in runs of the same kind and method, a run can be applied concurrently."""
+    groups = []
+    for operation in operations:
+        key = (operation["kind"], operation["method"])
+        if groups and groups[-1][0] == key:
+            groups[-1][1].append(operation)
+        else:
+            groups.append((key, [operation]))
+    return groups
+
+
+def write_plan(recorder, location, backup_location):
+    """Writes the recorded operations, runs that don't depend on order are sorted so equal plans are equal files."""
+    operations = []
+    for (kind, _), group in plan_groups(recorder.operations):
+        if kind not in ORDERED_PLAN_KINDS:
+            group = sorted(group, key=lambda o: (o["path"], o["sha256"]))
+        operations.extend(group)
+    plan = {
+        "version": 1,
+        "url": recorder.url,
+        "backup": str(backup_location),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "preconditions": sorted(recorder.preconditions.values(), key=lambda p: p["path"]),
+        "operations": operations,
+    }
+    with open(location, "w") as f:
+        json.dump(plan, f, indent=4)
+
+
+def dash_apply(args, s):
+    """
+    Runs the operations of a plan: all preconditions are checked first and nothing is written if one changed,
+    then the operations run in plan order, runs of the same kind and method concurrently.
+    """
+    with open(args.plan) as f:
+        plan = json.load(f)
+    if plan["url"].rstrip("/") != args.url.rstrip("/"):
+        logging.error(f"Plan was made for {plan['url']}, not for {args.url}")
+        sys.exit(1)
+
+    tampered = [o for o in plan["operations"] if content_hash(o["body"]) != o["sha256"]]
+    for operation in tampered:
+        logging.error(f"Operation {describe_operation(operation)} was changed after planning")
+
+    # one read per distinct path, the same list of contact points covers all contact point operations
+    current = concurrent_map(s, lambda p: read_precondition(s, args.url, p["path"]), plan["preconditions"])
+    drifted = [p for p, c in zip(plan["preconditions"], current) if (p["status"], p["sha256"]) != (c["status"], c["sha256"])]
+    for precondition in drifted:
+        logging.error(f"{precondition['path']} changed since the plan was made")
+    if tampered or drifted:
+        logging.error("Nothing was applied, make a new plan")
+        sys.exit(1)
+    logging.info(f"All {len(plan['preconditions'])} preconditions hold, applying {len(plan['operations'])} operations")
+
+    failed = []
+    # folder inventory of the target for the dashlist panels, read again after folders were written
+    target_folders = {}
+
+    def apply_operation(operation):
+        body = operation["body"]
+        if operation.get("folders"):
+            body = dict(body, dashboard=add_folder_id_to_dashlist_panels(body["dashboard"], target_folders["inventory"]))
+        data = json.dumps(body) if body is not None else None
+        resp = s.request(operation["method"], f"{args.url}{operation['path']}", data=data)
+        if resp.status_code < 300:
+            logging.info(f"Applied {describe_operation(operation)}")
+            return True
+        if resp.status_code == 412:
+            logging.error(f"{describe_operation(operation)} was rejected, the object changed since the plan was made")
+        else:
+            logging.error(f"{describe_operation(operation)} failed: HTTP {resp.status_code} {resp.text}")
+        failed.append(operation)
+        return False
+
+    applied = 0
+    for (kind, method), group in plan_groups(plan["operations"]):
+        if kind == "folders":
+            target_folders.clear()
+        elif "inventory" not in target_folders and any(o.get("folders") for o in group):
+            target_folders["inventory"] = Inventory.from_json(list_folders(s, args.url))
+        with profile_stage(f"apply {kind} {method}"):
+            if kind in ORDERED_PLAN_KINDS:
+                applied += sum(apply_operation(o) for o in group)
+            else:
+                applied += sum(concurrent_map(s, apply_operation, group))
+
+    print(f"\n        Applied: {applied} Failed: {len(failed)}\n")
+    return not failed
+
+def dash_sync(args, source, target):
+    """
+    Copies the source instance straight into the target without an intermediate dump.
+    Dashboards stream from the source fetch workers through the export and import transforms into
+    concurrent target writes, optionally teeing everything into a dump on the way.
+    """
+    logging.info("Sync started")
+
+    # source state and full data for everything except dashboards
+    datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(
+        source, args.source_url, args.tag
+    )
+    print_found(datasources, folders, dashboards, alertrules, contactpoints, policies, preferences)
+    datasources = fetch_datasources(source, args.source_url, datasources)
+    folders = fetch_folders(source, args.source_url, folders)
+    alertrules, rulegroups = fetch_alertrules(source, args.source_url, alertrules)
+    contactpoints = fetch_contactpoints(source, args.source_url, contactpoints)
+    policies = fetch_policies(source, args.source_url, policies)
+    libraryelements = fetch_libraryelements(source, args.source_url)
+
+    # target state
+    current = get_current_state(target, args.target_url)
+    if args.override:
+        cur_datasources, cur_folders, cur_dashboards, cur_alertrules, cur_contactpoints, cur_policies, _ = current
+        dash_purge(target, args.target_url, cur_folders, cur_dashboards, cur_contactpoints, cur_policies, cur_alertrules, dry_run=args.dry_run)
+        current = get_current_state(target, args.target_url)
+    cur_datasources, cur_folders, cur_dashboards, cur_alertrules, cur_contactpoints, cur_policies, cur_preferences = current
+
+    imported_datasources, duplicated_datasources = import_datasources(
+        target, args.target_url, datasources, cur_datasources, override=args.override, dry_run=args.dry_run
+    )
+    imported_folders, duplicate_folders = import_folders(
+        target, args.target_url, folders, cur_folders, override=args.override, dry_run=args.dry_run
+    )
+    imported_libraryelements, duplicated_libraryelements = import_libraryelements(
+        target, args.target_url, libraryelements, dry_run=args.dry_run
+    )
+    # dashlist panels need the folder ids of the target, including the folders created above
+    target_folders = Inventory.from_json(list_folders(target, args.target_url))
+
+    # at most this many dashboards wait for a target worker, which keeps the stream bounded on both ends
+    slots = threading.BoundedSemaphore(args.workers * 2)
+
+    def import_one(dashboard):
+        try:
+            uid = dashboard["dashboard"].get("uid")
+            return import_dashboards(
+                target,
+                args.target_url,
+                add_folder_id_to_dashlist_panels([dashboard], target_folders),
+                cur_dashboards.only([uid]),
+                dry_run=args.dry_run,
+            )
+        finally:
+            slots.release()
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as importers:
+
+        def synced(stream):
+            for dashboard in stream:
+                yield dashboard
+                if args.location:
+                    # the dump keeps the source version, the import transforms work on a copy
+                    dashboard = copy.deepcopy(dashboard)
+                slots.acquire()
+                results.append(importers.submit(import_one, dashboard))
+
+        stream = synced(stream_dashboards(
+            source, args.source_url, dashboards, folders, workers=args.workers,
+            library_uids={e["uid"] for e in libraryelements},
+        ))
+        if args.location:
+            grafana_backup = {
+                "folders": folders,
+                "libraryelements": libraryelements,
+                "dashboards": stream,
+                "datasources": datasources,
+                "rulegroups": rulegroups,
+                "alertrules": alertrules,
+                "preferences": preferences,
+                "contactpoints": contactpoints,
+                "policies": policies,
+            }
+            write_to_filesystem(grafana_backup, args.location, args.data_format, args.source_url, args.encoding)
+        else:
+            for _ in stream:
+                pass
+
+    imported_dashboards, duplicated_dashboards = 0, 0
+    for future in results:
+        imported, duplicated = future.result()
+        imported_dashboards += imported
+        duplicated_dashboards += duplicated
+
+    # alerting and preferences depend on the folders and contact points above
+    imported_contactpoints, duplicate_contactpoints = import_contactpoints(
+        target, args.target_url, contactpoints, cur_contactpoints, dry_run=args.dry_run
+    )
+    if args.bulk_rulegroups:
+        imported_rulegroups, _, imported_alertrules, duplicated_alertrules = import_rulegroups_bulk(
+            target, args.target_url, rulegroups, alertrules, cur_alertrules, override=args.override, dry_run=args.dry_run
+        )
+    else:
+        imported_alertrules, duplicated_alertrules = import_alertrules(
+            target, args.target_url, alertrules, cur_alertrules, dry_run=args.dry_run
+        )
+        imported_rulegroups = import_rulegroups(target, args.target_url, rulegroups, dry_run=args.dry_run)
+    imported_preferences, duplicated_preferences = import_preferences(
+        target, args.target_url, preferences, cur_preferences, dry_run=args.dry_run
+    )
+    imported_policies, duplicated_policies = import_policies(
+        target, args.target_url, policies, cur_policies, dry_run=args.dry_run
+    )
+
+    print_imported(
+        (imported_folders, duplicate_folders),
+        (imported_libraryelements, duplicated_libraryelements),
+        (imported_datasources, duplicated_datasources),
+        (imported_dashboards, duplicated_dashboards),
+        imported_rulegroups,
+        (imported_alertrules, duplicated_alertrules),
+        (imported_preferences, duplicated_preferences),
+        (imported_contactpoints, duplicate_contactpoints),
+        (imported_policies, duplicated_policies),
+    )
+
+    logging.info("Sync completed")
+
+
+def fetch_dashboard_versions(s, url, dashboard_list):
+    """
+    Returns {uid: version} for the dashboards in a search result.
+    Uses the version in the search hit when grafana includes it, otherwise asks the versions api for the latest one.
+    """
+    versions = {d["uid"]: d["version"] for d in dashboard_list if d.get("version") is not None}
+
+    def latest(uid):
+        r = s.get(f"{url}/api/dashboards/uid/{uid}/versions?limit=1")
+        if r.status_code != 200:
+            return None
+        items = dashboard_version_items(r.json())
+        return items[0].get("version") if items else None
+
+    missing = [d["uid"] for d in dashboard_list if d["uid"] not in versions and d.get("type") != "dash-folder"]
+    versions.update(zip(missing, concurrent_map(s, latest, missing)))
+    return versions
+
+
+def poll_dashboard_versions(s, url, dashboard_list, known, recheck):
+    """
+    Returns {uid: version} like fetch_dashboard_versions, but only asks the versions api for candidates.
+    known keeps [search hit hash, version] per uid between polls, least recently checked first.
+    Candidates are new dashboards, dashboards whose search hit (title, folder, tags) changed and the `recheck` least
+    recently checked others, so edits that don't show in the search hit are found once the rotation reaches them.
+    """
+    hits = {d["uid"]: content_hash([d.get("title"), d.get("folderUid"), d.get("tags"), d.get("version")]) for d in dashboard_list}
+    for uid in [uid for uid in known if uid not in hits]:
+        del known[uid]
+    candidates = {uid for uid, hit in hits.items() if uid not in known or known[uid][0] != hit}
+    candidates.update([uid for uid in known if uid not in candidates][:recheck])
+    checked = fetch_dashboard_versions(s, url, [d for d in dashboard_list if d["uid"] in candidates])
+    for uid in candidates:
+        known.pop(uid, None)
+        # failed lookups are not remembered, the dashboard is a candidate again on the next poll
+        if checked.get(uid) is not None:
+            known[uid] = [hits[uid], checked[uid]]
+    return {uid: known[uid][1] if uid in known else None for uid in hits}
+
+
+def poll_source(s, url, tag=False, known=None, recheck=0):
+    """
+    Returns the source listings and a change signal per object.
+    Signals are cheap to get: dashboard versions, alert rule update timestamps and hashes of the small lists.
+    With known (kept by the caller between polls) dashboard versions are only requested for candidates, see
+    poll_dashboard_versions.
+    """
+    tag_query = f"&tag={tag}" if tag else ""
+    listing = {
+        "datasources": s.get(f"{url}/api/datasources").json(),
+        "folders": list_folders(s, url),
+        "dashboards": [
+            d for d in s.get(f"{url}/api/search?limit=5000&type=dash-db{tag_query}").json()
+            if d.get("type") != "dash-folder"
+        ],
+        "alertrules": s.get(f"{url}/api/v1/provisioning/alert-rules").json(),
+        "contactpoints": s.get(f"{url}/api/v1/provisioning/contact-points").json(),
+        "policies": s.get(f"{url}/api/v1/provisioning/policies").json(),
+    }
+    if known is None:
+        versions = fetch_dashboard_versions(s, url, listing["dashboards"])
+    else:
+        versions = poll_dashboard_versions(s, url, listing["dashboards"], known, recheck)
+    signals = {
+        "datasources": {d["uid"]: content_hash(d) for d in listing["datasources"]},
+        "folders": {f["uid"]: content_hash([f.get("title"), f.get("parentUid")]) for f in listing["folders"]},
+        "dashboards": {
+            d["uid"]: f"{versions.get(d['uid'])}:{d.get('folderUid')}:{d.get('title')}"
+            for d in listing["dashboards"]
+        },
+        "alertrules": {r["uid"]: r.get("updated") or content_hash(r) for r in listing["alertrules"]},
+        "contactpoints": {cp["name"]: content_hash(cp) for cp in listing["contactpoints"]},
+        "policies": {"root": content_hash(listing["policies"])},
+    }
+    return listing, signals
+
+
+def load_watch_state(location, source_url, target_url):
+    """Returns the applied signals from the state file, or an empty state if it belongs to other instances."""
+    empty = {"source": source_url, "target": target_url, "applied": {}}
+    if not os.path.exists(location):
+        return empty
+    with open(location) as f:
+        state = json.load(f)
+    if state.get("source") != source_url or state.get("target") != target_url:
+        logging.warning(f"State file {location} belongs to {state.get('source')} -> {state.get('target')}, starting fresh")
+        return empty
+    return state
+
+
+def watch_apply(args, source, target, listing, changed, removed):
+    """
+    Replicates the changed and removed objects from the source to the target.
+    Returns the keys per kind that were written and the removed keys that are gone from the target (or were never
+    deleted by the watcher), failed writes and deletes are left out so the next poll tries them again.
+    """
+    dry_run = args.dry_run
+    datasources, folders, dashboards, alertrules, contactpoints, policies, preferences = get_current_state(
+        target, args.target_url
+    )
+    written = {kind: set() for kind in changed}
+    # only dashboards and alert rules are deleted, removed objects of the other kinds are just forgotten
+    deleted = {kind: set(keys) for kind, keys in removed.items() if kind not in ("dashboards", "alertrules")}
+    deleted.update(dashboards=set(), alertrules=set())
+
+    if changed["datasources"]:
+        import_datasources(
+            target, args.target_url,
+            fetch_datasources(source, args.source_url, [d for d in listing["datasources"] if d["uid"] in changed["datasources"]]),
+            datasources, override=False, dry_run=dry_run, update=True, written=written["datasources"],
+        )
+    if changed["folders"]:
+        import_folders(
+            target, args.target_url,
+            fetch_folders(source, args.source_url, [f for f in listing["folders"] if f["uid"] in changed["folders"]]),
+            folders, override=False, dry_run=dry_run, update=True, written=written["folders"],
+        )
+        folders = Inventory.from_json(list_folders(target, args.target_url))
+
+    if changed["dashboards"]:
+        stream = stream_dashboards(
+            source, args.source_url,
+            [d for d in listing["dashboards"] if d["uid"] in changed["dashboards"]],
+            listing["folders"], workers=args.workers,
+        )
+        batch = []
+        for dashboard in stream:
+            batch.append(dashboard)
+            if len(batch) >= args.workers * 4:
+                import_dashboards(
+                    target, args.target_url, add_folder_id_to_dashlist_panels(batch, folders), dashboards,
+                    dry_run=dry_run, written=written["dashboards"],
+                )
+                batch = []
+        if batch:
+            import_dashboards(
+                target, args.target_url, add_folder_id_to_dashlist_panels(batch, folders), dashboards,
+                dry_run=dry_run, written=written["dashboards"],
+            )
+    for uid in removed["dashboards"]:
+        if dry_run:
+            logging.info(f"Dry-run: would delete dashboard: {uid}")
+            continue
+        resp = target.delete(f"{args.target_url}/api/dashboards/uid/{uid}")
+        if resp.status_code < 300:
+            deleted["dashboards"].add(uid)
+            logging.info(f"Deleted dashboard: {uid}")
+        else:
+            logging.warning(f"Failed to delete dashboard {uid} with status code: {resp.status_code}")
+
+    if changed["contactpoints"]:
+        import_contactpoints(
+            target, args.target_url,
+            [cp for cp in listing["contactpoints"] if cp["name"] in changed["contactpoints"]],
+            contactpoints, dry_run=dry_run, written=written["contactpoints"],
+        )
+
+    if changed["alertrules"]:
+        rules, rulegroups = fetch_alertrules(
+            source, args.source_url, [r for r in listing["alertrules"] if r["uid"] in changed["alertrules"]]
+        )
+        import_alertrules(target, args.target_url, rules, alertrules, override=True, dry_run=dry_run, written=written["alertrules"])
+        import_rulegroups(target, args.target_url, rulegroups, dry_run=dry_run)
+    for uid in removed["alertrules"]:
+        if dry_run:
+            logging.info(f"Dry-run: would delete alert rule: {uid}")
+            continue
+        resp = target.delete(f"{args.target_url}/api/v1/provisioning/alert-rules/{uid}")
+        if resp.status_code < 300:
+            deleted["alertrules"].add(uid)
+            logging.info(f"Deleted alert rule: {uid}")
+        else:
+            logging.warning(f"Failed to delete alert rule {uid} with status code: {resp.status_code}")
+
+    if changed["policies"]:
+        import_policies(target, args.target_url, listing["policies"], policies, dry_run=dry_run, written=written["policies"])
+
+    return written, deleted
+
+
+def dash_watch(args, source, target):
+    """
+    Polls the source for changes and replicates only the changed objects to the target.
+    What has been applied is kept in a local state file so restarts don't copy everything again.
+    The poll interval doubles while nothing changes and drops back as soon as something does.
+    """
+    logging.info("Watch started")
+    state = load_watch_state(args.state, args.source_url, args.target_url)
+    interval = args.interval
+    # search hits and versions of the source dashboards, the first poll checks the version of every dashboard
+    known = {}
+
+    while True:
+        try:
+            listing, signals = poll_source(source, args.source_url, args.tag, known, args.recheck)
+            applied = state["applied"]
+            changed = {
+                kind: {key for key, signal in kind_signals.items() if applied.get(kind, {}).get(key) != signal}
+                for kind, kind_signals in signals.items()
+            }
+            # only objects this watcher created are removed, content that only exists in the target is left alone
+            removed = {
+                kind: {key for key in applied.get(kind, {}) if key not in signals[kind]}
+                for kind in signals
+            }
+            count = sum(len(v) for v in changed.values()) + sum(len(v) for v in removed.values())
+
+            if count:
+                logging.info(
+                    "Watch: changes found "
+                    + ", ".join(f"{kind}: {len(changed[kind])} changed {len(removed[kind])} removed" for kind in signals if changed[kind] or removed[kind])
+                )
+                written, deleted = watch_apply(args, source, target, listing, changed, removed)
+                if not args.dry_run:
+                    # only what reached the target is recorded, everything else shows up as changed again
+                    for kind, kind_signals in signals.items():
+                        kind_applied = applied.setdefault(kind, {})
+                        kind_applied.update((key, kind_signals[key]) for key in written.get(kind, ()))
+                        for key in deleted.get(kind, ()):
+                            kind_applied.pop(key, None)
+                    write_json_atomic(args.state, state)
+                    failed = count - sum(len(v) for v in written.values()) - sum(len(v) for v in deleted.values())
+                    if failed:
+                        logging.warning(f"Watch: {failed} changes were not applied, retrying on the next poll")
+                interval = args.interval
+            else:
+                interval = min(interval * 2, args.max_interval)
+                logging.debug("Watch: no changes")
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Watch: poll failed: {e}")
+            interval = min(interval * 2, args.max_interval)
+
+        if args.once:
+            break
+        logging.info(f"Watch: next poll in {interval:.0f}s")
+        time.sleep(interval)
+
+    logging.info("Watch stopped")
+
+
+def human_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+
+def dash_inspect(args):
+    """Lists, filters and extracts objects from a dump using its index, no grafana connection needed."""
+    index = load_backup_index(args.location, args.data_format)
+    data_format = index["format"]
+    objects = index["objects"]
+
+    if args.extract:
+        matches = [o for o in objects if o["uid"] == args.extract and (not args.kind or o["kind"] == args.kind)]
+        if not matches:
+            print(f"Object with uid {args.extract} not found in {args.location}", file=sys.stderr)
+            exit(1)
+        json.dump(read_backup_object(args.location, data_format, matches[0]), sys.stdout, indent=4)
+        print()
+        return
+
+    if args.kind or args.search or args.folder:
+        search = args.search.lower() if args.search else None
+        for o in objects:
+            if args.kind and o["kind"] != args.kind:
+                continue
+            if args.folder and o["folderUid"] != args.folder:
+                continue
+            if search and search not in f"{o['uid']} {o['title']}".lower():
+                continue
+            print(f"{o['kind']:<16} {str(o['uid']):<40} {human_size(o['length']):>10}  {o['title']}")
+        return
+
+    print(f"\nBackup: {args.location} ({index['format']}, {human_size(index['size'])})")
+    if index.get("url"):
+        print(f"Exported from: {index['url']} at {index['created']}")
+    print()
+    totals = {}
+    for o in objects:
+        count, size = totals.get(o["kind"], (0, 0))
+        totals[o["kind"]] = (count + 1, size + o["length"])
+    for kind, (count, size) in totals.items():
+        print(f"    {kind:<16} {count:>6} objects {human_size(size):>12}")
+
+    dashboards = sorted((o for o in objects if o["kind"] == "dashboards"), key=lambda o: o["length"], reverse=True)
+    if dashboards and args.largest > 0:
+        print("\nLargest dashboards:")
+        for o in dashboards[: args.largest]:
+            print(f"    {human_size(o['length']):>10}  {o['uid']:<40} {o['title']}")
+    print()
+
+
+def verify_object(read, entry):
+    """Checks a single object of a json dump by reading only its bytes, read(offset, length) returns them."""
+    data = read(entry["offset"], entry["length"])
+    return len(data) == entry["length"] and hashlib.sha256(data).hexdigest() == entry["sha256"]
+
+
+def verify_backup(location, deep=False, workers=8):
+    """
+    Checks a dump against its index, returns a list of problems (empty when the dump is intact).
+    The file digest is computed in chunks, json dumps are checked object by object with parallel reads of only
+    that object, pickle and dedup dumps have to be loaded as a whole to check objects.
+    Dumps in s3 are hashed while reading parallel ranged requests, objects are checked with a ranged read each.
+    """
+    index = read_backup_index_file(location)
+    if index is None:
+        return [f"no index found ({location}.index.json)"]
+    if "sha256" not in index:
+        return ["index has no checksums, the dump was exported by an older version"]
+
+    problems = []
+    size = backup_size(location)
+    if size is None:
+        return ["dump not found"]
+    if size != index["size"]:
+        problems.append(f"size is {size} bytes, expected {index['size']} (truncated?)")
+    elif file_digest(location, workers=workers) != index["sha256"]:
+        problems.append("file digest does not match")
+    if not problems and not deep:
+        return problems
+
+    entries = index["objects"]
+    if entries and all(e.get("offset") is not None for e in entries) and is_s3_location(location):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda e: verify_object(lambda offset, length: read_backup_range(location, offset, length), e), entries
+            )
+            corrupt = [e for e, ok in zip(entries, results) if not ok]
+    elif entries and all(e.get("offset") is not None for e in entries):
+        fd = os.open(location, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(lambda e: verify_object(lambda offset, length: os.pread(fd, length, offset), e), entries)
+                corrupt = [e for e, ok in zip(entries, results) if not ok]
+        finally:
+            os.close(fd)
+    else:
+        try:
+            corrupt = [e for _, _, e in corrupt_objects(
+                load_backup_file(location, index["format"]), entries, index["format"], index.get("encoding")
+            )]
+        except Exception as e:
+            return problems + [f"can't be read: {e}"]
+    problems.extend(f"{e['kind']} {e.get('uid')} ({e.get('title')}) does not match its checksum" for e in corrupt)
+    return problems
+
+
+def dash_verify(args):
+    """Verifies one or more dumps, folders are searched for dumps with an index. Exits 1 if any dump is damaged."""
+    locations = []
+    for location in args.locations:
+        if os.path.isdir(location):
+            locations.extend(
+                str(p)[: -len(".index.json")] for p in sorted(Path(location).glob("*.index.json"))
+            )
+        else:
+            locations.append(location)
+
+    failed = 0
+    # dumps are checked in parallel, objects inside a dump only for --deep or damaged dumps
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(verify_backup, location, args.deep, args.workers) for location in locations]
+        for location, future in zip(locations, futures):
+            try:
+                problems = future.result()
+            except OSError as e:
+                problems = [str(e)]
+            if problems:
+                failed += 1
+                print(f"FAILED  {location}")
+                for problem in problems:
+                    print(f"        {problem}")
+            else:
+                print(f"OK      {location}")
+    print(f"\nVerified {len(locations)} dumps, {failed} failed")
+    return failed == 0
+
+
+# tokens of a query expression, only the ones that matter for finding metric names and label matchers
+QUERY_TOKEN = re.compile(
+    r"""(?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`[^`]*`)"""
+    r"|(?P<variable>\$\{[^}]*\}|\$\w+|\[\[[^\]]*\]\])"
+    r"|(?P<range>\[[^\]]*\])"
+    r"|(?P<number>\d[\w.]*)"
+    r"|(?P<ident>[A-Za-z_:][\w:]*)"
+    r"|(?P<op>=~|!~|!=|=)"
+    r"|(?P<punct>[{}(),|])"
+)
+
+# promql words that look like metric names
+QUERY_KEYWORDS = {"by", "without", "on", "ignoring", "group_left", "group_right", "bool", "and", "or", "unless", "offset", "inf", "nan"}
+QUERY_GROUPING = {"by", "without", "on", "ignoring", "group_left", "group_right"}
+
+# datasource types whose queries are read as promql, and the ones where only the label matchers count (logql)
+PROMQL_DATASOURCES = {"prometheus"}
+LABEL_DATASOURCES = {"loki"}
+
+# grafana variable queries of the prometheus datasource: label_values(expr, label) and label_values(label)
+LABEL_VALUES = re.compile(r"^\s*label_values\((?:(?P<expr>.*),)?\s*(?P<label>[\w.]+)\s*\)\s*$", re.S)
+
+
+def parse_query_expression(expr):
+    """
+    Returns (metric names, label matchers) of a promql style expression, matchers as (label, op, value),
+    labels that are only named (grouping labels, label_values) have an empty op.
+    Grafana variables, ranges and function names are skipped. Everything after a log
+    pipeline (loki `|`) is ignored so parsers and filters aren't mistaken for metrics.
+    """
+    variable_query = LABEL_VALUES.match(expr)
+    if variable_query:
+        metrics, matchers = parse_query_expression(variable_query["expr"] or "")
+        return metrics, matchers | {(variable_query["label"], "", "")}
+    variable_query = re.match(r"^\s*query_result\((.*)\)\s*$", expr, re.S)
+    if variable_query:
+        expr = variable_query[1]
+
+    tokens = [(m.lastgroup, m.group()) for m in QUERY_TOKEN.finditer(expr)]
+    metrics, matchers = set(), set()
+    i, braces, grouping = 0, False, False
+    while i < len(tokens):
+        kind, text = tokens[i]
+        following = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if braces:
+            if text == "}":
+                braces = False
+            elif kind == "ident" and i + 2 < len(tokens) and tokens[i + 1][0] == "op" and tokens[i + 2][0] in ("string", "variable"):
+                op, value = tokens[i + 1][1], tokens[i + 2][1]
+                value = value[1:-1] if tokens[i + 2][0] == "string" else value
+                if text == "__name__" and op == "=":
+                    metrics.add(value)
+                else:
+                    matchers.add((text, op, value))
+                i += 2
+        elif grouping:
+            grouping = text != ")"
+            if kind == "ident":
+                matchers.add((text, "", ""))
+        elif text == "{":
+            braces = True
+        elif text == "|":
+            break
+        elif kind == "ident" and text.lower() in QUERY_GROUPING and following == "(":
+            grouping = True
+            i += 1
+        elif kind == "ident" and following != "(" and following not in QUERY_GROUPING and text.lower() not in QUERY_KEYWORDS:
+            metrics.add(text)
+        i += 1
+    return metrics, matchers
+
+
+def query_expressions(target):
+    """Returns the query text of a panel target, variable or annotation."""
+    expressions = []
+    for key in ("expr", "query"):
+        value = target.get(key)
+        if isinstance(value, dict):
+            value = value.get("query") or value.get("expr")
+        if isinstance(value, str) and value:
+            expressions.append(value)
+    return expressions
+
+
+def resolve_datasource(ref, datasources):
+    """
+    Returns the index terms of a datasource reference: uid and name under "datasource", the plugin under "dstype".
+    No reference means the default datasource, references to variables only keep the type when it is known.
+    """
+    if ref is None:
+        ref = datasources.get(None)
+    if isinstance(ref, dict):
+        uid, plugin = ref.get("uid"), ref.get("type")
+    else:
+        uid, plugin = ref, None
+    terms = set()
+    if isinstance(uid, str) and uid and "$" not in uid and uid not in BUILTIN_DATASOURCES:
+        known = datasources.get(uid, {})
+        terms.update(("datasource", key) for key in (uid, known.get("uid"), known.get("name")) if key)
+        plugin = plugin or known.get("type")
+    if plugin and plugin not in ("datasource", "grafana", "__expr__"):
+        terms.add(("dstype", plugin))
+    return terms
+
+
+def query_terms(targets, default, datasources):
+    """Returns the index terms of a list of targets that fall back to the datasource of their panel."""
+    terms = resolve_datasource(default, datasources) if default is not None else set()
+    for target in targets:
+        if not isinstance(target, dict):
+            continue
+        datasource = target.get("datasource", default)
+        target_terms = resolve_datasource(datasource, datasources)
+        terms |= target_terms
+        plugins = {value for key, value in target_terms if key == "dstype"}
+        if plugins and not plugins & (PROMQL_DATASOURCES | LABEL_DATASOURCES):
+            # sql, influxql, lucene and the like: their words are neither metrics nor label matchers
+            continue
+        if plugins:
+            expressions = query_expressions(target)
+        else:
+            # the type is unknown (variable datasource), only prometheus and loki write "expr"
+            expressions = [target["expr"]] if isinstance(target.get("expr"), str) and target["expr"] else []
+        for expr in expressions:
+            metrics, matchers = parse_query_expression(expr)
+            # loki selectors only have labels, words in log queries are not metrics
+            if not plugins & LABEL_DATASOURCES:
+                terms.update(("metric", m) for m in metrics)
+            for label, op, value in matchers:
+                terms.add(("labelname", label))
+                if op:
+                    terms.add(("label", f"{label}{op}{value}"))
+    return terms
+
+
+def index_backup_terms(grafana_backup):
+    """
+    Walks the dashboards (panels, nested rows, templating, annotations), library panels and alert rules of a backup.
+    Yields ((kind, uid, title, folderUid, part), terms) where part names the panel, variable or rule query.
+    """
+    datasources = {}
+    for ds in grafana_backup.get("datasources", []):
+        for key in (ds.get("uid"), ds.get("name")):
+            if key:
+                datasources[key] = ds
+        if ds.get("isDefault"):
+            datasources[None] = ds
+    folder_titles = {f.get("uid"): f.get("title") for f in grafana_backup.get("folders", [])}
+
+    def folder_terms(folder_uid):
+        return {("folder", key) for key in (folder_uid, folder_titles.get(folder_uid)) if key}
+
+    for kind, obj in iter_backup_objects(grafana_backup):
+        meta = backup_object_meta(kind, obj)
+        if kind in ("preferences", "policies"):
+            continue
+        ref = (kind, meta["uid"], meta["title"], meta["folderUid"])
+        yield ref + (None,), folder_terms(meta["folderUid"])
+
+        if kind == "dashboards":
+            dashboard = obj.get("dashboard", {})
+            for panel in iter_panels((dashboard.get("panels") or []) + (dashboard.get("rows") or [])):
+                terms = query_terms(panel.get("targets") or [], panel.get("datasource"), datasources)
+                if terms and panel.get("type") != "row":
+                    yield ref + (f"panel {panel.get('id')} {panel.get('title', '')}".rstrip(),), terms
+            for variable in (dashboard.get("templating") or {}).get("list", []):
+                if variable.get("type") == "query":
+                    yield ref + (f"variable {variable.get('name')}",), query_terms([variable], variable.get("datasource"), datasources)
+            for annotation in (dashboard.get("annotations") or {}).get("list", []):
+                if annotation.get("builtIn"):
+                    continue
+                terms = query_terms(annotation.get("targets") or [annotation], annotation.get("datasource"), datasources)
+                if terms:
+                    yield ref + (f"annotation {annotation.get('name')}",), terms
+        elif kind == "libraryelements":
+            model = obj.get("model") or {}
+            terms = query_terms(model.get("targets") or [], model.get("datasource"), datasources)
+            if terms:
+                yield ref + (f"panel {model.get('title', '')}".rstrip(),), terms
+        elif kind == "alertrules":
+            for query in obj.get("data") or []:
+                model = dict(query.get("model") or {}, datasource={"uid": query.get("datasourceUid")})
+                terms = query_terms([model], None, datasources)
+                if terms:
+                    yield ref + (f"query {query.get('refId')}",), terms
+
+
+def load_query_index(location):
+    """Returns the query index or an empty one when it doesn't exist yet."""
+    if not os.path.exists(location):
+        return {"version": 2, "next": 0, "backups": {}, "refs": [], "terms": {}}
+    with open(location) as f:
+        index = json.load(f)
+    if index.get("version") != 2:
+        logging.error(f"{location} is not a query index of this version, remove it to build a new one")
+        sys.exit(1)
+    return index
+
+
+def backup_fingerprint(location):
+    """Returns what identifies the content of a backup, the sha256 from its index or the size and mtime."""
+    size = backup_size(location)
+    backup_index = read_backup_index_file(location)
+    if backup_index and backup_index.get("size") == size and backup_index.get("sha256"):
+        return {"sha256": backup_index["sha256"], "format": backup_index["format"], "created": backup_index.get("created")}
+    return {"size": size, "mtime": None if is_s3_location(location) else os.stat(location).st_mtime}
+
+
+def backup_locations(locations):
+    """Expands folders to the dumps inside them, dumps are recognised by their index or their extension."""
+    found = []
+    for location in locations:
+        if not os.path.isdir(location):
+            found.append(location)
+            continue
+        for p in sorted(Path(location).iterdir()):
+            if p.is_file() and (p.suffix in (".json", ".pickle") and not p.name.endswith(".index.json")):
+                found.append(str(p))
+    return found
+
+
+def dash_index(args):
+    """
+    Adds dumps to the persistent query index, dumps that are already indexed with the same content are skipped.
+    The index maps terms (datasource uid/name, datasource type, metric, label matcher, folder) to the panels,
+    variables and rule queries that use them and the backups they appear in, so queries never load a backup.
+    """
+    index = load_query_index(args.index)
+    refs = {tuple(ref): i for i, ref in enumerate(index["refs"])}
+    by_location = {b["location"]: bid for bid, b in index["backups"].items()}
+
+    def drop(bid):
+        for postings in index["terms"].values():
+            for term, refs_of_term in list(postings.items()):
+                for ref_id, backups in list(refs_of_term.items()):
+                    if bid in backups:
+                        backups.remove(bid)
+                        if not backups:
+                            del refs_of_term[ref_id]
+                if not refs_of_term:
+                    del postings[term]
+        del index["backups"][bid]
+
+    if args.prune:
+        for location, bid in list(by_location.items()):
+            if backup_size(location) is None:
+                logging.info(f"Removing {location} from the index, the dump is gone")
+                drop(bid)
+                del by_location[location]
+
+    added = 0
+    for location in backup_locations(args.locations):
+        location = location if is_s3_location(location) else os.path.abspath(location)
+        fingerprint = backup_fingerprint(location)
+        bid = by_location.get(location)
+        if bid is not None:
+            if {k: index["backups"][bid].get(k) for k in fingerprint} == fingerprint:
+                logging.debug(f"{location} is already indexed")
+                continue
+            logging.info(f"{location} changed, indexing it again")
+            drop(bid)
+
+        data_format = backup_data_format(location, fingerprint.get("format"), args.data_format)
+        try:
+            grafana_backup = load_backup_file(location, data_format)
+        except Exception as e:
+            logging.error(f"Skipping {location}, it can't be read as {data_format}: {e}")
+            continue
+
+        bid = str(index["next"])
+        index["next"] += 1
+        count = 0
+        for ref, terms in index_backup_terms(grafana_backup):
+            ref_id = refs.get(ref)
+            if ref_id is None:
+                ref_id = refs[ref] = len(index["refs"])
+                index["refs"].append(list(ref))
+            for namespace, term in terms:
+                backups = index["terms"].setdefault(namespace, {}).setdefault(term, {}).setdefault(str(ref_id), [])
+                backups.append(bid)
+            count += 1
+        index["backups"][bid] = dict(fingerprint, location=location)
+        by_location[location] = bid
+        added += 1
+        logging.info(f"Indexed {location} ({count} panels, queries and objects)")
+
+    write_json_atomic(args.index, index, separators=(",", ":"))
+    print(f"Added {added} dumps, {args.index} holds {len(index['backups'])} dumps and {len(index['refs'])} references")
+
+
+def match_terms(postings, value, glob=False):
+    """Returns the postings of a term, with glob values with * or ? are matched as patterns against all terms."""
+    if glob and any(c in value for c in "*?["):
+        matched = {}
+        for term in fnmatch.filter(postings, value):
+            for ref_id, backups in postings[term].items():
+                matched.setdefault(ref_id, set()).update(backups)
+        return matched
+    return {ref_id: set(backups) for ref_id, backups in postings.get(value, {}).items()}
+
+
+def dash_query(args):
+    """Answers which dashboards, panels and alert rules use a datasource, metric, label or folder from the query index."""
+    if not os.path.exists(args.index):
+        print(f"Query index {args.index} not found, build it with the index command", file=sys.stderr)
+        exit(1)
+    index = load_query_index(args.index)
+
+    lookups = [
+        ("datasource", args.datasource), ("dstype", args.dstype), ("metric", args.metric), ("folder", args.folder),
+    ] + [("label" if any(op in label for op in ("=", "!~")) else "labelname", label) for label in args.labels or []]
+    lookups = [(namespace, value) for namespace, value in lookups if value]
+    if not lookups:
+        print("Give at least one of --datasource, --type, --metric, --label or --folder", file=sys.stderr)
+        exit(1)
+
+    # every lookup has to match, a reference is kept with the backups that all lookups have in common
+    hits = None
+    for namespace, value in lookups:
+        # label matchers contain regexes, only metric and label names are globs
+        matched = match_terms(index["terms"].get(namespace, {}), value, glob=namespace in ("metric", "labelname"))
+        hits = matched if hits is None else {
+            ref_id: backups & matched[ref_id] for ref_id, backups in hits.items() if backups & matched.get(ref_id, set())
+        }
+
+    backups = index["backups"]
+
+    def recency(bid):
+        # export time from the dump index, dumps without one count by the order they were indexed
+        return backups[bid].get("created") or "", int(bid)
+
+    if args.latest:
+        latest = max(backups, key=recency, default=None)
+        hits = {ref_id: {latest} for ref_id, found in hits.items() if latest in found}
+
+    rows = []
+    for ref_id, found in hits.items():
+        kind, uid, title, folder_uid, part = index["refs"][int(ref_id)]
+        if args.kind and kind != args.kind:
+            continue
+        last = backups[max(found, key=recency)]["location"]
+        rows.append((kind, str(uid), title or "", part or "", len(found), last))
+    for kind, uid, title, part, count, last in sorted(rows):
+        print(f"{kind:<16} {uid:<40} {title} {'/ ' + part if part else ''}".rstrip())
+        print(f"{'':<16} in {count} of {len(backups)} dumps, last: {os.path.basename(last)}")
+    print(f"\n{len(rows)} references found")
+
+
+# commands that only work on a dump and don't need a grafana connection
+OFFLINE_COMMANDS = {"inspect", "verify", "index", "query"}
+
 if __name__ == "__main__":
     # cli_arguments will sys.exit() on non valid input / help
     args = cli_arguments()
-    # session setup will sys.exit(1) if connection fails
-    s = login(args.url, args.secret)
-    
+
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(levelname)s - %(message)s')
 
+    if getattr(args, "profile", None):
+        enable_profiling(args.profile, args.profile_memory)
+    if getattr(args, "cache", False):
+        enable_inventory_cache()
+
+    if args.command == "verify":
+        sys.exit(0 if dash_verify(args) else 1)
+    if args.command == "index":
+        dash_index(args)
+        sys.exit(0)
+    if args.command == "query":
+        dash_query(args)
+        sys.exit(0)
+    if args.command in OFFLINE_COMMANDS:
+        dash_inspect(args)
+        sys.exit(0)
+
+    if args.command in ("sync", "watch"):
+        # session setup will sys.exit(1) if either connection fails
+        source = login(args.source_url, args.source_secret, args.workers)
+        target = login(args.target_url, args.target_secret, args.workers)
+        if args.command == "sync":
+            dash_sync(args, source, target)
+        else:
+            dash_watch(args, source, target)
+        sys.exit(0)
+
+    # session setup will sys.exit(1) if connection fails
+    s = login(args.url, args.secret, args.workers)
+
     # perform export or import
     if args.command == "export":
         dash_export(args, s)
     elif args.command == "import":
         dash_import(args, s)
+    elif args.command == "apply":
+        sys.exit(0 if dash_apply(args, s) else 1)
@@ -0,0 +1,51 @@
+"""Shared fixtures: the dash-move module, a runner for its commands and mock grafana instances."""
+import importlib.util
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from mock_grafana import serve
+
+SCRIPT = Path(__file__).resolve().parent.parent / "dash-move.py"
+
+
+@pytest.fixture(scope="session")
+def dash_move():
+    """dash-move.py loaded as a module, its file name is not importable."""
+    spec = importlib.util.spec_from_file_location("dash_move", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def run():
+    """Runs a dash-move command in a subprocess and returns the result, fails the test on a non zero exit."""
+
+    def run_command(*args, env=None, check=True):
+        result = subprocess.run(
+            [sys.executable, str(SCRIPT), *map(str, args)], capture_output=True, text=True, timeout=120, env=env
+        )
+        if check:
+            assert result.returncode == 0, result.stderr
+        return result
+
+    return run_command
+
+
+@pytest.fixture
+def source():
+    """A seeded mock instance, (state, url)."""
+    server, state, url = serve()
+    yield state, url
+    server.shutdown()
+
+
+@pytest.fixture
+def target():
+    """An empty mock instance, (state, url)."""
+    server, state, url = serve(seeded=False)
+    yield state, url
+    server.shutdown()
@@ -0,0 +1,336 @@
+"""In-memory stand-in for the parts of the grafana http api that dash-move uses, served with http.server."""
+import copy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class State:
+    """Objects of one mock instance, writes is a list of (method, path) of every non GET request, reads the paths of GETs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.datasources = {}
+        self.folders = {}
+        self.dashboards = {}
+        self.versions = {}
+        self.library = {}
+        self.contactpoints = {}
+        self.policies = {"receiver": "grafana-default-email"}
+        self.mute_timings = []
+        self.alertrules = {}
+        self.rulegroups = {}
+        self.org_preferences = {}
+        self.teams = {}
+        self.team_preferences = {}
+        self.next_id = 100
+        self.writes = []
+        self.reads = []
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+
+def seed(state, dashboards=5):
+    """Fills a state with folders, dashboards (with grafana default values), alerting objects and preferences."""
+    state.datasources["ds1"] = {"id": 1, "uid": "ds1", "name": "Prom", "type": "prometheus"}
+    state.folders["f1"] = {"id": 11, "uid": "f1", "title": "Folder 1"}
+    state.folders["f2"] = {"id": 12, "uid": "f2", "title": "Child", "parentUid": "f1"}
+    state.library["lib1"] = {
+        "uid": "lib1", "name": "Shared", "kind": 1, "folderUid": "f1", "version": 1,
+        "model": {"type": "timeseries", "title": "Shared", "targets": [{"expr": "up"}]},
+    }
+    for i in range(dashboards):
+        uid = f"d{i}"
+        dashboard = {
+            "id": 200 + i, "uid": uid, "title": f"Dash {i}", "version": 3,
+            "tags": ["t"] if i % 2 else [], "editable": True, "links": [], "graphTooltip": 0,
+            "timezone": "", "style": "dark",
+            "panels": [
+                {
+                    "id": 1, "type": "timeseries", "title": "p", "transparent": False, "links": [],
+                    "datasource": {"uid": "ds1", "type": "prometheus"},
+                    "targets": [{"expr": f'rate(http_requests_total{{job="api{i}"}}[5m])', "refId": "A"}],
+                    "fieldConfig": {"defaults": {}, "overrides": []}, "pluginVersion": "10.0.0",
+                },
+                {"id": 2, "type": "dashlist", "options": {"folderId": 11}},
+                {"id": 4, "libraryPanel": {"uid": "lib1", "name": "Shared"}},
+                {
+                    "id": 9, "type": "row", "collapsed": True, "title": "r",
+                    "panels": [{"id": 10, "type": "stat", "title": "s", "options": {}, "transformations": []}],
+                },
+            ],
+        }
+        folder = state.folders["f2" if i % 2 else "f1"]
+        state.dashboards[uid] = {
+            "dashboard": dashboard,
+            "meta": {
+                "folderUid": folder["uid"], "folderId": folder["id"], "url": f"/d/{uid}", "slug": f"dash-{i}",
+                "canSave": True, "canEdit": True, "created": "2024-01-01T00:00:00Z", "version": 3,
+            },
+        }
+        state.versions[uid] = [dict(dashboard, version=v, title=f"Dash {i} v{v}") for v in (1, 2, 3)]
+    state.contactpoints["cp1"] = {"uid": "cp1", "name": "email", "type": "email", "settings": {"addresses": "a@b"}}
+    state.policies = {"receiver": "email", "routes": [{"receiver": "email"}]}
+    state.alertrules["r1"] = {
+        "uid": "r1", "title": "Rule 1", "folderUID": "f1", "ruleGroup": "g1",
+        "notification_settings": {"receiver": "email"},
+        "data": [{"refId": "A", "datasourceUid": "ds1", "model": {"expr": "up == 0"}}],
+        "updated": "2024-01-01T00:00:00Z",
+    }
+    state.rulegroups[("f1", "g1")] = {"folderUid": "f1", "title": "g1", "interval": 60}
+    state.org_preferences = {"theme": "dark"}
+    state.teams[1] = {"id": 1, "uid": "team1", "name": "Team 1"}
+    state.team_preferences[1] = {"theme": "light"}
+
+
+class Handler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, obj=None):
+        data = b"" if obj is None else json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_method(self, method):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with self.state.lock:
+            if method != "GET":
+                self.state.writes.append((method, path))
+            else:
+                self.state.reads.append(path)
+            self.route(method, path, path.split("/"), query, body)
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_PATCH(self):
+        self.handle_method("PATCH")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def route(self, method, path, parts, query, body):
+        st = self.state
+        if path == "/api/access-control/user/permissions":
+            return self.send(200, {})
+        if path == "/api/health":
+            return self.send(200, {"database": "ok", "version": "10.0.0"})
+        if path == "/api/org":
+            return self.send(200, {"id": 1, "name": "Main Org."})
+
+        if path == "/api/datasources":
+            if method == "GET":
+                return self.send(200, list(st.datasources.values()))
+            datasource = dict(body, id=st.new_id())
+            st.datasources[datasource["uid"]] = datasource
+            return self.send(200, {"datasource": datasource})
+        if path.startswith("/api/datasources/uid/"):
+            uid = parts[-1]
+            if method == "GET":
+                return self.send(200, st.datasources[uid]) if uid in st.datasources else self.send(404, {})
+            if method == "PUT":
+                st.datasources[uid] = dict(body, id=st.datasources[uid]["id"])
+                return self.send(200, {"datasource": st.datasources[uid]})
+            st.datasources.pop(uid, None)
+            return self.send(200, {})
+
+        if path == "/api/folders":
+            if method == "GET":
+                parent = query.get("parentUid")
+                return self.send(200, [
+                    {"id": f["id"], "uid": f["uid"], "title": f["title"]}
+                    for f in st.folders.values() if f.get("parentUid") == parent
+                ])
+            folder = dict(body, id=st.new_id())
+            st.folders[folder["uid"]] = folder
+            return self.send(200, folder)
+        if path.startswith("/api/folders/id/"):
+            folder_id = int(parts[-1])
+            if folder_id == 0:
+                return self.send(200, {"id": 0, "uid": "general", "title": "General"})
+            folder = next((f for f in st.folders.values() if f["id"] == folder_id), None)
+            return self.send(200, folder) if folder else self.send(404, {})
+        if path.startswith("/api/folders/") and parts[-1] == "move":
+            st.folders[parts[-2]]["parentUid"] = body.get("parentUid")
+            return self.send(200, st.folders[parts[-2]])
+        if path.startswith("/api/folders/"):
+            uid = parts[-1]
+            if method == "PUT":
+                st.folders[uid].update(title=body["title"])
+                return self.send(200, st.folders[uid])
+            if method == "DELETE":
+                st.folders.pop(uid, None)
+                return self.send(200, {})
+            return self.send(200, st.folders[uid]) if uid in st.folders else self.send(404, {})
+
+        if path == "/api/search":
+            if query.get("type") == "dash-folder":
+                return self.send(200, [
+                    {"uid": f["uid"], "title": f["title"], "type": "dash-folder", "folderUid": f.get("parentUid")}
+                    for f in st.folders.values()
+                ])
+            hits = [
+                {
+                    "id": d["dashboard"]["id"], "uid": uid, "title": d["dashboard"]["title"], "type": "dash-db",
+                    "tags": d["dashboard"].get("tags", []), "folderUid": d["meta"].get("folderUid"),
+                }
+                for uid, d in sorted(st.dashboards.items())
+                if not query.get("tag") or query["tag"] in d["dashboard"].get("tags", [])
+            ]
+            limit, page = int(query.get("limit", 1000)), int(query.get("page", 1))
+            return self.send(200, hits[(page - 1) * limit : page * limit])
+
+        if path.startswith("/api/dashboards/uid/") and parts[-1] == "versions":
+            uid = parts[-2]
+            versions = [
+                {"id": i, "version": v["version"], "dashboardUID": uid, "created": "x", "message": ""}
+                for i, v in enumerate(reversed(st.versions.get(uid, [])))
+            ]
+            return self.send(200, versions[: int(query.get("limit", 100))])
+        if path.startswith("/api/dashboards/uid/") and parts[-2] == "versions":
+            uid, version = parts[-3], int(parts[-1])
+            match = next((v for v in st.versions.get(uid, []) if v["version"] == version), None)
+            return self.send(200, {"version": version, "data": match}) if match else self.send(404, {})
+        if path.startswith("/api/dashboards/uid/"):
+            uid = parts[-1]
+            if method == "GET":
+                return self.send(200, st.dashboards[uid]) if uid in st.dashboards else self.send(404, {})
+            st.dashboards.pop(uid, None)
+            return self.send(200, {})
+        if path == "/api/dashboards/db":
+            dashboard = copy.deepcopy(body["dashboard"])
+            current = st.dashboards.get(dashboard["uid"])
+            if current and not body.get("overwrite") and dashboard.get("version") != current["dashboard"]["version"]:
+                return self.send(412, {"status": "version-mismatch"})
+            dashboard["version"] = current["dashboard"]["version"] + 1 if current else 1
+            dashboard["id"] = current["dashboard"]["id"] if current else st.new_id()
+            folder = st.folders.get(body.get("folderUid"), {})
+            st.dashboards[dashboard["uid"]] = {
+                "dashboard": dashboard, "meta": {"folderUid": body.get("folderUid"), "folderId": folder.get("id", 0)},
+            }
+            st.versions.setdefault(dashboard["uid"], []).append(copy.deepcopy(dashboard))
+            return self.send(200, {"id": dashboard["id"], "uid": dashboard["uid"], "version": dashboard["version"]})
+
+        if path == "/api/library-elements":
+            if method == "GET":
+                per_page, page = int(query.get("perPage", 100)), int(query.get("page", 1))
+                elements = list(st.library.values())
+                return self.send(200, {"result": {
+                    "totalCount": len(elements), "elements": elements[(page - 1) * per_page : page * per_page],
+                    "page": page, "perPage": per_page,
+                }})
+            element = dict(body, version=1)
+            st.library[element["uid"]] = element
+            return self.send(200, {"result": element})
+        if path.startswith("/api/library-elements/"):
+            uid = parts[-1]
+            if method == "GET":
+                return self.send(200, {"result": st.library[uid]}) if uid in st.library else self.send(404, {})
+            if method == "PATCH":
+                st.library[uid] = dict(body)
+                return self.send(200, {"result": st.library[uid]})
+            st.library.pop(uid, None)
+            return self.send(200, {})
+
+        if path == "/api/v1/provisioning/contact-points":
+            if method == "GET":
+                return self.send(200, list(st.contactpoints.values()))
+            contactpoint = dict(body)
+            contactpoint.setdefault("uid", f"cp{st.new_id()}")
+            st.contactpoints[contactpoint["uid"]] = contactpoint
+            return self.send(202, contactpoint)
+        if path.startswith("/api/v1/provisioning/contact-points/"):
+            uid = parts[-1]
+            if method == "PUT":
+                st.contactpoints[uid] = dict(body, uid=uid)
+            else:
+                st.contactpoints.pop(uid, None)
+            return self.send(202, {})
+        if path == "/api/v1/provisioning/policies":
+            if method == "GET":
+                return self.send(200, st.policies)
+            st.policies = body if method == "PUT" else {"receiver": "grafana-default-email"}
+            return self.send(202, {})
+        if path == "/api/v1/provisioning/mute-timings":
+            return self.send(200, st.mute_timings)
+        if path == "/api/v1/provisioning/alert-rules":
+            if method == "GET":
+                return self.send(200, list(st.alertrules.values()))
+            st.alertrules[body["uid"]] = body
+            return self.send(201, body)
+        if path.startswith("/api/v1/provisioning/alert-rules/"):
+            uid = parts[-1]
+            if method == "GET":
+                return self.send(200, st.alertrules[uid]) if uid in st.alertrules else self.send(404, {})
+            if method == "PUT":
+                st.alertrules[uid] = body
+                return self.send(200, body)
+            st.alertrules.pop(uid, None)
+            return self.send(204)
+        if path.startswith("/api/v1/provisioning/folder/") and "rule-groups" in parts:
+            folder_uid, group = parts[5], parts[7]
+            if method == "GET":
+                rulegroup = dict(st.rulegroups.get((folder_uid, group), {"folderUid": folder_uid, "title": group}))
+                rulegroup["rules"] = [
+                    r for r in st.alertrules.values() if (r["folderUID"], r["ruleGroup"]) == (folder_uid, group)
+                ]
+                return self.send(200, rulegroup)
+            rulegroup = dict(body)
+            if "rules" in rulegroup:
+                # a group with rules replaces the rules of the group, rules left out are deleted
+                rules = {r["uid"]: dict(r, folderUID=folder_uid, ruleGroup=group) for r in rulegroup.pop("rules")}
+                for uid, rule in list(st.alertrules.items()):
+                    if (rule["folderUID"], rule["ruleGroup"]) == (folder_uid, group) and uid not in rules:
+                        del st.alertrules[uid]
+                st.alertrules.update(rules)
+            st.rulegroups[(folder_uid, group)] = rulegroup
+            return self.send(200, body)
+
+        if path == "/api/org/preferences":
+            if method == "GET":
+                return self.send(200, st.org_preferences)
+            st.org_preferences = body
+            return self.send(200, {})
+        if path == "/api/teams/search":
+            per_page, page = int(query.get("perpage", 1000)), int(query.get("page", 1))
+            teams = list(st.teams.values())
+            return self.send(200, {
+                "totalCount": len(teams), "teams": teams[(page - 1) * per_page : page * per_page],
+                "page": page, "perPage": per_page,
+            })
+        if path.startswith("/api/teams/") and parts[-1] == "preferences":
+            team_id = int(parts[-2])
+            if method == "GET":
+                return self.send(200, st.team_preferences.get(team_id, {}))
+            st.team_preferences[team_id] = body
+            return self.send(200, {})
+        return self.send(404, {"message": f"mock: no route for {method} {path}"})
+
+
+def serve(seeded=True):
+    """Starts a mock instance on a free port, returns (server, state, url)."""
+    state = State()
+    if seeded:
+        seed(state)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), type("MockHandler", (Handler,), {"state": state}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,39 @@
+"""Deltas of older dashboard versions stored by --with-versions."""
+import copy
+import json
+
+
+def dashboard(panels=10):
+    return {
+        "uid": "d", "title": "D",
+        "panels": [
+            {"id": i, "type": "timeseries", "title": f"panel {i}", "targets": [{"refId": "A", "expr": f"metric_{i}"}]}
+            for i in range(panels)
+        ],
+    }
+
+
+def test_added_and_removed_panels_only_store_those_panels(dash_move):
+    latest = dashboard()
+    older = copy.deepcopy(latest)
+    del older["panels"][4]
+    older["panels"].insert(1, {"id": 42, "type": "stat", "title": "removed later"})
+    older["panels"][0]["targets"].append({"refId": "B", "expr": "other"})
+
+    delta = dash_move.json_delta(latest, older)
+    assert dash_move.apply_json_delta(latest, delta) == older
+    stored = json.dumps(delta)
+    assert "removed later" in stored
+    assert "panel 7" not in stored
+
+
+def test_lists_without_ids_are_replaced(dash_move):
+    delta = dash_move.json_delta({"tags": ["a", "b"]}, {"tags": ["a"]})
+    assert delta == {"~": {"tags": ["=", ["a"]]}}
+    assert dash_move.apply_json_delta({"tags": ["a", "b"]}, delta) == {"tags": ["a"]}
+
+
+def test_delta_survives_json(dash_move):
+    latest, older = dashboard(5), dashboard(3)
+    delta = json.loads(json.dumps(dash_move.json_delta(latest, older)))
+    assert dash_move.apply_json_delta(latest, delta) == older
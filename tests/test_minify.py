@@ -0,0 +1,76 @@
+"""Round trip of full and --minify exports through a mock grafana."""
+from mock_grafana import serve
+
+
+def export(run, url, location, *options):
+    run("export", "--location", location, "--format", "json", "--secret", "glsa_test", "--url", url, *options)
+    return location
+
+
+def import_dump(run, url, location):
+    return run("import", "--location", location, "--format", "json", "--secret", "glsa_test", "--url", url)
+
+
+def dashboards_of(dash_move, state):
+    return {
+        uid: (dash_move.minify_dashboard(dash_move._normalize_for_hash(d["dashboard"])), d["meta"].get("folderUid"))
+        for uid, d in state.dashboards.items()
+    }
+
+
+def test_minified_dump_restores_the_same_dashboards(dash_move, run, source, tmp_path):
+    _, source_url = source
+    full = export(run, source_url, tmp_path / "full.json")
+    minified = export(run, source_url, tmp_path / "minified.json", "--minify")
+    assert minified.stat().st_size < full.stat().st_size
+
+    restored = []
+    for dump in (full, minified):
+        server, state, url = serve(seeded=False)
+        try:
+            import_dump(run, url, dump)
+        finally:
+            server.shutdown()
+        restored.append(dashboards_of(dash_move, state))
+
+    from_full, from_minified = restored
+    assert from_full.keys() == from_minified.keys() == {f"d{i}" for i in range(5)}
+    for uid in from_full:
+        # same folderUid and the same dashboard once the grafana default values are left out
+        assert from_full[uid] == from_minified[uid]
+        assert dash_move.hash_dashboard(from_full[uid][0], minified=True) == dash_move.hash_dashboard(
+            from_minified[uid][0], minified=True
+        )
+
+
+def test_reimport_of_minified_dump_skips_everything(run, source, target, tmp_path):
+    _, source_url = source
+    target_state, target_url = target
+    minified = export(run, source_url, tmp_path / "minified.json", "--minify")
+
+    import_dump(run, target_url, minified)
+    # grafana fills the default values in again when it saves a dashboard
+    defaults = {"editable": True, "links": [], "graphTooltip": 0, "timezone": "", "style": "dark"}
+    for dashboard in target_state.dashboards.values():
+        dashboard["dashboard"] = dict(defaults, **dashboard["dashboard"])
+    target_state.writes.clear()
+
+    result = import_dump(run, target_url, minified)
+    assert result.stderr.count("Skipping import for identical dashboard") == 5
+    # rule groups and preferences are written on every import, everything else is skipped
+    assert [
+        write for write in target_state.writes
+        if "/rule-groups/" not in write[1] and not write[1].endswith("/preferences")
+    ] == []
+
+
+def test_full_dump_compares_default_values(run, source, target, tmp_path):
+    _, source_url = source
+    _, target_url = target
+    full = export(run, source_url, tmp_path / "full.json")
+    minified = export(run, source_url, tmp_path / "minified.json", "--minify")
+
+    # only dumps marked as minified are compared without the default values
+    import_dump(run, target_url, minified)
+    assert import_dump(run, target_url, full).stderr.count("Updated dashboard") == 5
+    assert import_dump(run, target_url, full).stderr.count("Skipping import for identical dashboard") == 5
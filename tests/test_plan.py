@@ -0,0 +1,44 @@
+"""Plans made with import --plan-out and run with apply."""
+import json
+
+
+def test_apply_then_import_writes_nothing(run, source, target, tmp_path):
+    _, source_url = source
+    target_state, target_url = target
+    dump, plan = tmp_path / "dump.json", tmp_path / "plan.json"
+    run("export", "--location", dump, "--format", "json", "--secret", "glsa_test", "--url", source_url)
+    target_options = ("--secret", "glsa_test", "--url", target_url)
+
+    run("import", "--location", dump, "--format", "json", "--plan-out", plan, *target_options)
+    assert target_state.writes == []
+    operations = json.loads(plan.read_text())["operations"]
+    # the folder of the dashlist panels is created by the plan itself
+    assert all(o["folders"] == ["f1"] for o in operations if o["kind"] == "dashboards")
+
+    run("apply", plan, *target_options)
+    assert target_state.dashboards["d0"]["dashboard"]["panels"][1]["options"] == {
+        "folderUid": "f1", "folderId": target_state.folders["f1"]["id"],
+    }
+
+    target_state.writes.clear()
+    result = run("import", "--location", dump, "--format", "json", *target_options)
+    assert result.stderr.count("Skipping import for identical dashboard") == 5
+    # rule groups and preferences are written on every import
+    assert [
+        write for write in target_state.writes
+        if "/rule-groups/" not in write[1] and not write[1].endswith("/preferences")
+    ] == []
+
+
+def test_apply_profiles_every_group(run, source, target, tmp_path):
+    _, source_url = source
+    _, target_url = target
+    dump, plan, profile = tmp_path / "dump.json", tmp_path / "plan.json", tmp_path / "profile"
+    run("export", "--location", dump, "--format", "json", "--secret", "glsa_test", "--url", source_url)
+    target_options = ("--secret", "glsa_test", "--url", target_url)
+    run("import", "--location", dump, "--format", "json", "--plan-out", plan, *target_options)
+
+    run("apply", plan, *target_options, "--profile", profile)
+    stages = sorted(path.name[: -len(".pstats")] for path in profile.glob("*.pstats"))
+    assert "04-apply dashboards POST" in stages
+    assert len((profile / "summary.txt").read_text().splitlines()) == len(stages)
@@ -0,0 +1,21 @@
+"""Stages written by --profile and --profile-memory."""
+import tracemalloc
+
+
+def test_memory_of_a_stage_is_a_diff_against_its_start(dash_move, monkeypatch, tmp_path):
+    for key, value in dash_move.PROFILE.items():
+        monkeypatch.setitem(dash_move.PROFILE, key, value)
+    dash_move.enable_profiling(tmp_path, memory=True)
+    try:
+        kept = [bytearray(1024) for _ in range(1000)]
+        with dash_move.profile_stage("alloc"):
+            grown = [bytearray(1024) for _ in range(1000)]
+    finally:
+        tracemalloc.stop()
+
+    memory = (tmp_path / "01-alloc.memory.txt").read_text().splitlines()
+    assert len(kept) == len(grown)
+    # the allocations of the stage come first, allocations from before the stage didn't grow
+    assert memory[0].startswith(f"{__file__}:12: size=") and " KiB (+" in memory[0]
+    assert all(" (+0 B)" in line for line in memory if line.startswith(f"{__file__}:10:"))
+    assert not any(line.startswith(tracemalloc.__file__) for line in memory)
@@ -0,0 +1,38 @@
+"""Index terms of panel queries per datasource type."""
+
+DATASOURCES = {
+    "prom": {"uid": "prom", "name": "Prometheus", "type": "prometheus"},
+    "logs": {"uid": "logs", "name": "Loki", "type": "loki"},
+    "influx": {"uid": "influx", "name": "Influx", "type": "influxdb"},
+    "es": {"uid": "es", "name": "Elastic", "type": "elasticsearch"},
+}
+
+
+def terms_of(dash_move, kind, targets, datasource):
+    return {value for key, value in dash_move.query_terms(targets, datasource, DATASOURCES) if key == kind}
+
+
+def test_promql_adds_metrics_and_matchers(dash_move):
+    targets = [{"expr": 'sum by (code) (rate(http_requests_total{job="api"}[5m]))'}]
+    assert terms_of(dash_move, "metric", targets, {"uid": "prom"}) == {"http_requests_total"}
+    assert terms_of(dash_move, "label", targets, {"uid": "prom"}) == {"job=api"}
+    assert terms_of(dash_move, "labelname", targets, {"uid": "prom"}) == {"job", "code"}
+
+
+def test_loki_adds_only_labels(dash_move):
+    targets = [{"expr": 'sum(count_over_time({app="web"} |= "error" | json [5m]))'}]
+    assert terms_of(dash_move, "metric", targets, {"uid": "logs"}) == set()
+    assert terms_of(dash_move, "label", targets, {"uid": "logs"}) == {"app=web"}
+
+
+def test_other_datasource_types_are_not_parsed(dash_move):
+    influx = [{"query": 'SELECT mean("value") FROM "cpu" WHERE host = \'a\''}]
+    elastic = [{"query": "status:500 AND service:checkout"}]
+    for targets, uid in ((influx, "influx"), (elastic, "es")):
+        terms = dash_move.query_terms(targets, {"uid": uid}, DATASOURCES)
+        assert {key for key, _ in terms} == {"datasource", "dstype"}
+
+
+def test_null_panels_and_rows_are_skipped(dash_move):
+    backup = {"dashboards": [{"dashboard": {"uid": "d", "title": "D", "panels": None, "rows": None}, "meta": {}}]}
+    assert [ref[1] for ref, _ in dash_move.index_backup_terms(backup)] == ["d"]
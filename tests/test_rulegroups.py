@@ -0,0 +1,65 @@
+"""Alert rule groups written with --bulk-rulegroups."""
+import json
+
+
+def rule(uid, title, receiver="email"):
+    return {
+        "uid": uid, "title": title, "folderUID": "f1", "ruleGroup": "g1",
+        "notification_settings": {"receiver": receiver},
+        "data": [{"refId": "A", "datasourceUid": "ds1", "model": {"expr": "up == 0"}}],
+    }
+
+
+def export_with_rule(run, source, tmp_path, new_rule):
+    source_state, source_url = source
+    source_state.alertrules[new_rule["uid"]] = new_rule
+    dump = tmp_path / "dump.json"
+    run("export", "--location", dump, "--format", "json", "--secret", "glsa_test", "--url", source_url)
+    return dump
+
+
+def seed_target(target_state):
+    target_state.folders["f1"] = {"id": 11, "uid": "f1", "title": "Folder 1"}
+    target_state.contactpoints["cp1"] = {"uid": "cp1", "name": "email", "type": "email", "settings": {"addresses": "a@b"}}
+    target_state.alertrules["r1"] = rule("r1", "Rule 1 changed in the target")
+    target_state.alertrules["r2"] = rule("r2", "Only in the target")
+    target_state.rulegroups[("f1", "g1")] = {"folderUid": "f1", "title": "g1", "interval": 60}
+
+
+def test_existing_rules_are_kept_without_override(run, source, target, tmp_path):
+    target_state, target_url = target
+    dump = export_with_rule(run, source, tmp_path, rule("r3", "New rule"))
+    seed_target(target_state)
+
+    run("import", "--location", dump, "--format", "json", "--bulk-rulegroups", "--secret", "glsa_test", "--url", target_url)
+    titles = {uid: r["title"] for uid, r in target_state.alertrules.items()}
+    assert titles == {"r1": "Rule 1 changed in the target", "r2": "Only in the target", "r3": "New rule"}
+
+
+def test_override_writes_the_rules_of_the_dump(run, source, target, tmp_path):
+    target_state, target_url = target
+    dump = export_with_rule(run, source, tmp_path, rule("r3", "New rule"))
+    seed_target(target_state)
+
+    run(
+        "import", "--location", dump, "--format", "json", "--bulk-rulegroups", "--override",
+        "--secret", "glsa_test", "--url", target_url,
+    )
+    assert {uid: r["title"] for uid, r in target_state.alertrules.items()} == {"r1": "Rule 1", "r3": "New rule"}
+
+
+def test_group_with_missing_contact_point_is_not_replaced(run, source, target, tmp_path):
+    target_state, target_url = target
+    dump = export_with_rule(run, source, tmp_path, rule("r3", "Needs a missing contact point", receiver="pager"))
+    backup = json.loads(dump.read_text())
+    backup["contactpoints"] = [cp for cp in backup["contactpoints"] if cp["name"] != "pager"]
+    dump.write_text(json.dumps(backup))
+    seed_target(target_state)
+    target_state.writes.clear()
+
+    result = run(
+        "import", "--location", dump, "--format", "json", "--bulk-rulegroups", "--secret", "glsa_test", "--url", target_url,
+    )
+    assert "Not importing rulegroup f1 g1" in result.stderr
+    assert not [write for write in target_state.writes if "/rule-groups/" in write[1]]
+    assert set(target_state.alertrules) == {"r1", "r2"}
@@ -0,0 +1,73 @@
+"""watch --once against mock instances and the dashboard change signal of a poll."""
+
+
+def watch_once(run, source_url, target_url, state_file):
+    return run(
+        "watch", "--source-url", source_url, "--source-secret", "glsa_test",
+        "--target-url", target_url, "--target-secret", "glsa_test", "--state", state_file, "--once",
+    )
+
+
+def edit_dashboard(state, uid, **changes):
+    """Saves a new version of a source dashboard like grafana does."""
+    dashboard = dict(state.dashboards[uid]["dashboard"], **changes)
+    dashboard["version"] += 1
+    state.dashboards[uid]["dashboard"] = dashboard
+    state.versions[uid].append(dict(dashboard))
+
+
+def versions_reads(state):
+    return sorted(path.split("/")[-2] for path in state.reads if path.endswith("/versions"))
+
+
+def test_watch_once_applies_only_changes(run, source, target, tmp_path):
+    source_state, source_url = source
+    target_state, target_url = target
+    state_file = tmp_path / "state.json"
+
+    watch_once(run, source_url, target_url, state_file)
+    assert target_state.dashboards.keys() == source_state.dashboards.keys()
+    assert target_state.folders["f2"]["parentUid"] == "f1"
+
+    target_state.writes.clear()
+    watch_once(run, source_url, target_url, state_file)
+    assert target_state.writes == []
+
+    edit_dashboard(source_state, "d1", title="Renamed")
+    del source_state.dashboards["d2"]
+    watch_once(run, source_url, target_url, state_file)
+    assert target_state.dashboards["d1"]["dashboard"]["title"] == "Renamed"
+    assert "d2" not in target_state.dashboards
+    assert sorted(target_state.writes) == [("DELETE", "/api/dashboards/uid/d2"), ("POST", "/api/dashboards/db")]
+
+
+def test_poll_only_requests_versions_of_candidates(dash_move, source):
+    state, url = source
+    s = dash_move.login(url, "glsa_test")
+    known = {}
+
+    dash_move.poll_source(s, url, known=known, recheck=1)
+    assert versions_reads(state) == [f"d{i}" for i in range(5)]
+
+    # unchanged search hits, only the least recently checked dashboard is asked again
+    state.reads.clear()
+    dash_move.poll_source(s, url, known=known, recheck=1)
+    assert len(versions_reads(state)) == 1
+
+    state.reads.clear()
+    edit_dashboard(state, "d3", title="Renamed")
+    _, signals = dash_move.poll_source(s, url, known=known, recheck=0)
+    assert versions_reads(state) == ["d3"]
+    assert signals["dashboards"]["d3"].startswith("4:")
+
+
+def test_poll_finds_edits_outside_the_search_hit_by_rotation(dash_move, source):
+    state, url = source
+    s = dash_move.login(url, "glsa_test")
+    known = {}
+    _, before = dash_move.poll_source(s, url, known=known, recheck=2)
+
+    # a panel edit doesn't change the search hit
+    edit_dashboard(state, "d0", panels=[])
+    signals = [dash_move.poll_source(s, url, known=known, recheck=2)[1]["dashboards"]["d0"] for _ in range(3)]
+    assert signals[-1] != before["dashboards"]["d0"]